@@ -85,6 +85,7 @@ class BaseTrainer(object):
             score = self.validate()
             self.save_checkpoint(score=score)
         
+        self.finish_logging()
         if self.writer is not None:
             self.writer.flush()
             self.writer.close()
@@ -114,17 +115,21 @@ class BaseTrainer(object):
         self.train_dataset, self.train_sampler = create_training_dataset(self.config)
         # Currently only support batch_size=1 (i.e., one set of target and source views) for each GPU node
         # please use distributed parallel on multiple GPUs to train multiple target views per batch
+        # Workers are kept alive across epochs and load a few batches ahead, the pinned
+        # batches are then copied to the device asynchronously by the ray sampler.
+        worker_kwargs = dict(persistent_workers=True, prefetch_factor=4) if self.config.workers > 0 else dict()
         self.train_loader = torch.utils.data.DataLoader(self.train_dataset, batch_size=1,
                                                    worker_init_fn=seed_worker,
                                                    num_workers=self.config.workers,
                                                    pin_memory=True,
                                                    sampler=self.train_sampler,
-                                                   shuffle=True if self.train_sampler is None else False)
+                                                   shuffle=True if self.train_sampler is None else False,
+                                                   **worker_kwargs)
 
         # Create validation dataset.
         self.val_dataset = dataset_dict[self.config.eval_dataset](self.config, 'validation',
                                                       scenes=self.config.eval_scenes)
-        self.val_loader = DataLoader(self.val_dataset, batch_size=1)
+        self.val_loader = DataLoader(self.val_dataset, batch_size=1, pin_memory=True)
         self.val_loader_iterator = iter(cycle(self.val_loader))
 
     def _setup_visualizer(self):
@@ -239,6 +244,13 @@ class BaseTrainer(object):
         
         return score
 
+    def finish_logging(self) -> None:
+        """
+            Overwrite this function if logs are written in the background, it
+            should return once all of them are written.
+        """
+        pass
+
     def compose_state_dicts(self) -> None:
         """
             Implement this function and follow the format below:
@@ -26,6 +26,10 @@ def config_parser():
      parser.add_argument("--expname", type=str, help='experiment name')
      parser.add_argument('--distributed', action='store_true', help='if use distributed training')
      parser.add_argument("--local_rank", type=int, default=0, help='rank for distributed training')
+     parser.add_argument('--ddp_comm_hook', type=str, default='none', choices=['none', 'fp16', 'powersgd'],
+                         help='compression of the gradients all-reduced in distributed training')
+     parser.add_argument('--powersgd_rank', type=int, default=1,
+                         help='rank of the gradient approximation when ddp_comm_hook is powersgd')
      parser.add_argument("--pretrained", action='store_true', help='if use pretrained feature backbone')
      parser.add_argument("--enable_tensorboard", action='store_true', help='if use tensorboard')
      parser.add_argument("--enable_visdom", action='store_true', help='if use visdom to visualize camera poses')
@@ -33,6 +37,8 @@ def config_parser():
                         help='number of data loading workers (default: 8)')
      parser.add_argument('--seed', type=int, default=3407,
                          help='seed for torch and numpy')
+     parser.add_argument('--deterministic', action='store_true',
+                         help='use deterministic cuDNN kernels and disable TF32 for reproducible runs')
 
      ########## dataset options ##########
      ## train and eval dataset
@@ -61,10 +67,15 @@ def config_parser():
      ## ray sampling options
      parser.add_argument('--sample_mode', type=str, default='uniform',
                          help='how to sample pixels from images for training:'
-                              'uniform|center')
+                              'uniform|center|tile')
+     parser.add_argument('--tile_size', type=int, default=4,
+                         help='size of the square pixel tiles sampled when sample_mode is tile')
      parser.add_argument('--center_ratio', type=float, default=0.8, help='the ratio of center crop to keep')
      parser.add_argument("--N_rand", type=int, default=32 * 16,
                          help='batch size (number of random rays per gradient step)')
+     parser.add_argument("--accum_views", type=int, default=1,
+                         help='number of target views whose gradients are accumulated before each optimizer step, '
+                              'the learning rates decay by optimizer steps')
      parser.add_argument("--chunk_size", type=int, default=1024 * 4,
                          help='number of rays processed in parallel, decrease if running out of memory')
      parser.add_argument("--feat_loss_scale", type=float, default=1e1, help='the hyperparameter of feature metric loss')
@@ -99,12 +110,21 @@ def config_parser():
                          help='decay learning rate by a factor every specified number of steps')
      parser.add_argument("--lrate_decay_pose_steps", type=int, default=50000,
                          help='decay learning rate for pose by a factor every specified number of steps')
+     parser.add_argument("--train_bf16", action='store_true',
+                         help='run the feature net and pose correction under bfloat16 autocast when training')
+     parser.add_argument("--train_fp16", action='store_true',
+                         help='train IBRNet under float16 autocast with a gradient scaler')
+     parser.add_argument("--train_compile", action='store_true',
+                         help='compile the feature net and the coarse/fine networks with torch.compile for training')
 
      ########## rendering options ##########
      parser.add_argument("--N_samples", type=int, default=64, help='number of coarse samples per ray')
      parser.add_argument("--N_importance", type=int, default=64, help='number of important samples per ray')
      parser.add_argument("--inv_uniform", action='store_true',
                          help='if True, will uniformly sample inverse depths')
+     parser.add_argument("--depth_guided_sampling", action='store_true',
+                         help='draw the fine samples around the predicted depth instead of importance sampling, '
+                              'a much smaller N_importance is then sufficient')
      parser.add_argument("--det", action='store_true', help='deterministic sampling for coarse and fine samples')
      parser.add_argument("--white_bkgd", action='store_true',
                          help='apply the trick to avoid fitting to white background')
@@ -121,5 +141,9 @@ def config_parser():
                         help='will take every 1/N images as LLFF test set, paper uses 8')
      parser.add_argument("--visdom_server", type=str, default="localhost")
      parser.add_argument("--visdom_port", type=int, default=9000)
+     parser.add_argument("--eval_fp16", action='store_true',
+                         help='render evaluation views with FP16 autocast and channels_last features')
+     parser.add_argument("--eval_compile", action='store_true',
+                         help='compile the networks with torch.compile for evaluation')
 
      return parser
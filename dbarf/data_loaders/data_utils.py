@@ -16,7 +16,7 @@ import os
 import cv2
 import math
 import numpy as np
-import queue
+import heapq
 import re
 import torchvision.transforms as transforms
 import torch
@@ -301,24 +301,17 @@ def get_nearby_view_ids(target_id: int, graph: Graph, idx_to_node_id: dict, node
     target_node_id = idx_to_node_id[target_id]
     
     neighbors = list(graph.neighbors(target_node_id))
-    qu = queue.PriorityQueue()
+    qu = []
 
     for j in neighbors:
-        if j not in node_id_to_idx.keys():
+        if j not in node_id_to_idx:
             continue
         # Larger weight has higher priority level.
         priority_level = int((1.0 / graph[target_node_id][j]['weight']) * 1e5)
-        qu.put([priority_level, j])
+        qu.append((priority_level, j))
 
-    k = 0
-    select_ids = []
-    while not qu.empty() and k < num_select:
-        ele = qu.get()
-        select_idx = node_id_to_idx[ele[1]] # Map node id in view graph to the index in train set.
-        select_ids.append(select_idx)
-        k += 1
-
-    select_ids = np.array(select_ids)
+    # Map node id in view graph to the index in train set.
+    select_ids = np.array([node_id_to_idx[j] for _, j in heapq.nsmallest(num_select, qu)])
     return select_ids
 
 
@@ -413,3 +406,43 @@ def get_all_image_names(dir, formats=[
 
 def get_filename_from_abs_path(abs_path):
     return abs_path.split('/')[-1]
+
+
+class CUDAPrefetcher(object):
+    """
+    Iterate over a data loader while the tensors under `keys` of the next batch
+    are already being copied to `device` on a side stream, so that the copy
+    overlaps with the work done on the current batch.
+    """
+    def __init__(self, loader, device='cuda:0', keys=('rgb', 'src_rgbs')):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(device=self.device)
+        loader_iter = iter(self.loader)
+        next_data = self._preload(loader_iter, stream)
+        while next_data is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            data = next_data
+            for key in self.keys:
+                if torch.is_tensor(data.get(key)):
+                    data[key].record_stream(current_stream)
+            next_data = self._preload(loader_iter, stream)
+            yield data
+
+    def _preload(self, loader_iter, stream):
+        try:
+            data = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(stream):
+            for key in self.keys:
+                if torch.is_tensor(data.get(key)):
+                    data[key] = data[key].to(self.device, non_blocking=True)
+        return data
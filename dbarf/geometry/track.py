@@ -85,8 +85,7 @@ class TrackBuilder():
         )
 
         # Union all connected tracks.
-        for track_pair in track_element_pairs:
-            finder.union(track_pair[0], track_pair[1])
+        finder.union_all(track_element_pairs)
         finder.validate()
 
         for track_id in range(num_track_elements):
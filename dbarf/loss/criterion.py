@@ -16,7 +16,7 @@
 import torch
 import torch.nn as nn
 
-from utils import img2mse
+from utils import TINY_NUMBER
 from dbarf.geometry.depth import depth2inv
 
 
@@ -27,14 +27,33 @@ class MaskedL2ImageLoss(nn.Module):
     def forward(self, outputs, ray_batch):
         '''
         training criterion
+        :return: masked loss, unmasked mse (same as img2mse() without a mask, for logging)
         '''
         pred_rgb = outputs['rgb']
         pred_mask = outputs['mask'].float()
         gt_rgb = ray_batch['rgb']
 
-        loss = img2mse(pred_rgb, gt_rgb, pred_mask)
+        # same as img2mse() with a mask, the squared errors are shared with the mse
+        sq_diff = (pred_rgb - gt_rgb).square().sum(dim=-1)
+        loss = torch.sum(sq_diff * pred_mask) / (torch.sum(pred_mask) * gt_rgb.shape[-1] + TINY_NUMBER)
+        mse = torch.mean(sq_diff.detach()) / gt_rgb.shape[-1]
 
-        return loss
+        return loss, mse
+
+    def forward_pair(self, outputs_coarse, outputs_fine, ray_batch):
+        '''
+        training criterion of the coarse and fine outputs, the target is only read once
+        :return: masked losses [2], unmasked mses [2], coarse first
+        '''
+        pred_rgb = torch.stack([outputs_coarse['rgb'], outputs_fine['rgb']], dim=0)   # [2, N_rays, 3]
+        pred_mask = torch.stack([outputs_coarse['mask'], outputs_fine['mask']], dim=0).float()  # [2, N_rays]
+        gt_rgb = ray_batch['rgb']
+
+        sq_diff = (pred_rgb - gt_rgb).square().sum(dim=-1)
+        loss = torch.sum(sq_diff * pred_mask, dim=-1) / (torch.sum(pred_mask, dim=-1) * gt_rgb.shape[-1] + TINY_NUMBER)
+        mse = torch.mean(sq_diff.detach(), dim=-1) / gt_rgb.shape[-1]
+
+        return loss, mse
 
 
 def pseudo_huber_loss(residual, scale=10):
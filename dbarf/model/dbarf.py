@@ -22,11 +22,10 @@ class DBARFModel(IBRNetModel):
         super().to_distributed()
 
         if self.args.distributed:
-            self.pose_learner = torch.nn.parallel.DistributedDataParallel(
-                self.pose_learner,
-                device_ids=[self.args.local_rank],
-                output_device=[self.args.local_rank]
-            )
+            self.pose_learner = self.wrap_distributed(self.pose_learner)
+
+    def networks(self):
+        return super().networks() + [self.pose_learner]
 
     def correct_poses(self, fmaps, target_image, ref_imgs, target_camera, ref_cameras,
                       min_depth=0.1, max_depth=100, scaled_shape=(378, 504)):
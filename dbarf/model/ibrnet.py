@@ -1,4 +1,5 @@
 import os
+import contextlib
 
 import torch
 import torch.nn as nn
@@ -158,26 +159,63 @@ class IBRNetModel(Model):
                                    fine_out_ch=self.args.fine_feat_dim,
                                    coarse_only=self.args.coarse_only).cuda()
 
+    def wrap_distributed(self, module):
+        # Gradients are all-reduced bucket by bucket while backward is still running.
+        # The buckets double as the .grad tensors, which saves one copy per step.
+        module = torch.nn.parallel.DistributedDataParallel(
+            module,
+            device_ids=[self.args.local_rank],
+            output_device=self.args.local_rank,
+            broadcast_buffers=False,
+            gradient_as_bucket_view=True
+        )
+
+        # Optionally compress the gradient buckets before they are all-reduced.
+        if self.args.ddp_comm_hook == 'fp16':
+            from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+            module.register_comm_hook(state=None, hook=default_hooks.fp16_compress_hook)
+        elif self.args.ddp_comm_hook == 'powersgd':
+            # Low-rank approximation of the gradients, with error feedback. The first
+            # iterations are all-reduced uncompressed while the model warms up.
+            from torch.distributed.algorithms.ddp_comm_hooks import powerSGD_hook
+            state = powerSGD_hook.PowerSGDState(process_group=None,
+                                                matrix_approximation_rank=self.args.powersgd_rank,
+                                                start_powerSGD_iter=1000)
+            module.register_comm_hook(state=state, hook=powerSGD_hook.powerSGD_hook)
+        return module
+
     def to_distributed(self):
         if self.args.distributed:
-            self.net_coarse = torch.nn.parallel.DistributedDataParallel(
-                self.net_coarse,
-                device_ids=[self.args.local_rank],
-                output_device=self.args.local_rank
-            )
-
-            self.feature_net = torch.nn.parallel.DistributedDataParallel(
-                self.feature_net,
-                device_ids=[self.args.local_rank],
-                output_device=self.args.local_rank
-            )
+            self.net_coarse = self.wrap_distributed(self.net_coarse)
+            self.feature_net = self.wrap_distributed(self.feature_net)
 
             if self.net_fine is not None:
-                self.net_fine = torch.nn.parallel.DistributedDataParallel(
-                    self.net_fine,
-                    device_ids=[self.args.local_rank],
-                    output_device=self.args.local_rank
-                )
+                self.net_fine = self.wrap_distributed(self.net_fine)
+
+    def networks(self):
+        return [self.net_coarse, self.feature_net, self.net_fine]
+
+    def no_sync(self, enabled=True):
+        # Skips the gradient all-reduce of the DDP-wrapped networks, for the forward
+        # and backward passes inside the context. A no-op when not distributed.
+        stack = contextlib.ExitStack()
+        if enabled:
+            for net in self.networks():
+                if isinstance(net, torch.nn.parallel.DistributedDataParallel):
+                    stack.enter_context(net.no_sync())
+        return stack
+
+    def compile_networks(self, mode='default'):
+        # Only the forward functions are compiled, so the modules (and the keys of their
+        # state dicts) stay the same, whether or not they are wrapped by DDP later.
+        # No CUDA graphs by default: the networks also render the validation views,
+        # whose shapes differ from the training batches.
+        if not hasattr(torch, 'compile'):
+            return
+        for net in [self.net_coarse, self.feature_net, self.net_fine]:
+            if net is not None:
+                net = de_parallel(net)
+                net.forward = torch.compile(net.forward, mode=mode)
 
     def switch_to_eval(self):
         self.net_coarse.eval()
@@ -1,3 +1,4 @@
+import functools
 import os
 import time
 
@@ -20,6 +21,12 @@ from perf.model import ssim_torch
 from perf.model.nerf import base
 from perf.geometry import camera
 from perf.utils import utils, visualization
+from dbarf.utils.compile import maybe_compile, mark_dynamic
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 
 class _trunc_exp(Function):
@@ -38,6 +45,90 @@ class _trunc_exp(Function):
 trunc_exp = _trunc_exp.apply
 
 
+@maybe_compile(dynamic=True)
+def _positional_encoding(input, freq, phase): # [B,...,N],[L],[2,1]
+    # Fused into a single kernel: the spectrum, sin, cos and the stacked
+    # tensors are never written back to memory. Since cos(x) = sin(x + pi/2),
+    # both halves come out of one sin pass already in the [sin, cos] layout.
+    spectrum = torch.addcmul(
+        phase, input[..., None, None].to(freq.dtype), freq) # [B,...,N,2,L]
+    input_enc = spectrum.sin_() # [B,...,N,2,L]
+    # The spectrum is evaluated with FP32 frequencies, only the encoding is
+    # stored in the (possibly half-precision) input type.
+    return input_enc.flatten(start_dim=-3).to(input.dtype) # [B,...,2NL]
+
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _composite_cpu(rgb_samples, density_samples, depth_samples,
+                       depth_intv_samples, ray_length, early_term_eps):
+        # [R,N,3],[R,N],[R,N],[R,N],[R]
+        num_rays, num_samples = density_samples.shape
+        rgb = np.zeros((num_rays, 3), dtype=rgb_samples.dtype) # [R,3]
+        depth = np.zeros(num_rays, dtype=depth_samples.dtype) # [R]
+        opacity = np.zeros(num_rays, dtype=density_samples.dtype) # [R]
+        prob = np.zeros((num_rays, num_samples), dtype=density_samples.dtype) # [R,N]
+        for r in numba.prange(num_rays):
+            T = 1.
+            for i in range(num_samples):
+                sigma_delta = density_samples[r, i] * depth_intv_samples[r, i] * ray_length[r]
+                alpha = -np.expm1(-sigma_delta)
+                weight = T * alpha
+                prob[r, i] = weight
+                for c in range(3):
+                    rgb[r, c] += weight * rgb_samples[r, i, c]
+                depth[r] += weight * depth_samples[r, i]
+                opacity[r] += weight
+                T *= 1. - alpha
+                # early ray termination
+                if T < early_term_eps:
+                    break
+        return rgb, depth, opacity, prob
+else:
+    _composite_cpu = None
+
+
+def _composite_weights(sigma_delta): # [B,HW,N]
+    # Since -sigma_delta = log(1 - alpha), one exp over the inclusive cumsum
+    # gives the transmittance after each sample. The transmittance before each
+    # sample is the same tensor shifted by one. alpha comes from expm1, T - T_next
+    # would cancel catastrophically for small sigma_delta.
+    T_next = (-sigma_delta.cumsum(dim=2)).exp_() # [B,HW,N]
+    T = torch_F.pad(T_next[..., :-1], (1, 0), value=1.) # [B,HW,N]
+    return T, T * (-torch.expm1(-sigma_delta)) # [B,HW,N],[B,HW,N]
+
+
+# cumsum, exp, shift and difference generated as one kernel. The number of
+# samples per ray is fixed for each of the coarse and fine passes and stays
+# specialised, the caller marks the ray dimension dynamic.
+_fused_composite_weights = maybe_compile(_composite_weights)
+
+
+@functools.lru_cache(maxsize=4)
+def _graphed_composite_weights(shape, dtype, device):
+    # Rendering without gradients repeats the same ray chunk shape, the
+    # compositing kernels are captured once per shape into a CUDA graph and
+    # replayed, without the per-kernel launch latency. Only a few shapes are
+    # kept, an evicted graph releases its memory pool.
+    static_input = torch.zeros(shape, dtype=dtype, device=device)
+    stream = torch.cuda.Stream(device=device)
+    stream.wait_stream(torch.cuda.current_stream(device))
+    with torch.cuda.stream(stream):
+        _composite_weights(static_input) # warm up before capturing
+    torch.cuda.current_stream(device).wait_stream(stream)
+
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        static_outputs = _composite_weights(static_input)
+
+    def replay(sigma_delta):
+        static_input.copy_(sigma_delta)
+        graph.replay()
+        # The next replay overwrites the static outputs.
+        return tuple(output.clone() for output in static_outputs)
+    return replay
+
+
 class VanillaNeRFGraphModel(base.BaseNeRFGraphModel):
     def __init__(self, config: DictConfig):
         super().__init__(config)
@@ -56,22 +147,24 @@ class VanillaNeRFGraphModel(base.BaseNeRFGraphModel):
         # be able to get the desired results.
         pose = self.get_pose(config, var, mode=mode)
         
-        # render images
-        if config.nerf.rand_rays and mode in ["train", "test-optim"]:
-            # sample random rays for optimization
-            var.ray_idx = torch.randperm(
-                config.H * config.W, device=config.device
-            )[:config.nerf.rand_rays // batch_size]
-            ret = self.render(
-                config, pose, intr=var.intr, ray_idx=var.ray_idx, mode=mode
-            ) # [B,N,3],[B,N,1]
-        else:
-            # render full image (process in slices)
-            ret = self.render_by_slices(
-                config, pose, intr=var.intr, mode=mode
-            ) if config.nerf.rand_rays else self.render(
-                config, pose, intr=var.intr, mode=mode
-            ) # [B,HW,3],[B,HW,1]
+        # render images (in BF16 when mixed precision is enabled)
+        with torch.autocast(device_type="cuda", dtype=torch.bfloat16,
+                            enabled=config.optim.get("amp", False)):
+            if config.nerf.rand_rays and mode in ["train", "test-optim"]:
+                # sample random rays for optimization
+                var.ray_idx = torch.randperm(
+                    config.H * config.W, device=config.device
+                )[:config.nerf.rand_rays // batch_size]
+                ret = self.render(
+                    config, pose, intr=var.intr, ray_idx=var.ray_idx, mode=mode
+                ) # [B,N,3],[B,N,1]
+            else:
+                # render full image (process in slices)
+                ret = self.render_by_slices(
+                    config, pose, intr=var.intr, mode=mode
+                ) if config.nerf.rand_rays else self.render(
+                    config, pose, intr=var.intr, mode=mode
+                ) # [B,HW,3],[B,HW,1]
         
         var.update(ret)
         
@@ -114,15 +207,20 @@ class VanillaNeRFGraphModel(base.BaseNeRFGraphModel):
             # convert center/ray representations to NDC
             center, ray = camera.convert_NDC(config, center, ray, intr=intr)
 
+        # shared by the coarse and fine compositing
+        ray_length = ray.norm(dim=-1, keepdim=True) # [B,HW,1]
+        
         # render with main MLP
         depth_samples = self.sample_depth(
             config, batch_size, num_rays=ray.shape[1]) # [B,HW,N,1]
         
-        rgb_samples, density_samples = self.nerf.forward_samples(
-            config, center, ray, depth_samples, mode=mode)
+        samples = self.nerf.forward_samples(
+            config, center, ray, depth_samples, mode=mode) # [B,HW,N,5]
         
         rgb, depth, opacity, prob = self.nerf.composite(
-            config, ray, rgb_samples, density_samples, depth_samples)
+            config, ray, samples, ray_length=ray_length,
+            depth_intv_samples=self.sample_depth_intervals(config),
+            return_prob=config.nerf.fine_sampling)
         
         ret = edict(rgb=rgb, depth=depth, opacity=opacity) # [B,HW,K]
         
@@ -137,10 +235,10 @@ class VanillaNeRFGraphModel(base.BaseNeRFGraphModel):
                 ], dim=2) # [B,HW,N+Nf,1]
                 depth_samples = depth_samples.sort(dim=2).values
             
-            rgb_samples, density_samples = self.nerf_fine.forward_samples(
-                config, center, ray, depth_samples, mode=mode)
+            samples = self.nerf_fine.forward_samples(
+                config, center, ray, depth_samples, mode=mode) # [B,HW,N+Nf,5]
             rgb_fine, depth_fine, opacity_fine,_ = self.nerf_fine.composite(
-                config, ray, rgb_samples, density_samples, depth_samples)
+                config, ray, samples, ray_length=ray_length)
             ret.update(
                 rgb_fine=rgb_fine, depth_fine=depth_fine, opacity_fine=opacity_fine
             ) # [B,HW,K]
@@ -189,6 +287,24 @@ class VanillaNeRFGraphModel(base.BaseNeRFGraphModel):
         
         return depth_samples
 
+    def sample_depth_intervals(self, config: DictConfig):
+        """
+        Sampling intervals of `sample_depth()` when they are known analytically,
+        i.e. uniform (non-stratified) samples in metric depth. Returns None
+        otherwise, the intervals then have to be computed from the samples.
+        """
+        if config.nerf.sample_stratified or config.nerf.depth.param != "metric":
+            return None
+        
+        depth_min, depth_max = config.nerf.depth.range
+        depth_intv_samples = torch.full(
+            (config.nerf.sample_intvs,),
+            (depth_max - depth_min) / config.nerf.sample_intvs,
+            device=config.device
+        ) # [N]
+        depth_intv_samples[-1] = 1e10
+        return depth_intv_samples
+
     def sample_depth_from_pdf(self, config: DictConfig, pdf):
         depth_min, depth_max = config.nerf.depth.range
         
@@ -515,7 +631,18 @@ class VanillaNeRF(torch.nn.Module):
         torch.nn.init.zeros_(linear.bias)
 
     def forward(self, config, points_3D, ray_unit=None, mode=None): # [B,...,3]
-        if config.arch.posenc:
+        # Encode the points and view directions in one batched call when they
+        # share the same number of frequencies.
+        batch_posenc = config.arch.posenc and config.nerf.view_dep and \
+            config.arch.posenc.L_3D == config.arch.posenc.L_view
+        if batch_posenc:
+            assert(ray_unit is not None)
+            input_enc = self.positional_encoding(
+                config, torch.cat([points_3D, ray_unit], dim=-1),
+                L=config.arch.posenc.L_3D) # [B,...,12L]
+            points_enc, ray_enc = input_enc.chunk(2, dim=-1) # [B,...,6L]
+            points_enc = torch.cat([points_3D, points_enc], dim=-1) # [B,...,6L+3]
+        elif config.arch.posenc:
             points_enc = self.positional_encoding(
                 config, points_3D, L=config.arch.posenc.L_3D)
             points_enc = torch.cat([points_3D, points_enc], dim=-1) # [B,...,6L+3]
@@ -543,8 +670,9 @@ class VanillaNeRF(torch.nn.Module):
         if config.nerf.view_dep:
             assert(ray_unit is not None)
             if config.arch.posenc:
-                ray_enc = self.positional_encoding(
-                    config, ray_unit, L=config.arch.posenc.L_view)
+                if not batch_posenc:
+                    ray_enc = self.positional_encoding(
+                        config, ray_unit, L=config.arch.posenc.L_view)
                 ray_enc = torch.cat([ray_unit, ray_enc], dim=-1) # [B,...,6L+3]
             else:
                 ray_enc = ray_unit
@@ -570,42 +698,110 @@ class VanillaNeRF(torch.nn.Module):
         
         rgb_samples,density_samples = self.forward(
             config, points_3D_samples, ray_unit=ray_unit_samples, mode=mode
-        ) # [B,HW,N],[B,HW,N,3]
-        return rgb_samples,density_samples
+        ) # [B,HW,N,3],[B,HW,N]
+        return self.pack_samples(rgb_samples, density_samples, depth_samples) # [B,HW,N,5]
 
-    def composite(self, config, ray, rgb_samples, density_samples, depth_samples):
-        ray_length = ray.norm(dim=-1, keepdim=True) # [B,HW,1]
+    @staticmethod
+    def pack_samples(rgb_samples, density_samples, depth_samples):
+        # Pack (rgb, density, depth) of each sample into one contiguous row,
+        # the compositing then sweeps a single [B,HW,N,5] tensor.
+        return torch.cat([
+            rgb_samples, density_samples[..., None],
+            depth_samples.expand(*density_samples.shape, 1)
+        ], dim=-1) # [B,HW,N,5]
+
+    def composite(self, config, ray, samples, ray_length=None,
+                  depth_intv_samples=None, return_prob=False):
+        """
+        Volume rendering of the packed samples. The per-sample weights `prob`
+        are only returned when `return_prob` is set (e.g. for hierarchical
+        resampling), None is returned in their place otherwise. `ray_length`
+        is computed from `ray` unless the caller already has it.
+        """
+        rgb_samples = samples[..., :3] # [B,HW,N,3]
+        density_samples = samples[..., 3] # [B,HW,N]
+        depth_samples = samples[..., 4:] # [B,HW,N,1]
+        if ray_length is None:
+            ray_length = ray.norm(dim=-1, keepdim=True) # [B,HW,1]
         
         # volume rendering: compute probability (using quadrature)
-        depth_intv_samples = depth_samples[..., 1:, 0] - depth_samples[..., :-1, 0] # [B,HW,N-1]
-        depth_intv_samples = torch.cat([
-            depth_intv_samples, torch.empty_like(depth_intv_samples[...,:1]).fill_(1e10)
-        ], dim=2) # [B,HW,N]
-        dist_samples = depth_intv_samples * ray_length # [B,HW,N]
-        sigma_delta = density_samples * dist_samples # [B,HW,N]
-        alpha = 1 - (-sigma_delta).exp_() # [B,HW,N]
-        T = (-torch.cat([
-            torch.zeros_like(sigma_delta[..., :1]), sigma_delta[..., :-1]
-        ], dim=2).cumsum(dim=2)).exp_() # [B,HW,N]
-        prob = (T * alpha)[...,None] # [B,HW,N,1]
-        
-        # integrate RGB and depth weighted by probability
-        depth = (depth_samples * prob).sum(dim=2) # [B,HW,1]
-        rgb = (rgb_samples * prob).sum(dim=2) # [B,HW,3]
+        if depth_intv_samples is None:
+            depth_intv_samples = torch_F.pad(
+                depth_samples[..., 1:, 0] - depth_samples[..., :-1, 0], (0, 1), value=1e10
+            ) # [B,HW,N]
+        
+        if _composite_cpu is not None and not rgb_samples.is_cuda and \
+            not torch.is_grad_enabled():
+            return self.composite_cpu(
+                config, ray_length, rgb_samples, density_samples, depth_samples,
+                depth_intv_samples, return_prob=return_prob)
+        
+        # The transmittance is accumulated in FP32 even under autocast, the
+        # long cumulative sum is the only numerically sensitive term here.
+        sigma_delta = density_samples.float().mul(
+            depth_intv_samples).mul_(ray_length.float()) # [B,HW,N]
+        # With gradients a replay would also overwrite the tensors saved for the
+        # backward of an earlier call, so graphs are only used without them.
+        if config.nerf.get("cuda_graph", False) and sigma_delta.is_cuda and \
+            not torch.is_grad_enabled():
+            composite_weights = _graphed_composite_weights(
+                sigma_delta.shape, sigma_delta.dtype, sigma_delta.device)
+        else:
+            # The number of rays changes with the chunk (the last slice of a
+            # render is shorter) and the image resolution, no recompile for it.
+            if sigma_delta.shape[1] > 1:
+                mark_dynamic(sigma_delta, 1)
+            composite_weights = _fused_composite_weights
+        _, prob = composite_weights(sigma_delta) # [B,HW,N]
+        prob = prob.to(samples.dtype)[...,None] # [B,HW,N,1]
+        
+        # No early ray termination here: all the weights are already computed,
+        # it only saves work in the per-ray loop of the CPU path.
+        # integrate RGB and depth weighted by probability, in one batched
+        # reduction over the packed samples
+        integral = (prob.transpose(-1, -2) @ samples) # [B,HW,1,5]
+        rgb, depth = integral[..., 0, :3], integral[..., 0, 4:] # [B,HW,3],[B,HW,1]
         opacity = prob.sum(dim=2) # [B,HW,1]
+        if config.nerf.setbg_opaque:
+            rgb = rgb + config.data.bgcolor * (1 - opacity)
+        return rgb, depth, opacity, prob if return_prob else None # [B,HW,K]
+
+    def composite_cpu(self, config, ray_length, rgb_samples, density_samples,
+                      depth_samples, depth_intv_samples, return_prob=False):
+        # Per-ray compositing loop compiled by numba, the eager PyTorch path is
+        # dominated by the per-op dispatch overhead on CPU.
+        batch_size, num_rays, num_samples = density_samples.shape
+        num_all_rays = batch_size * num_rays
+        early_term_eps = config.nerf.get("early_term_eps", None) or 0.
+        
+        rgb, depth, opacity, prob = _composite_cpu(
+            rgb_samples.float().reshape(num_all_rays, num_samples, 3).numpy(),
+            density_samples.float().reshape(num_all_rays, num_samples).numpy(),
+            depth_samples[..., 0].float().expand(
+                batch_size, num_rays, num_samples).reshape(num_all_rays, num_samples).numpy(),
+            depth_intv_samples.float().expand(
+                batch_size, num_rays, num_samples).reshape(num_all_rays, num_samples).numpy(),
+            ray_length.float().expand(batch_size, num_rays, 1).reshape(num_all_rays).numpy(),
+            early_term_eps
+        )
+        rgb = torch.from_numpy(rgb).view(batch_size, num_rays, 3) # [B,HW,3]
+        depth = torch.from_numpy(depth).view(batch_size, num_rays, 1) # [B,HW,1]
+        opacity = torch.from_numpy(opacity).view(batch_size, num_rays, 1) # [B,HW,1]
+        prob = torch.from_numpy(prob).view(
+            batch_size, num_rays, num_samples, 1) if return_prob else None # [B,HW,N,1]
+        
         if config.nerf.setbg_opaque:
             rgb = rgb + config.data.bgcolor * (1 - opacity)
         return rgb, depth, opacity, prob # [B,HW,K]
 
     def positional_encoding(self, config, input, L): # [B,...,N]
-        shape = input.shape
         freq = 2 ** torch.arange(
             L, dtype=torch.float32, device=config.device
         ) * np.pi # [L]
-        spectrum = input[..., None] * freq # [B,...,N,L]
-        sin,cos = spectrum.sin(), spectrum.cos() # [B,...,N,L]
-        input_enc = torch.stack([sin, cos], dim=-2) # [B,...,N,2,L]
-        input_enc = input_enc.view(*shape[:-1], -1) # [B,...,2NL]
+        phase = torch.tensor(
+            [[0], [np.pi / 2]], dtype=torch.float32, device=config.device
+        ) # [2,1]
+        input_enc = _positional_encoding(input, freq, phase) # [B,...,2NL]
         return input_enc
 
 
@@ -705,41 +901,14 @@ class TCNNVanillaNeRF(torch.nn.Module):
         
         rgb_samples, density_samples = self.forward(
             config, points_3D_samples, ray_unit=ray_unit_samples, mode=mode
-        ) # [B,HW,N],[B,HW,N,3]
+        ) # [B,HW,N,3],[B,HW,N]
         
-        return rgb_samples, density_samples
+        return self.pack_samples(rgb_samples, density_samples, depth_samples) # [B,HW,N,5]
 
-    def composite(self, config, ray, rgb_samples, density_samples, depth_samples):
-        ray_length = ray.norm(dim=-1, keepdim=True) # [B,HW,1]
-        
-        # volume rendering: compute probability (using quadrature)
-        depth_intv_samples = depth_samples[..., 1:, 0] - depth_samples[..., :-1, 0] # [B,HW,N-1]
-        depth_intv_samples = torch.cat([
-            depth_intv_samples, torch.empty_like(depth_intv_samples[...,:1]).fill_(1e10)
-        ], dim=2) # [B,HW,N]
-        dist_samples = depth_intv_samples * ray_length # [B,HW,N]
-        sigma_delta = density_samples * dist_samples # [B,HW,N]
-        alpha = 1 - (-sigma_delta).exp_() # [B,HW,N]
-        T = (-torch.cat([
-            torch.zeros_like(sigma_delta[..., :1]), sigma_delta[..., :-1]
-        ], dim=2).cumsum(dim=2)).exp_() # [B,HW,N]
-        prob = (T * alpha)[...,None] # [B,HW,N,1]
-        
-        # integrate RGB and depth weighted by probability
-        depth = (depth_samples * prob).sum(dim=2) # [B,HW,1]
-        rgb = (rgb_samples * prob).sum(dim=2) # [B,HW,3]
-        opacity = prob.sum(dim=2) # [B,HW,1]
-        if config.nerf.setbg_opaque:
-            rgb = rgb + config.data.bgcolor * (1 - opacity)
-        return rgb, depth, opacity, prob # [B,HW,K]
+    pack_samples = VanillaNeRF.pack_samples
 
-    def positional_encoding(self, config, input, L): # [B,...,N]
-        shape = input.shape
-        freq = 2 ** torch.arange(
-            L, dtype=torch.float32, device=config.device
-        ) * np.pi # [L]
-        spectrum = input[..., None] * freq # [B,...,N,L]
-        sin,cos = spectrum.sin(), spectrum.cos() # [B,...,N,L]
-        input_enc = torch.stack([sin, cos], dim=-2) # [B,...,N,2,L]
-        input_enc = input_enc.view(*shape[:-1], -1) # [B,...,2NL]
-        return input_enc
+    composite = VanillaNeRF.composite
+
+    composite_cpu = VanillaNeRF.composite_cpu
+
+    positional_encoding = VanillaNeRF.positional_encoding
@@ -1,7 +1,6 @@
 import os
 import tqdm
 import networkx
-import queue
 
 import torch
 import torch.nn.functional as torch_F
@@ -9,19 +8,37 @@ import numpy as np
 
 from typing import Tuple
 from easydict import EasyDict as edict
-from einops import rearrange
 from hloc.utils.database import COLMAPDatabase, blob_to_array, \
-    pair_id_to_image_ids, image_ids_to_pair_id
+    pair_id_to_image_ids, image_ids_to_pair_id, MAX_IMAGE_ID
 
+from dbarf.base.functools import lru_cache
 from dbarf.geometry.lie_group import SE3q, SE3
 from dbarf.geometry.utils import get_all_g2o_files, read_g2o_file, read_g2o_file_valid
+from dbarf.utils.compile import maybe_compile
+
+
+@lru_cache(maxsize=None)
+def eye3(device, dtype=torch.float32):
+    """
+    Cached 3x3 identity matrix for a given device and dtype, shared by the
+    rotation helpers below. The returned tensor must not be modified in-place.
+    """
+    return torch.eye(3, device=device, dtype=dtype)
+
+
+@lru_cache(maxsize=None)
+def eye4(device, dtype=torch.float32):
+    """
+    Cached 4x4 identity matrix for a given device and dtype. The returned
+    tensor must not be modified in-place.
+    """
+    return torch.eye(4, device=device, dtype=dtype)
 
 
 # @torch.cuda.amp.autocast(dtype=torch.float32)
 def axis_angle_to_R(v):
     """
     Convert an axis-angle vector to rotation matrix
-    from https://github.com/ActiveVisionLab/nerfmm/blob/main/utils/lie_group_helper.py#L47
 
     Inputs:
         v: (B, 3)
@@ -30,23 +47,8 @@ def axis_angle_to_R(v):
         R: (B, 3, 3)
     """
 
-    if len(v.shape) == 1:
-        v = v.unsqueeze(0)
-
-    if len(v.shape) == 3:
-        v = v.squeeze(0)
-    
-    zero = torch.zeros_like(v[:, :1]) # (B, 1)
-    skew_v0 = torch.cat([zero, -v[:, 2:3], v[:, 1:2]], 1) # (B, 3)
-    skew_v1 = torch.cat([v[:, 2:3], zero, -v[:, 0:1]], 1)
-    skew_v2 = torch.cat([-v[:, 1:2], v[:, 0:1], zero], 1)
-    skew_v = torch.stack([skew_v0, skew_v1, skew_v2], dim=1) # (B, 3, 3)
-
-    norm_v = rearrange(torch.norm(v, dim=1)+1e-7, 'b -> b 1 1')
-    eye = torch.eye(3, device=v.device)
-    R = eye + (torch.sin(norm_v)/norm_v)*skew_v + \
-        ((1-torch.cos(norm_v))/norm_v**2)*(skew_v@skew_v)
-    return R
+    # Rodrigues' formula, shared with so3_exp_map().
+    return so3_exp_map(v.reshape(-1, 3))
 
 
 def euler_angle_to_R(angle):
@@ -54,30 +56,17 @@ def euler_angle_to_R(angle):
     B = angle.size(0)
     x, y, z = angle[:, 0], angle[:, 1], angle[:, 2]
 
-    cosz = torch.cos(z)
-    sinz = torch.sin(z)
-
-    zeros = z.detach() * 0
-    ones = zeros.detach() + 1
-    zmat = torch.stack([cosz, -sinz, zeros,
-                        sinz, cosz, zeros,
-                        zeros, zeros, ones], dim=1).view(B, 3, 3)
-
-    cosy = torch.cos(y)
-    siny = torch.sin(y)
-
-    ymat = torch.stack([cosy, zeros, siny,
-                        zeros, ones, zeros,
-                        -siny, zeros, cosy], dim=1).view(B, 3, 3)
-
-    cosx = torch.cos(x)
-    sinx = torch.sin(x)
-
-    xmat = torch.stack([ones, zeros, zeros,
-                        zeros, cosx, -sinx,
-                        zeros, sinx, cosx], dim=1).view(B, 3, 3)
-
-    rot_mat = xmat.bmm(ymat).bmm(zmat)
+    cosx, sinx = torch.cos(x), torch.sin(x)
+    cosy, siny = torch.cos(y), torch.sin(y)
+    cosz, sinz = torch.cos(z), torch.sin(z)
+
+    # Closed form of R_x @ R_y @ R_z, assembled without the intermediate
+    # per-axis matrices and the two bmm calls.
+    rot_mat = torch.stack([
+        cosy * cosz, -cosy * sinz, siny,
+        sinx * siny * cosz + cosx * sinz, cosx * cosz - sinx * siny * sinz, -sinx * cosy,
+        sinx * sinz - cosx * siny * cosz, cosx * siny * sinz + sinx * cosz, cosx * cosy
+    ], dim=1).view(B, 3, 3)
     return rot_mat
 
 
@@ -93,7 +82,7 @@ class Pose():
         if R is None:
             if not isinstance(t, torch.Tensor):
                 t = torch.tensor(t)
-            R = torch.eye(3, device=t.device).repeat(*t.shape[:-1], 1, 1)
+            R = eye3(t.device).repeat(*t.shape[:-1], 1, 1)
         elif t is None:
             if not isinstance(R, torch.Tensor):
                 R = torch.tensor(R)
@@ -112,10 +101,10 @@ class Pose():
         assert(pose.shape[-2:] == (3, 4))
         return pose
 
-    def invert(self, pose, use_inverse=False):
-        # Invert a camera pose
+    def invert(self, pose):
+        # Invert a camera pose, the inverse of a rotation is its transpose.
         R, t = pose[..., :3], pose[..., 3:]
-        R_inv = R.inverse() if use_inverse else R.transpose(-1, -2)
+        R_inv = R.transpose(-1, -2)
         t_inv = (-R_inv @ t)[..., 0]
         pose_inv = self(R=R_inv, t=t_inv)
         return pose_inv
@@ -156,6 +145,36 @@ class Pose():
         return pose
 
 
+# The pointwise helpers below are scripted so that the chains of sin/cos,
+# divisions and polynomial terms are fused into single kernels.
+@torch.jit.script
+def _split_small_angle(x: torch.Tensor, small_angle: float) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    small = x.abs() < small_angle
+    x_safe = torch.where(small, torch.ones_like(x), x) # avoid NaN gradients
+    return small, x_safe, x * x
+
+
+@torch.jit.script
+def _taylor_A(x: torch.Tensor, small_angle: float) -> torch.Tensor:
+    small, x_safe, x2 = _split_small_angle(x, small_angle)
+    taylor = 1 + x2 * (-1 / 6 + x2 * (1 / 120 + x2 * (-1 / 5040)))
+    return torch.where(small, taylor, x_safe.sin() / x_safe)
+
+
+@torch.jit.script
+def _taylor_B(x: torch.Tensor, small_angle: float) -> torch.Tensor:
+    small, x_safe, x2 = _split_small_angle(x, small_angle)
+    taylor = 1 / 2 + x2 * (-1 / 24 + x2 * (1 / 720 + x2 * (-1 / 40320)))
+    return torch.where(small, taylor, (1 - x_safe.cos()) / (x_safe * x_safe))
+
+
+@torch.jit.script
+def _taylor_C(x: torch.Tensor, small_angle: float) -> torch.Tensor:
+    small, x_safe, x2 = _split_small_angle(x, small_angle)
+    taylor = 1 / 6 + x2 * (-1 / 120 + x2 * (1 / 5040 + x2 * (-1 / 362880)))
+    return torch.where(small, taylor, (x_safe - x_safe.sin()) / (x_safe ** 3))
+
+
 class Lie():
     """
     Lie algebra for SO(3) and SE(3) operations in PyTorch
@@ -164,10 +183,10 @@ class Lie():
     def so3_to_SO3(self, w): # [...,3]
         wx = self.skew_symmetric(w)
         theta = w.norm(dim=-1)[..., None, None]
-        I = torch.eye(3, device=w.device, dtype=torch.float32)
+        I = eye3(w.device, w.dtype)
         A = self.taylor_A(theta)
         B = self.taylor_B(theta)
-        R = I + A * wx + B * wx @ wx
+        R = I + A * wx + B * self.skew_symmetric_square(w, I)
         return R
 
     def SO3_to_so3(self, R, eps=1e-7): # [...,3,3]
@@ -186,12 +205,13 @@ class Lie():
         w,u = wu.split([3, 3], dim=-1)
         wx = self.skew_symmetric(w)
         theta = w.norm(dim=-1)[..., None, None]
-        I = torch.eye(3, device=w.device, dtype=torch.float32)
+        I = eye3(w.device, w.dtype)
         A = self.taylor_A(theta)
         B = self.taylor_B(theta)
         C = self.taylor_C(theta)
-        R = I + A * wx + B * wx @ wx
-        V = I + B * wx + C * wx @ wx
+        wx2 = self.skew_symmetric_square(w, I)
+        R = I + A * wx + B * wx2
+        V = I + B * wx + C * wx2
         Rt = torch.cat([R, (V @ u[..., None])], dim=-1)
         return Rt
 
@@ -200,55 +220,54 @@ class Lie():
         w = self.SO3_to_so3(R)
         wx = self.skew_symmetric(w)
         theta = w.norm(dim=-1)[..., None, None]
-        I = torch.eye(3, device=w.device, dtype=torch.float32)
+        I = eye3(w.device, w.dtype)
         A = self.taylor_A(theta)
         B = self.taylor_B(theta)
-        invV = I - 0.5 * wx + (1 - A / (2 * B)) / (theta ** 2 + eps) * wx @ wx
+        invV = I - 0.5 * wx + (1 - A / (2 * B)) / (theta ** 2 + eps) * \
+            self.skew_symmetric_square(w, I)
         u = (invV @ t)[..., 0]
         wu = torch.cat([w, u], dim=-1)
         return wu    
 
     def skew_symmetric(self, w):
+        # Same layout as hat(): one allocation, then six strided writes.
+        wx = torch.zeros(*w.shape[:-1], 3, 3, dtype=w.dtype, device=w.device)
         w0, w1, w2 = w.unbind(dim=-1)
-        O = torch.zeros_like(w0)
-        wx = torch.stack([torch.stack([O, -w2, w1], dim=-1),
-                          torch.stack([w2, O, -w0], dim=-1),
-                          torch.stack([-w1, w0, O], dim=-1)], dim=-2)
+        wx[..., 0, 1] = -w2
+        wx[..., 0, 2] = w1
+        wx[..., 1, 0] = w2
+        wx[..., 1, 2] = -w0
+        wx[..., 2, 0] = -w1
+        wx[..., 2, 1] = w0
         return wx
 
-    def taylor_A(self, x, nth=10):
-        # Taylor expansion of sin(x)/x
-        ans = torch.zeros_like(x)
-        denom = 1.
-        for i in range(nth + 1):
-            if i > 0:
-                denom *= (2 * i) * (2 * i + 1)
-            ans = ans + (-1) ** i * x ** (2 * i) / denom
-        return ans
-
-    def taylor_B(self, x, nth=10):
-        # Taylor expansion of (1-cos(x))/x**2
-        ans = torch.zeros_like(x)
-        denom = 1.
-        for i in range(nth + 1):
-            denom *= (2 * i + 1) * (2 * i + 2)
-            ans = ans + (-1) ** i * x ** (2 * i) / denom
-        return ans
-
-    def taylor_C(self, x, nth=10):
-        # Taylor expansion of (x-sin(x))/x**3
-        ans = torch.zeros_like(x)
-        denom = 1.
-        for i in range(nth+1):
-            denom *= (2 * i + 2) * (2 * i + 3)
-            ans = ans + (-1) ** i * x ** (2 * i) / denom
-        return ans
+    def skew_symmetric_square(self, w, I):
+        # [w]x @ [w]x = w w^T - |w|^2 I, without a batched 3x3 matmul.
+        wwT = w[..., :, None] * w[..., None, :]
+        return wwT - (w * w).sum(dim=-1)[..., None, None] * I
+
+    # Below this angle the closed forms lose precision (cancellation in
+    # 1-cos(x) and x-sin(x)), their 4-term Taylor expansions are used instead.
+    small_angle = 0.5
+
+    def taylor_A(self, x):
+        # sin(x)/x
+        return _taylor_A(x, self.small_angle)
+
+    def taylor_B(self, x):
+        # (1-cos(x))/x**2
+        return _taylor_B(x, self.small_angle)
+
+    def taylor_C(self, x):
+        # (x-sin(x))/x**3
+        return _taylor_C(x, self.small_angle)
 
 lie = Lie()
 pose = Pose()
 
 
-def rotation_distance(R1, R2, eps=1e-7):
+@torch.jit.script
+def rotation_distance(R1: torch.Tensor, R2: torch.Tensor, eps: float = 1e-7) -> torch.Tensor:
     """
     Args:
         R1: rotation matrix from camera 1 to world
@@ -257,9 +276,8 @@ def rotation_distance(R1, R2, eps=1e-7):
         angle: the angular distance between camera 1 and camera 2.
     """
     # http://www.boris-belousov.net/2016/12/01/quat-dist/
-    # R_diff = R1 @ R2.transpose(-2, -1)
-    R_diff = R1.transpose(-2, -1) @ R2
-    trace = R_diff[..., 0, 0] + R_diff[..., 1, 1] + R_diff[..., 2, 2]
+    # trace(R1^T @ R2) is the sum of the elementwise product of R1 and R2.
+    trace = torch.einsum('...ij,...ij->...', [R1, R2])
     
     # numerical stability near -1/+1
     angle = ((trace - 1) / 2).clamp(-1 + eps, 1 - eps).acos_()
@@ -274,19 +292,16 @@ def to_hom(X):
     return X_hom
 
 
-def move_to(obj, device):
+def move_to(obj, device, non_blocking=True):
     if torch.is_tensor(obj):
-        return obj.to(device)
+        return obj.to(device, non_blocking=non_blocking)
     elif isinstance(obj, dict):
-        res = {}
-        for k, v in obj.items():
-            res[k] = move_to(v, device)
-        return res
+        # Tensor leaves are moved inline, only nested containers recurse.
+        return {k: v.to(device, non_blocking=non_blocking) if torch.is_tensor(v)
+                else move_to(v, device, non_blocking) for k, v in obj.items()}
     elif isinstance(obj, list):
-        res = []
-        for v in obj:
-            res.append(move_to(v, device))
-        return res
+        return [v.to(device, non_blocking=non_blocking) if torch.is_tensor(v)
+                else move_to(v, device, non_blocking) for v in obj]
     else:
         raise TypeError("Invalid type for move_to")
 
@@ -310,6 +325,8 @@ class PoseInitializer(object):
     def __init__(self, data_path: str, image_ids: list, load_external: bool, args) -> None:
         super(PoseInitializer, self).__init__()
         self.device = torch.device(f'cuda:{args.local_rank}')
+        # Homogeneous row [0, 0, 0, 1] appended below [R|t] matrices.
+        self._hom_row = torch.tensor([0, 0, 0, 1], dtype=torch.float32, device=self.device)
         
         if load_external == False:
             return
@@ -345,7 +362,7 @@ class PoseInitializer(object):
         eu3_noise = torch.randn(num_poses, 3, device=self.device) * 0.2 * noise_level
         SO3_noise = axis_angle_to_R(so3_noise)
 
-        init_poses = torch.from_numpy(pose_gt).to(self.device).float()
+        init_poses = torch.from_numpy(pose_gt).float().pin_memory().to(self.device, non_blocking=True)
         init_poses[..., :3, :3] = SO3_noise @ init_poses[..., :3, :3]
         init_poses[..., :3, 3] += eu3_noise
 
@@ -362,15 +379,13 @@ class PoseInitializer(object):
         num_outlier_poses = int(num_poses * outlier_ratio)
         # print(f'[INFO] Number of outlier poses: {num_outlier_poses}')
         if num_outlier_poses > 0:
-            pose_indices = np.array([i for i in range(num_poses)])
-            np.random.shuffle(pose_indices)
-            outlier_pose_indices = pose_indices[:num_outlier_poses]
+            outlier_pose_indices = torch.randperm(num_poses, device=self.device)[:num_outlier_poses]
 
             pose_outlier_level = 0.5
             se3_outlier = torch.randn(num_outlier_poses, 6, device=self.device) * pose_outlier_level
             pose_outlier = torch.cat(
                 (lie.se3_to_SE3(se3_outlier),
-                torch.tensor([0, 0, 0, 1], dtype=torch.float32, device=self.device).repeat(num_outlier_poses, 1, 1)
+                self._hom_row.expand(num_outlier_poses, 1, 4)
             ), dim=1)
             # init_poses[outlier_pose_indices, :, :] = init_poses[outlier_pose_indices, :, :] @ pose_outlier
             init_poses[outlier_pose_indices, :, :] = pose_outlier @ init_poses[outlier_pose_indices, :, :]
@@ -388,8 +403,10 @@ class PoseInitializer(object):
     def init_global_rotations_from_mst(self,
                                        two_view_geometries: dict,
                                        num_rotations):
-        init_global_rotations = torch.eye(3, device=self.device).repeat(num_rotations, 1, 1)
-        init_global_rotations[self.ref_image_id, :, :] = self.ref_image_rotation
+        # The traversal only composes 3x3 matrices, so it runs on the CPU and the
+        # result is moved to the device once at the end.
+        init_global_rotations = eye3(torch.device('cpu')).repeat(num_rotations, 1, 1)
+        init_global_rotations[self.ref_image_id, :, :] = self.ref_image_rotation.cpu()
 
         # Build a weighted graph.
         graph = networkx.Graph()
@@ -400,50 +417,44 @@ class PoseInitializer(object):
         # Find the minimum spanning tree.
         mst = networkx.minimum_spanning_tree(graph)
 
-        visited = [False for i in range(num_rotations)]
-        visited[self.ref_image_id] = True
-        qu = queue.PriorityQueue()
+        # The global rotation of a node only depends on its parent in the tree,
+        # hence all nodes at the same depth from the reference image can be
+        # composed together once their parents are done.
+        parents = dict(networkx.bfs_predecessors(mst, self.ref_image_id))
+        if len(parents) == 0:
+            self.init_global_rotations = init_global_rotations.to(self.device)
+            return
+        
+        depths = networkx.single_source_shortest_path_length(mst, self.ref_image_id)
+        nodes = list(parents.keys())
 
-        def compute_rotation(i, j):
+        def relative_rotation(i, j):
             if i < j:
-                R_ij = two_view_geometries[(i, j)][0]
+                return two_view_geometries[(i, j)][0]
             else:
-                R_ij = two_view_geometries[(j, i)][0].transpose(0, 1)
-
-            R_ij = R_ij.to(self.device).float()
-            init_global_rotations[j] = R_ij @ init_global_rotations[i]
-
-        def add_edges_to_heap(image_id):
-            neighbors = list(mst.neighbors(image_id))
-            for j in neighbors:
-                if visited[j]: continue
+                return two_view_geometries[(j, i)][0].transpose(0, 1)
 
-                priority_level = int(mst[image_id][j]['weight'] * 1e5)
-                qu.put([priority_level, (image_id, j)])
+        R_ij = torch.stack([relative_rotation(parents[j], j) for j in nodes]).cpu().float()
+        node_ids = torch.from_numpy(np.asarray(nodes, dtype=np.int64))
+        parent_ids = torch.from_numpy(np.asarray([parents[j] for j in nodes], dtype=np.int64))
 
-        add_edges_to_heap(self.ref_image_id)
+        # Nodes come out of the BFS sorted by depth, so each depth is a
+        # contiguous slice.
+        node_depths = np.asarray([depths[j] for j in nodes])
+        bounds = np.concatenate([[0], np.flatnonzero(np.diff(node_depths)) + 1, [len(nodes)]])
+        for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            init_global_rotations[node_ids[start:end]] = torch.bmm(
+                R_ij[start:end], init_global_rotations[parent_ids[start:end]])
 
-        while not qu.empty():
-            edge = qu.get()
-            i, j = edge[1][0], edge[1][1]
-            if visited[j] == True: continue
-
-            compute_rotation(i, j)
-            visited[j] = True
-
-            add_edges_to_heap(j)
-
-        self.init_global_rotations = init_global_rotations.to(self.device)
+        self.init_global_rotations = init_global_rotations.to(self.device, non_blocking=True)
 
     @torch.no_grad()
     def init_global_positions(self):
-        global_rotations_dict = dict()
-        for i in range(self.init_global_rotations.shape[0]):
-            global_rotations_dict[i] = self.init_global_rotations[i].double()
-
         # Obtain global positions by differentiable SVD.
-        self.init_global_positions = self.position_estimator.estimate_positions(
-            global_rotations_dict).to(self.device).float()
+        global_rotations_dict = dict(enumerate(self.init_global_rotations.double().unbind(0)))
+        global_positions = self.position_estimator.estimate_positions(global_rotations_dict)
+
+        self.init_global_positions = global_positions.to(self.device).float()
 
     def parse_cameras_and_bounds(self):
         filename = os.path.join(self.path_model, "poses_bounds.npy")
@@ -496,61 +507,73 @@ class PoseInitializer(object):
         database_path = os.path.join(path, "database.db")
         db = COLMAPDatabase.connect(database_path)
 
-        keypoints_dict = dict()
-        for image_id, rows, cols, data in db.execute(
-                "SELECT image_id, rows, cols, data FROM keypoints"):
-            if image_id - 1 not in training_image_ids:
-                continue
-        
-            keypoints_dict[image_id - 1] = torch.from_numpy(
-                blob_to_array(data, np.float32, (rows, cols))
-            )[:, :2]
-        
+        training_set = set(training_image_ids)
+        rows = [row for row in db.execute("SELECT image_id, rows, cols, data FROM keypoints")
+                if row[0] - 1 in training_set]
         db.close()
 
+        keypoints_dict = dict()
+        if len(rows) > 0:
+            # Parse all blobs in numpy and convert to a tensor once, then split
+            # back into per-image views.
+            keypoints = np.concatenate([
+                np.frombuffer(data, np.float32).reshape(num_rows, num_cols)[:, :2]
+                for _, num_rows, num_cols, data in rows
+            ])
+            keypoints = torch.from_numpy(keypoints).split([row[1] for row in rows])
+            keypoints_dict = {row[0] - 1: kps for row, kps in zip(rows, keypoints)}
+
         print(f'[INFO] Loaded keypoints for {len(keypoints_dict)} images.')
         return keypoints_dict
 
     def _get_all_intrinsics(self, path):
-        all_intrinsics = {}
-
         database_path = os.path.join(path, "database.db")
         db = COLMAPDatabase.connect(database_path)
-        for image_id, name, camera_id in db.execute("SELECT image_id, name, camera_id FROM images"):
-            rows = db.execute(
-                f"SELECT model, params FROM cameras WHERE camera_id={camera_id}")
-            model, params = next(rows)
-            params = blob_to_array(params, np.float64)
-
-            if model == 2: # SIMPLE_RADIAL
-                fx, cx, cy = params[0], params[1], params[2]
-                fy = fx
-            else:
+        rows = db.execute(
+            "SELECT images.image_id, cameras.model, cameras.params FROM images "
+            "JOIN cameras ON images.camera_id = cameras.camera_id").fetchall()
+        db.close()
+
+        image_ids, params = [], []
+        for image_id, model, data in rows:
+            if model != 2: # SIMPLE_RADIAL
                 print(f'[ERROR] Camera Model {model} not supported!')
                 raise NotImplementedError
-
-            intrinsics = torch.tensor([[fx, 0, cx], [0, fy, cy], [0, 0, 1]]).float()
-            # assert(image_id - 1 == self.image_name_to_idx[name])
-            all_intrinsics[image_id - 1] = intrinsics
+            image_ids.append(image_id - 1)
+            params.append(np.frombuffer(data, np.float64)[:3])
+
+        if len(image_ids) == 0:
+            return {}
+
+        fx, cx, cy = np.stack(params).T
+        intrinsics = np.zeros((len(image_ids), 3, 3), dtype=np.float32)
+        intrinsics[:, 0, 0] = fx
+        intrinsics[:, 1, 1] = fx
+        intrinsics[:, 0, 2] = cx
+        intrinsics[:, 1, 2] = cy
+        intrinsics[:, 2, 2] = 1
         
-        return all_intrinsics
+        return dict(zip(image_ids, torch.from_numpy(intrinsics).unbind(0)))
 
     def _read_matches_num(self, path: str):
         database_path = os.path.join(path, "database.db")
         # print(f'[DEBUG] database path: {database_path}')
         db = COLMAPDatabase.connect(database_path)
 
-        image_pair_to_matches_num = dict()
-        for pair_id, data in db.execute("SELECT pair_id, data FROM matches"):
-            if data is None:
-                continue
-            
-            image_pair = pair_id_to_image_ids(pair_id)
-            num_matches = blob_to_array(data, np.uint32, (-1, 2)).shape[0]
-            image_pair_to_matches_num[(image_pair[0] - 1, image_pair[1] - 1)] = num_matches
-
+        # Each match is a pair of uint32 indices, i.e. 8 bytes.
+        rows = db.execute(
+            "SELECT pair_id, LENGTH(data) FROM matches WHERE data IS NOT NULL").fetchall()
         db.close()
 
+        if len(rows) == 0:
+            return dict()
+
+        rows = np.asarray(rows, dtype=np.int64)
+        image_ids1, image_ids2 = np.divmod(rows[:, 0], MAX_IMAGE_ID)
+        num_matches = rows[:, 1] // 8
+        image_pair_to_matches_num = dict(zip(
+            zip((image_ids1 - 1).tolist(), (image_ids2 - 1).tolist()), num_matches.tolist()))
+
         return image_pair_to_matches_num
 
     def _load_view_graph(self, path: str, training_image_ids: list):
@@ -618,6 +641,7 @@ class PoseInitializer(object):
         return gt_abs_poses, view_graph
 
 
+@torch.jit.script
 def hat(v: torch.Tensor) -> torch.Tensor:
     """
     Compute the Hat operator [1] of a batch of 3D vectors.
@@ -642,16 +666,12 @@ def hat(v: torch.Tensor) -> torch.Tensor:
     if dim != 3:
         raise ValueError("Input vectors have to be 3-dimensional.")
 
-    h = torch.zeros((N, 3, 3), dtype=v.dtype, device=v.device)
-
     x, y, z = v.unbind(1)
+    O = torch.zeros_like(x)
 
-    h[:, 0, 1] = -z
-    h[:, 0, 2] = y
-    h[:, 1, 0] = z
-    h[:, 1, 2] = -x
-    h[:, 2, 0] = -y
-    h[:, 2, 1] = x
+    h = torch.stack([O, -z, y,
+                     z, O, -x,
+                     -y, x, O], dim=-1).view(N, 3, 3)
 
     return h
 
@@ -697,12 +717,7 @@ def _so3_exp_map(
         raise ValueError("Input tensor shape has to be Nx3.")
 
     nrms = (log_rot * log_rot).sum(1)
-    # phis ... rotation angles
-    rot_angles = torch.clamp(nrms, eps).sqrt()
-    # pyre-fixme[58]: `/` is not supported for operand types `float` and `Tensor`.
-    rot_angles_inv = 1.0 / rot_angles
-    fac1 = rot_angles_inv * rot_angles.sin()
-    fac2 = rot_angles_inv * rot_angles_inv * (1.0 - rot_angles.cos())
+    rot_angles, fac1, fac2 = _so3_exp_factors(nrms, eps)
     skews = hat(log_rot)
     skews_square = torch.bmm(skews, skews)
 
@@ -710,42 +725,42 @@ def _so3_exp_map(
         fac1[:, None, None] * skews
         # pyre-fixme[16]: `float` has no attribute `__getitem__`.
         + fac2[:, None, None] * skews_square
-        + torch.eye(3, dtype=log_rot.dtype, device=log_rot.device)[None]
     )
+    R.diagonal(dim1=-2, dim2=-1).add_(1) # + I
 
     return R, rot_angles, skews, skews_square
 
 
-def euler_angle_to_R(angle):
-    """Convert euler angles to rotation matrix"""
-    B = angle.size(0)
-    x, y, z = angle[:, 0], angle[:, 1], angle[:, 2]
-
-    cosz = torch.cos(z)
-    sinz = torch.sin(z)
-
-    zeros = z.detach() * 0
-    ones = zeros.detach() + 1
-    zmat = torch.stack([cosz, -sinz, zeros,
-                        sinz, cosz, zeros,
-                        zeros, zeros, ones], dim=1).view(B, 3, 3)
-
-    cosy = torch.cos(y)
-    siny = torch.sin(y)
-
-    ymat = torch.stack([cosy, zeros, siny,
-                        zeros, ones, zeros,
-                        -siny, zeros, cosy], dim=1).view(B, 3, 3)
-
-    cosx = torch.cos(x)
-    sinx = torch.sin(x)
-
-    xmat = torch.stack([ones, zeros, zeros,
-                        zeros, cosx, -sinx,
-                        zeros, sinx, cosx], dim=1).view(B, 3, 3)
-
-    rot_mat = xmat.bmm(ymat).bmm(zmat)
-    return rot_mat
+@torch.jit.script
+def _so3_exp_factors(
+    nrms: torch.Tensor, eps: float
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    # phis ... rotation angles
+    rot_angles = torch.clamp(nrms, eps).sqrt()
+    # Near the identity use the Taylor expansions in phi**2 = nrms instead of
+    # dividing by the (clamped) angle.
+    small = nrms <= eps
+    nrms_safe = torch.where(small, torch.ones_like(nrms), nrms) # avoid NaN gradients
+    phis = nrms_safe.sqrt()
+    # sin(phi)/phi
+    fac1 = torch.where(small, 1 - nrms / 6 + nrms * nrms / 120, phis.sin() / phis)
+    # (1-cos(phi))/phi**2
+    fac2 = torch.where(small, 0.5 - nrms / 24 + nrms * nrms / 720, (1.0 - phis.cos()) / nrms_safe)
+    return rot_angles, fac1, fac2
+
+
+@torch.jit.script
+def _se3_V_factors(
+    rotation_angles: torch.Tensor, eps: float
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    nrms = rotation_angles * rotation_angles
+    small = nrms <= eps
+    phis = torch.where(small, torch.ones_like(rotation_angles), rotation_angles)
+    # (1-cos(phi))/phi**2
+    fac1 = torch.where(small, 0.5 - nrms / 24 + nrms * nrms / 720, (1 - phis.cos()) / (phis**2))
+    # (phi-sin(phi))/phi**3
+    fac2 = torch.where(small, 1 / 6 - nrms / 120 + nrms * nrms / 5040, (phis - phis.sin()) / (phis**3))
+    return fac1, fac2
 
 
 def _se3_V_matrix(
@@ -760,25 +775,18 @@ def _se3_V_matrix(
     [1] https://jinyongjeong.github.io/Download/SE3/jlblanco2010geometry3d_techrep.pdf
     """
 
+    fac1, fac2 = _se3_V_factors(rotation_angles, eps)
     V = (
-        torch.eye(3, dtype=log_rotation.dtype, device=log_rotation.device)[None]
-        + log_rotation_hat
-        # pyre-fixme[58]: `**` is not supported for operand types `Tensor` and `int`.
-        * ((1 - torch.cos(rotation_angles)) / (rotation_angles**2))[:, None, None]
-        + (
-            log_rotation_hat_square
-            # pyre-fixme[58]: `**` is not supported for operand types `Tensor` and
-            #  `int`.
-            * ((rotation_angles - torch.sin(rotation_angles)) / (rotation_angles**3))[
-                :, None, None
-            ]
-        )
+        log_rotation_hat * fac1[:, None, None]
+        + log_rotation_hat_square * fac2[:, None, None]
     )
+    V.diagonal(dim1=-2, dim2=-1).add_(1) # + I
 
     return V
 
 
 # https://github.com/facebookresearch/pytorch3d/blob/8c2b0b01f87f62aa66019a88d8461d4e11f72cf6/pytorch3d/transforms/se3.py#L12
+@maybe_compile(dynamic=True)
 def se3_exp_map(log_transform: torch.Tensor, eps: float = 1e-4) -> torch.Tensor:
     """
     Convert a batch of logarithmic representations of SE(3) matrices `log_transform`
@@ -844,39 +852,36 @@ def se3_exp_map(log_transform: torch.Tensor, eps: float = 1e-4) -> torch.Tensor:
         rotation_angles,
         eps=eps,
     )
-    T = torch.bmm(V, log_translation[:, :, None])[:, :, 0]
-
-    transform = torch.zeros(
-        N, 4, 4, dtype=log_transform.dtype, device=log_transform.device
-    )
+    T = torch.einsum('nij,nj->ni', V, log_translation)
 
-    transform[:, :3, :3] = R
-    transform[:, :3, 3] = T
-    transform[:, 3, 3] = 1.0
+    # Assemble [R T; 0 1] in one concatenation rather than zero-fill + writes.
+    bottom = log_transform.new_tensor([0, 0, 0, 1]).expand(N, 1, 4)
+    transform = torch.cat([torch.cat([R, T[:, :, None]], dim=-1), bottom], dim=1)
 
     return transform
 
 
-def random_so3(num_poses: int = 1) -> torch.Tensor:
-    so3 = torch.randn((num_poses, 3), dtype=torch.float32)
+def random_so3(num_poses: int = 1, device='cpu') -> torch.Tensor:
+    so3 = torch.randn((num_poses, 3), dtype=torch.float32, device=device)
     return so3
 
 
-def random_SO3(num_poses: int = 1) -> torch.Tensor:
-    so3 = random_so3(num_poses=num_poses)
+def random_SO3(num_poses: int = 1, device='cpu') -> torch.Tensor:
+    so3 = random_so3(num_poses=num_poses, device=device)
     SO3 = so3_exp_map(so3)
     
     return SO3
 
 
-def random_se3(mean: float=0, std: float=1, num_poses: int = 1):
-    se3 = torch.normal(mean, std, (num_poses, 6), dtype=torch.float32)
+def random_se3(mean: float=0, std: float=1, num_poses: int = 1, device='cpu'):
+    # Sampled where it is consumed, no host-to-device copy afterwards.
+    se3 = torch.empty((num_poses, 6), dtype=torch.float32, device=device).normal_(mean, std)
     return se3
 
 
-def random_SE3(mean: float=0, std: float=1, num_poses: int=1):
-    se3 = random_se3(mean, std, num_poses=num_poses)
-    se3[:, :3] = torch.clamp(se3[:, :3], min=-0.2, max=0.2) # clamp translation
+def random_SE3(mean: float=0, std: float=1, num_poses: int=1, device='cpu'):
+    se3 = random_se3(mean, std, num_poses=num_poses, device=device)
+    se3[:, :3].clamp_(min=-0.2, max=0.2) # clamp translation
     SE3 = se3_exp_map(se3)
     
     return SE3
@@ -63,6 +63,8 @@ class Projector():
 
         return T_refs
 
+    # Pixel coordinates are too large for float16, the geometry always runs in float32.
+    @torch.autocast('cuda', enabled=False)
     def compute_projections(self, xyz, train_cameras, query_camera=None, rel_poses=None):
         '''
         project 3D points into cameras
@@ -71,7 +73,7 @@ class Projector():
         :return: pixel locations [..., 2], mask [...]
         '''
         original_shape = xyz.shape[:2]
-        xyz = xyz.reshape(-1, 3)
+        xyz = xyz.reshape(-1, 3).float()
         num_views = len(train_cameras)
         train_intrinsics = train_cameras[:, 2:18].reshape(-1, 4, 4)  # [n_views, 4, 4]
         train_poses = train_cameras[:, -16:].reshape(-1, 4, 4)  # [n_views, 4, 4]
@@ -92,6 +94,7 @@ class Projector():
         return pixel_locations.reshape((num_views, ) + original_shape + (2, )), \
                mask.reshape((num_views, ) + original_shape)
 
+    @torch.autocast('cuda', enabled=False)
     def compute_angle(self, xyz, query_camera, train_cameras, rel_poses=None):
         '''
         :param xyz: [..., 3]
@@ -101,7 +104,7 @@ class Projector():
         query and target ray directions, the last channel is the inner product of the two directions.
         '''
         original_shape = xyz.shape[:2]
-        xyz = xyz.reshape(-1, 3)
+        xyz = xyz.reshape(-1, 3).float()
         train_poses = train_cameras[:, -16:].reshape(-1, 4, 4)  # [n_views, 4, 4]
         
         num_views = len(train_poses)
@@ -134,6 +137,18 @@ class Projector():
                  ray_diff: [n_rays, n_samples, 4],
                  mask: [n_rays, n_samples, 1]
         '''
+        geometry = self.compute_geometry(xyz, query_camera, train_imgs, train_cameras, rel_poses)
+        return self.sample_features(geometry, feat_maps)
+
+    def compute_geometry(self, xyz, query_camera, train_imgs, train_cameras, rel_poses):
+        '''
+        the part of compute() that does not depend on the feature maps, it can be
+        shared by the coarse and fine passes, see merge_geometry()
+        :return: {'pixel_locations': [n_views, n_rays, n_samples, 2] (normalized),
+                  'rgb_sampled': [n_rays, n_samples, n_views, 3],
+                  'ray_diff': [n_rays, n_samples, n_views, 4],
+                  'mask': [n_rays, n_samples, n_views, 1]}
+        '''
         assert (train_imgs.shape[0] == 1) \
                and (train_cameras.shape[0] == 1) \
                and (query_camera.shape[0] == 1), 'only support batch_size=1 for now'
@@ -154,17 +169,40 @@ class Projector():
         rgbs_sampled = F.grid_sample(train_imgs, normalized_pixel_locations, align_corners=True)
         rgb_sampled = rgbs_sampled.permute(2, 3, 0, 1)  # [n_rays, n_samples, n_views, 3]
 
-        # deep feature sampling
-        feat_sampled = F.grid_sample(feat_maps, normalized_pixel_locations, align_corners=True)
-        feat_sampled = feat_sampled.permute(2, 3, 0, 1)  # [n_rays, n_samples, n_views, d]
-        rgb_feat_sampled = torch.cat([rgb_sampled, feat_sampled], dim=-1)   # [n_rays, n_samples, n_views, d+3]
-
         # mask
         inbound = self.inbound(pixel_locations, h, w)
         ray_diff = self.compute_angle(xyz, query_camera, train_cameras, rel_poses)
         ray_diff = ray_diff.permute(1, 2, 0, 3)
         mask = (inbound * mask_in_front).float().permute(1, 2, 0)[..., None]   # [n_rays, n_samples, n_views, 1]
-        return rgb_feat_sampled, ray_diff, mask
+        return {'pixel_locations': normalized_pixel_locations,
+                'rgb_sampled': rgb_sampled,
+                'ray_diff': ray_diff,
+                'mask': mask}
+
+    def merge_geometry(self, geometry, new_geometry, order):
+        '''
+        concatenate the geometry of two sets of samples along the same rays and reorder the samples
+        :param order: [n_rays, n_samples + n_new_samples], indices into the concatenated samples
+        '''
+        merged = {}
+        for k in geometry:
+            # pixel locations are [n_views, n_rays, n_samples, 2], the others [n_rays, n_samples, ...]
+            dim = 2 if k == 'pixel_locations' else 1
+            index = order[None, ..., None] if dim == 2 else order[..., None, None]
+            merged[k] = torch.take_along_dim(torch.cat([geometry[k], new_geometry[k]], dim=dim), index, dim=dim)
+        return merged
+
+    def sample_features(self, geometry, feat_maps):
+        '''
+        :param geometry: output of compute_geometry()
+        :param feat_maps: [n_views, d, h, w]
+        :return: same as compute()
+        '''
+        # deep feature sampling
+        feat_sampled = F.grid_sample(feat_maps, geometry['pixel_locations'], align_corners=True)
+        feat_sampled = feat_sampled.permute(2, 3, 0, 1)  # [n_rays, n_samples, n_views, d]
+        rgb_feat_sampled = torch.cat([geometry['rgb_sampled'], feat_sampled], dim=-1)   # [n_rays, n_samples, n_views, d+3]
+        return rgb_feat_sampled, geometry['ray_diff'], geometry['mask']
 
     def compute_proj_feature(self, xyz, train_imgs, train_cameras, feat_maps):
         '''
@@ -19,6 +19,8 @@ from collections import OrderedDict
 from dbarf.render_ray import render_rays
 
 
+# Only used for logging and evaluation, no graph is recorded for the rendered views.
+@torch.no_grad()
 def render_single_image(ray_sampler,
                         ray_batch,
                         model,
@@ -32,7 +34,8 @@ def render_single_image(ray_sampler,
                         render_stride=1,
                         feat_maps=None,
                         inv_depth_prior=None,
-                        rel_poses=None):
+                        rel_poses=None,
+                        fine_inv_depth_prior=None):
     '''
     :param ray_sampler: RaySamplingSingleImage for this view
     :param model:  {'net_coarse': , 'net_fine': , ...}
@@ -62,6 +65,10 @@ def render_single_image(ray_sampler,
         if inv_depth_prior is not None:
             inv_depth_prior_chunk = inv_depth_prior[i:i+chunk_size]
 
+        fine_inv_depth_prior_chunk = None
+        if fine_inv_depth_prior is not None:
+            fine_inv_depth_prior_chunk = fine_inv_depth_prior[i:i+chunk_size]
+
         ret = render_rays(chunk, model, feat_maps,
                           projector=projector,
                           N_samples=N_samples,
@@ -70,45 +77,44 @@ def render_single_image(ray_sampler,
                           det=det,
                           white_bkgd=white_bkgd,
                           inv_depth_prior=inv_depth_prior_chunk,
-                          rel_poses=rel_poses)
+                          rel_poses=rel_poses,
+                          fine_inv_depth_prior=fine_inv_depth_prior_chunk)
 
         # handle both coarse and fine outputs
-        # cache chunk results on cpu
+        # cache chunk results on cpu: the outputs are written into one pinned buffer
+        # with a row per ray, allocated at the first chunk. The outputs of a chunk are
+        # concatenated and copied into its rows with a single transfer, without
+        # waiting, the stream is synchronized once after the last chunk
         if i == 0:
+            dtypes = OrderedDict()
             for k in ret['outputs_coarse']:
-                all_ret['outputs_coarse'][k] = []
+                dtypes[('outputs_coarse', k)] = ret['outputs_coarse'][k].dtype
 
             if ret['outputs_fine'] is None:
                 all_ret['outputs_fine'] = None
             else:
                 for k in ret['outputs_fine']:
-                    all_ret['outputs_fine'][k] = []
+                    dtypes[('outputs_fine', k)] = ret['outputs_fine'][k].dtype
+
+            widths = [ret[name][k][0].numel() for name, k in dtypes]
+            all_outputs = torch.empty((N_rays, sum(widths)), pin_memory=torch.cuda.is_available())
 
-        for k in ret['outputs_coarse']:
-            all_ret['outputs_coarse'][k].append(ret['outputs_coarse'][k].cpu())
+        outputs = [ret[name][k] for name, k in dtypes]
+        outputs = torch.cat([v.reshape(v.shape[0], -1).float() for v in outputs], dim=1)
+        all_outputs[i:i+outputs.shape[0]].copy_(outputs, non_blocking=True)
 
-        if ret['outputs_fine'] is not None:
-            for k in ret['outputs_fine']:
-                all_ret['outputs_fine'][k].append(ret['outputs_fine'][k].cpu())
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
 
     rgb_strided = torch.ones(ray_sampler.H, ray_sampler.W, 3)[::render_stride, ::render_stride, :]
-    # merge chunk results and reshape
-    for k in all_ret['outputs_coarse']:
+    # split the buffer and reshape
+    for (name, k), output in zip(dtypes, all_outputs.split(widths, dim=1)):
         if k == 'random_sigma':
             continue
-        tmp = torch.cat(all_ret['outputs_coarse'][k], dim=0).reshape((rgb_strided.shape[0],
-                                                                      rgb_strided.shape[1], -1))
-        all_ret['outputs_coarse'][k] = tmp.squeeze()
+        tmp = output.to(dtypes[(name, k)]).reshape((rgb_strided.shape[0], rgb_strided.shape[1], -1))
+        all_ret[name][k] = tmp.squeeze().contiguous()
 
     all_ret['outputs_coarse']['rgb'][all_ret['outputs_coarse']['mask'] == 0] = 1.
-    if all_ret['outputs_fine'] is not None:
-        for k in all_ret['outputs_fine']:
-            if k == 'random_sigma':
-                continue
-            tmp = torch.cat(all_ret['outputs_fine'][k], dim=0).reshape((rgb_strided.shape[0],
-                                                                        rgb_strided.shape[1], -1))
-
-            all_ret['outputs_fine'][k] = tmp.squeeze()
 
     return all_ret
 
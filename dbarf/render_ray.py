@@ -71,6 +71,36 @@ def sample_pdf(bins, weights, N_samples, det=False):
     return samples
 
 
+def sample_around_depth(depth, z_vals, weights, N_samples, det=False):
+    '''
+    sample depths from a gaussian centered on a predicted depth, the spread of the coarse weights
+    around the predicted depth is used as its uncertainty
+    :param depth: predicted depth, tensor of shape [N_rays, 1]
+    :param z_vals: depths of the coarse samples, tensor of shape [N_rays, M]
+    :param weights: weights of the coarse samples, tensor of shape [N_rays, M]
+    :param N_samples: number of samples along each ray
+    :param det: if True, will perform deterministic sampling
+    :return: [N_rays, N_samples]
+    '''
+    near, far = z_vals[:, :1], z_vals[:, -1:]
+    depth = torch.clamp(depth, near, far)
+
+    # the gaussian is at least as wide as the spacing of the coarse samples
+    var = torch.sum(weights * (z_vals - depth) ** 2, dim=-1, keepdim=True) / \
+          torch.clamp(torch.sum(weights, dim=-1, keepdim=True), min=1e-5)
+    std = torch.clamp(torch.sqrt(var), min=1e-5) + (far - near) / z_vals.shape[1]
+
+    # Take uniform samples in (0, 1) and map them with the inverse cdf of the gaussian
+    if det:
+        u = torch.linspace(0., 1., N_samples + 2, device=z_vals.device)[1:-1]
+        u = u.unsqueeze(0).repeat(z_vals.shape[0], 1)       # [N_rays, N_samples]
+    else:
+        u = torch.rand(z_vals.shape[0], N_samples, device=z_vals.device).clamp(1e-5, 1. - 1e-5)
+
+    samples = depth + std * 2. ** 0.5 * torch.erfinv(2. * u - 1.)
+    return torch.clamp(samples, near, far)
+
+
 def sample_along_camera_ray(ray_o, ray_d, depth_range,
                             N_samples,
                             inv_uniform=False,
@@ -190,7 +220,8 @@ def render_rays(ray_batch,
                 det=False,
                 white_bkgd=False,
                 inv_depth_prior=None,
-                rel_poses=None):
+                rel_poses=None,
+                fine_inv_depth_prior=None):
     '''
     :param ray_batch: {'ray_o': [N_rays, 3] , 'ray_d': [N_rays, 3], 'view_dir': [N_rays, 2]}
     :param model:  {'net_coarse':  , 'net_fine': }
@@ -198,6 +229,7 @@ def render_rays(ray_batch,
     :param inv_uniform: if True, uniformly sample inverse depth for coarse model
     :param N_importance: additional samples along each ray produced by importance sampling (for fine model)
     :param det: if True, will deterministicly sample depths
+    :param fine_inv_depth_prior: [N_rays, 1], if given, the fine samples are drawn around this inverse depth
     :return: {'outputs_coarse': {}, 'outputs_fine': {}}
     '''
 
@@ -213,11 +245,12 @@ def render_rays(ray_batch,
                                           inv_depth_prior=inv_depth_prior)
     N_rays, N_samples = pts.shape[:2]
 
-    rgb_feat, ray_diff, mask = projector.compute(pts, ray_batch['camera'],
-                                                 ray_batch['src_rgbs'],
-                                                 ray_batch['src_cameras'],
-                                                 feat_maps=feat_maps[0],
-                                                 rel_poses=rel_poses)  # [N_rays, N_samples, N_views, x]
+    # the projections of the coarse samples are reused by the fine pass
+    geometry = projector.compute_geometry(pts, ray_batch['camera'],
+                                          ray_batch['src_rgbs'],
+                                          ray_batch['src_cameras'],
+                                          rel_poses=rel_poses)
+    rgb_feat, ray_diff, mask = projector.sample_features(geometry, feat_maps[0])  # [N_rays, N_samples, N_views, x]
     
     pixel_mask = mask[..., 0].sum(dim=2) > 1   # [N_rays, N_samples], should at least have 2 observations
     raw_coarse = model.net_coarse(rgb_feat, ray_diff, mask)   # [N_rays, N_samples, 4]
@@ -229,7 +262,12 @@ def render_rays(ray_batch,
         assert model.net_fine is not None
         # detach since we would like to decouple the coarse and fine networks
         weights = outputs_coarse['weights'].clone().detach()            # [N_rays, N_samples]
-        if inv_uniform:
+        if fine_inv_depth_prior is not None:
+            # the fine samples are concentrated around the predicted depth
+            z_samples = sample_around_depth(depth=1. / torch.clamp(fine_inv_depth_prior, min=1e-5),
+                                            z_vals=z_vals, weights=weights,
+                                            N_samples=N_importance, det=det)  # [N_rays, N_importance]
+        elif inv_uniform:
             inv_z_vals = 1. / z_vals
             inv_z_vals_mid = .5 * (inv_z_vals[:, 1:] + inv_z_vals[:, :-1])   # [N_rays, N_samples-1]
             weights = weights[:, 1:-1]      # [N_rays, N_samples-2]
@@ -247,18 +285,18 @@ def render_rays(ray_batch,
         z_vals = torch.cat((z_vals, z_samples), dim=-1)  # [N_rays, N_samples + N_importance]
 
         # samples are sorted with increasing depth
-        z_vals, _ = torch.sort(z_vals, dim=-1)
-        N_total_samples = N_samples + N_importance
-
-        viewdirs = ray_batch['ray_d'].unsqueeze(1).repeat(1, N_total_samples, 1)
-        ray_o = ray_batch['ray_o'].unsqueeze(1).repeat(1, N_total_samples, 1)
-        pts = z_vals.unsqueeze(2) * viewdirs + ray_o  # [N_rays, N_samples + N_importance, 3]
-
-        rgb_feat_sampled, ray_diff, mask = projector.compute(pts, ray_batch['camera'],
-                                                             ray_batch['src_rgbs'],
-                                                             ray_batch['src_cameras'],
-                                                             feat_maps=feat_maps[1],
-                                                             rel_poses=rel_poses)
+        z_vals, order = torch.sort(z_vals, dim=-1)
+
+        # only the importance samples are projected, the coarse samples are the
+        # same points as in the coarse pass and their geometry is merged in
+        pts = z_samples.unsqueeze(2) * ray_batch['ray_d'].unsqueeze(1) + \
+            ray_batch['ray_o'].unsqueeze(1)  # [N_rays, N_importance, 3]
+        new_geometry = projector.compute_geometry(pts, ray_batch['camera'],
+                                                  ray_batch['src_rgbs'],
+                                                  ray_batch['src_cameras'],
+                                                  rel_poses=rel_poses)
+        geometry = projector.merge_geometry(geometry, new_geometry, order)
+        rgb_feat_sampled, ray_diff, mask = projector.sample_features(geometry, feat_maps[1])
 
         pixel_mask = mask[..., 0].sum(dim=2) > 1  # [N_rays, N_samples]. should at least have 2 observations
         raw_fine = model.net_fine(rgb_feat_sampled, ray_diff, mask)
@@ -104,17 +104,20 @@ class RaySamplerSingleImage(object):
         return rays_o, rays_d
 
     def get_all(self):
-        ret = {'ray_o': self.rays_o.cuda(),
-               'ray_d': self.rays_d.cuda(),
-               'depth_range': self.depth_range.cuda(),
-               'camera': self.camera.cuda(),
-               'rgb': self.rgb.cuda() if self.rgb is not None else None,
-               'src_rgbs': self.src_rgbs.cuda() if self.src_rgbs is not None else None,
-               'src_cameras': self.src_cameras.cuda() if self.src_cameras is not None else None,
+        # Copies from pinned loader memory are asynchronous, the rays are computed
+        # here in pageable memory and copied synchronously.
+        to_device = lambda x: x.to(self.device, non_blocking=True) if x is not None else None
+        ret = {'ray_o': to_device(self.rays_o),
+               'ray_d': to_device(self.rays_d),
+               'depth_range': to_device(self.depth_range),
+               'camera': to_device(self.camera),
+               'rgb': to_device(self.rgb),
+               'src_rgbs': to_device(self.src_rgbs),
+               'src_cameras': to_device(self.src_cameras),
         }
         return ret
 
-    def sample_random_pixel(self, N_rand, sample_mode, center_ratio=0.8, area=[48, 64]):
+    def sample_random_pixel(self, N_rand, sample_mode, center_ratio=0.8, area=[48, 64], tile_size=4):
         if sample_mode == 'center':
             border_H = int(self.H * (1 - center_ratio) / 2.)
             border_W = int(self.W * (1 - center_ratio) / 2.)
@@ -146,18 +149,38 @@ class RaySamplerSingleImage(object):
             select_inds = np.array([i for i in range(u.shape[0])])
             select_inds = v[select_inds] + self.W * u[select_inds]
 
+        elif sample_mode == 'tile':
+            # Random tile_size x tile_size tiles, the rays of a tile project to neighboring
+            # pixels of the source views, so the feature lookups of a batch are coherent.
+            # Distinct tiles of a non-overlapping grid, so no ray is drawn twice. The grid
+            # is shifted by a random phase, the pixels of the remainder are sampled too.
+            tile_size = max(min(tile_size, self.H, self.W), 1)
+            grid_H, grid_W = self.H // tile_size, self.W // tile_size
+            num_tiles = int(np.ceil(N_rand / tile_size ** 2))
+            tile_inds = rng.choice(grid_H * grid_W, size=(num_tiles,), replace=False)
+            tile_v = (tile_inds // grid_W) * tile_size + rng.randint(self.H % tile_size + 1)
+            tile_u = (tile_inds % grid_W) * tile_size + rng.randint(self.W % tile_size + 1)
+
+            offsets = np.arange(tile_size)
+            v = tile_v[:, None, None] + offsets[None, :, None]
+            u = tile_u[:, None, None] + offsets[None, None, :]
+            select_inds = (u + self.W * v).reshape(-1)[:N_rand]
+
         else:
             raise Exception("unknown sample mode!")
 
         return select_inds
 
-    def random_sample(self, N_rand, sample_mode, center_ratio=0.8, area=[48, 64]):
+    def random_sample(self, N_rand, sample_mode, center_ratio=0.8, area=[48, 64], tile_size=4,
+                      src_rgbs=None):
         '''
         :param N_rand: number of rays to be casted
+        :param tile_size: size of the square pixel tiles when sample_mode is 'tile'
+        :param src_rgbs: the source images already on the device, they are not uploaded again
         :return:
         '''
 
-        select_inds = self.sample_random_pixel(N_rand, sample_mode, center_ratio, area)
+        select_inds = self.sample_random_pixel(N_rand, sample_mode, center_ratio, area, tile_size)
 
         rays_o = self.rays_o[select_inds]
         rays_d = self.rays_d[select_inds]
@@ -167,13 +190,17 @@ class RaySamplerSingleImage(object):
         else:
             rgb = None
 
-        ret = {'ray_o': rays_o.cuda(),
-               'ray_d': rays_d.cuda(),
-               'camera': self.camera.cuda(),
-               'depth_range': self.depth_range.cuda(),
-               'rgb': rgb.cuda() if rgb is not None else None,
-               'src_rgbs': self.src_rgbs.cuda() if self.src_rgbs is not None else None,
-               'src_cameras': self.src_cameras.cuda() if self.src_cameras is not None else None,
+        # The source images are the largest part of the batch, they are copied
+        # asynchronously from pinned loader memory. The gathered rays and colors
+        # are new pageable tensors, non_blocking has no effect on their copies.
+        to_device = lambda x: x.to(self.device, non_blocking=True) if x is not None else None
+        ret = {'ray_o': to_device(rays_o),
+               'ray_d': to_device(rays_d),
+               'camera': to_device(self.camera),
+               'depth_range': to_device(self.depth_range),
+               'rgb': to_device(rgb),
+               'src_rgbs': src_rgbs if src_rgbs is not None else to_device(self.src_rgbs),
+               'src_cameras': to_device(self.src_cameras),
                'selected_inds': select_inds
         }
         return ret
@@ -0,0 +1,18 @@
+import torch
+
+
+def maybe_compile(fn=None, **kwargs):
+    # torch.compile is only available since PyTorch 2.0, fall back to eager mode.
+    if fn is None:
+        return lambda fn: maybe_compile(fn, **kwargs)
+    if not hasattr(torch, "compile"):
+        return fn
+    return torch.compile(fn, **kwargs)
+
+
+def mark_dynamic(tensor, *dims):
+    # Compile the given dimensions of `tensor` for any size, the others stay specialised.
+    if hasattr(torch, "compile"):
+        import torch._dynamo
+        for dim in dims:
+            torch._dynamo.mark_dynamic(tensor, dim)
@@ -1,30 +1,66 @@
 import os
 
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _find_root(parents, idx):
+        root = idx
+        while parents[root] != root:
+            root = parents[root]
+        while parents[idx] != root:
+            parent = parents[idx]
+            parents[idx] = root
+            idx = parent
+        return root
+
+    @numba.njit(cache=True)
+    def _union_all(parents, component_size, pairs, max_num_per_set):
+        # Same rules as UnionFind.union(), over sequential indices. A
+        # non-positive `max_num_per_set` means the set size is unbounded.
+        for k in range(pairs.shape[0]):
+            x = _find_root(parents, pairs[k, 0])
+            y = _find_root(parents, pairs[k, 1])
+            if x == y:
+                continue
+            if max_num_per_set > 0 and \
+                component_size[x] + component_size[y] > max_num_per_set:
+                continue
+            if component_size[x] < component_size[y]:
+                x, y = y, x
+            component_size[x] += component_size[y]
+            parents[y] = x
+else:
+    _union_all = None
+
 
 class UnionFind():
     def __init__(self, size: int, max_num_per_set=None) -> None:
         # The maximum size for each component.
         self.max_num_per_set = max_num_per_set
 
-        # Tracking the rank for each node.
-        self.ranks = [0 for i in range(size)]
-        
         # Tracking the root node for each node.
-        self.parents = [i for i in range(size)]
+        self.parents = np.arange(size, dtype=np.int32)
         
-        self.nodes = [i for i in range(size)]
+        self.nodes = np.arange(size, dtype=np.int32)
         
         # For nodes which indices are not in sequential, we map the id of each
         # node into a sequential index.
         self.node_mapper = {i:i for i in range(size)}
 
-        # Tracking of the size of each component, such that we are able to
-        # truncate too large components.
-        self.component_size = {i:1 for i in range(size)}
+        # Tracking of the size of each component (indexed by its root), such
+        # that we are able to truncate too large components.
+        self.component_size = np.ones(size, dtype=np.int32)
 
     def init_with_nodes(self, nodes: list):
         self.node_mapper.clear()
-        self.nodes = nodes
+        self.nodes = np.asarray(nodes)
         for i, node_idx in enumerate(nodes):
             self.node_mapper[node_idx] = i
     
@@ -42,22 +78,39 @@ class UnionFind():
             (self.component_size[x] + self.component_size[y] > self.max_num_per_set):
             return
         
-        if self.ranks[x] < self.ranks[y]:
-            self.component_size[y] += self.component_size[x]
-            self.parents[x] = y
-        else:
-            self.component_size[x] += self.component_size[y]
-            self.parents[y] = x
-            if self.ranks[x] == self.ranks[y]:
-                self.ranks[x] += 1
+        # Union by size: the smaller component is attached to the larger one.
+        if self.component_size[x] < self.component_size[y]:
+            x, y = y, x
+        self.component_size[x] += self.component_size[y]
+        self.parents[y] = x
+
+    def union_all(self, pairs):
+        """Union each (x, y) pair of node ids, in order."""
+        if _union_all is None:
+            for x, y in pairs:
+                self.union(x, y)
+            return
+
+        pairs = np.fromiter(
+            (self.node_mapper[x] for pair in pairs for x in pair), dtype=np.int64
+        ).reshape(-1, 2)
+        max_num_per_set = 0 if self.max_num_per_set is None else self.max_num_per_set
+        # The whole loop runs in compiled code on the storage arrays.
+        _union_all(self.parents, self.component_size, pairs, max_num_per_set)
 
     def find_root(self, x):
         idx = self.node_mapper[x]
-        if self.parents[idx] == idx:
-            return idx
-        else:
-            self.parents[idx] = self.find_root(self.nodes[self.parents[idx]])
-            return self.parents[idx]
+        # Two passes without recursion: find the root, then link every node on
+        # the path directly to it. `parents` already holds sequential indices.
+        parents = self.parents
+        root = idx
+        while parents[root] != root:
+            root = parents[root]
+        while parents[idx] != root:
+            parent = parents[idx]
+            parents[idx] = root
+            idx = parent
+        return int(root)
 
     def get_connected_components():
         return None
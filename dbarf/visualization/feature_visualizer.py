@@ -25,59 +25,46 @@ def feature_map_to_heatmap(feat_maps):
     '''
     feat_maps: [C, H, W]
     '''
-    # Define a transform to convert the image to tensor
-    transform = transforms.ToTensor()
-
-    num_channels = feat_maps.shape[0]
-    heat_maps = []
-
-    for i in range(num_channels):
-        feat_map = np.asarray(feat_maps)[i]
-        # print('feat_map.shape:', feat_map.shape) # [H, W]
-        # print('feat_map type:', feat_map.dtype) # float32 
-        
-        feat_map = np.asarray(feat_map * 255, dtype=np.uint8) # [0,255]
-        # print('feat_map type:', feat_map.dtype) # uint8
+    feat_maps = np.asarray(feat_maps)
+    [c, h, w] = feat_maps.shape
 
-        # https://www.sohu.com/a/343215045_120197868
-        feat_map = cv2.applyColorMap(feat_map, cv2.COLORMAP_RAINBOW)
-        feat_map = transform(feat_map)
+    # Color all channels in one call on a [C*H, W] image.
+    feat_maps = np.asarray(feat_maps * 255, dtype=np.uint8).reshape(c * h, w) # [0,255]
 
-        heat_maps.append(feat_map)
-    
-    heat_maps = torch.stack(heat_maps, dim=0) # [C, 3, 25, 25]
+    # https://www.sohu.com/a/343215045_120197868
+    heat_maps = cv2.applyColorMap(feat_maps, cv2.COLORMAP_RAINBOW).reshape(c, h, w, 3)
+    heat_maps = torch.from_numpy(heat_maps).permute(0, 3, 1, 2).float().div_(255) # [C, 3, 25, 25]
     return heat_maps
 
 
 def feature_maps_to_heatmap(feat_maps):
     '''
     Args:
-        feat_maps: [C, H, W]
+        feat_maps: [C, H, W] or a batch of views [V, C, H, W]
     Return:
-        A composed heat map with shape [H, W]
+        A composed heat map with shape [3, H, W] (or [V, 3, H, W])
     '''
-    # Define a transform to convert the image to tensor
-    transform = transforms.ToTensor()
-
     # print(f'[DEBUG] feat_maps shape: {feat_maps.shape}')
-    [c, h, w] = feat_maps.shape
-
-    heatmap = torch.zeros((h, w))
-    weight = []
     feat_maps = np.asarray(feat_maps)
+    batched = feat_maps.ndim == 4
+    if not batched:
+        feat_maps = feat_maps[None]
+    [v, c, h, w] = feat_maps.shape
     
-    for i in range(c):
-        feat_map = feat_maps[i]
-        weight = np.mean(feat_map)
-        heatmap[:, :] += weight * feat_map
+    # Each channel is weighted by its mean value.
+    weights = feat_maps.mean(axis=(2, 3)) # [V, C]
+    heatmap = np.einsum('vc,vchw->vhw', weights, feat_maps) # [V, H, W]
     
-    heatmap = (heatmap - heatmap.min()) / heatmap.max() # normalization
+    # normalization
+    heatmap_min = heatmap.min(axis=(1, 2), keepdims=True)
+    heatmap_max = heatmap.max(axis=(1, 2), keepdims=True)
+    heatmap = (heatmap - heatmap_min) / (heatmap_max - heatmap_min + 1e-8)
 
-    heatmap = np.asarray(heatmap * 255, dtype=np.uint8)
-    heatmap = cv2.applyColorMap(heatmap, cv2.COLORMAP_RAINBOW)
-    heatmap = transform(heatmap)
+    heatmap = np.asarray(heatmap * 255, dtype=np.uint8).reshape(v * h, w)
+    heatmap = cv2.applyColorMap(heatmap, cv2.COLORMAP_RAINBOW).reshape(v, h, w, 3)
+    heatmap = torch.from_numpy(heatmap).permute(0, 3, 1, 2).float().div_(255) # [V, 3, H, W]
 
-    return heatmap
+    return heatmap if batched else heatmap[0]
 
 
 def plot_sampled_feature_map(writer, global_step, target_rgb_feat, rgb_feats, N_rand, prefix='train/'):
@@ -85,10 +72,17 @@ def plot_sampled_feature_map(writer, global_step, target_rgb_feat, rgb_feats, N_
     target_rgb_feat = target_rgb_feat.detach().cpu()
     rgb_feats = rgb_feats.detach().cpu()
 
-    target_rgb_feat = target_rgb_feat.permute(3, 2, 0, 1).reshape(35, -1, width, width)
-    rgb_feats = rgb_feats.permute(3, 2, 0, 1).reshape(35, -1, width, width)
+    # The residual is taken in the input layout, where both operands are
+    # contiguous. The permute + reshape below only produces a view whenever
+    # the sampled rays factor into [width, width].
     res_rgb_feats = torch.abs(target_rgb_feat - rgb_feats)
-    target_rgb_feat = target_rgb_feat[:, 0, ...]
+
+    def to_channel_first(feats):
+        return feats.permute(3, 2, 0, 1).reshape(35, -1, width, width)
+
+    target_rgb_feat = to_channel_first(target_rgb_feat)[:, 0, ...]
+    rgb_feats = to_channel_first(rgb_feats)
+    res_rgb_feats = to_channel_first(res_rgb_feats)
 
     # target_feat_map = feature_map_to_heatmap(target_rgb_feat[3:])
     # feat_map_grid = torchvision.utils.make_grid(target_feat_map, normalize=True, scale_each=True, nrow=8)
@@ -97,32 +91,23 @@ def plot_sampled_feature_map(writer, global_step, target_rgb_feat, rgb_feats, N_
     writer.add_image(prefix + f'target_feat_map', target_feat_map, global_step) # feature map
     writer.add_image(prefix + f'target_rgb_map', target_rgb_feat[0:3], global_step)
 
-    num_nearby_views = rgb_feats.shape[1]
-    nearby_feat_maps, nearby_rgb_maps = [], []
-    nearby_res_feat_maps, nearby_res_rgb_maps = [], []
-    for i in range(num_nearby_views):
-        rgb_feat_map = rgb_feats[:, i, ...]
-        feat_map = feature_maps_to_heatmap(rgb_feat_map[3:])
-        nearby_feat_maps.append(feat_map)
-        nearby_rgb_maps.append(rgb_feat_map[0:3])
+    # All nearby views are processed at once: [V, C, H, W].
+    rgb_feats = rgb_feats.transpose(0, 1)
+    res_rgb_feats = res_rgb_feats.transpose(0, 1)
 
-        res_rgb_feat_map = res_rgb_feats[:, i, ...]
-        res_feat_map = feature_maps_to_heatmap(res_rgb_feat_map[3:])
-        nearby_res_feat_maps.append(res_feat_map)
-        nearby_res_rgb_maps.append(res_rgb_feat_map[0:3])
+    nearby_feat_maps = feature_maps_to_heatmap(rgb_feats[:, 3:])
+    nearby_rgb_maps = rgb_feats[:, 0:3] # [n_views, 3, h, w]
+    nearby_res_feat_maps = feature_maps_to_heatmap(res_rgb_feats[:, 3:])
+    nearby_res_rgb_maps = res_rgb_feats[:, 0:3] # [n_views, 3, h, w]
 
-    nearby_feat_maps = torch.stack(nearby_feat_maps, dim=0)
     nearby_feat_grid = torchvision.utils.make_grid(nearby_feat_maps, normalize=True, scale_each=True, nrow=5)
     writer.add_image(prefix + f'nearby_feat_maps', nearby_feat_grid, global_step)
 
-    nearby_rgb_maps = torch.stack(nearby_rgb_maps, dim=0) # [n_views, 3, h, w]
     nearby_rgb_grid = torchvision.utils.make_grid(nearby_rgb_maps, normalize=True, scale_each=True, nrow=5)
     writer.add_image(prefix + f'nearby_rgb_maps', nearby_rgb_grid, global_step)
 
-    nearby_res_feat_maps = torch.stack(nearby_res_feat_maps, dim=0)
     nearby_res_feat_grid = torchvision.utils.make_grid(nearby_res_feat_maps, normalize=True, scale_each=True, nrow=5)
     writer.add_image(prefix + f'nearby_res_feat_maps', nearby_res_feat_grid, global_step)
 
-    nearby_res_rgb_maps = torch.stack(nearby_res_rgb_maps, dim=0) # [n_views, 3, h, w]
     nearby_res_rgb_grid = torchvision.utils.make_grid(nearby_res_rgb_maps, normalize=True, scale_each=True, nrow=5)
     writer.add_image(prefix + f'nearby_res_rgb_maps', nearby_res_rgb_grid, global_step)
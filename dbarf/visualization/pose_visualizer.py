@@ -1,22 +1,29 @@
+import numpy as np
 import torch
 
 from dbarf.pose_util import to_hom
 
 
+# Camera frustum template, shared by all calls of get_camera_mesh().
+_CAMERA_VERTICES = torch.tensor([[-0.5, -0.5, 1],
+                                 [ 0.5, -0.5, 1],
+                                 [ 0.5,  0.5, 1],
+                                 [-0.5,  0.5, 1],
+                                 [   0,    0, 0]])
+
+_CAMERA_FACES = torch.tensor([[0, 1, 2],
+                              [0, 2, 3],
+                              [0, 1, 4],
+                              [1, 2, 4],
+                              [2, 3, 4],
+                              [3, 0, 4]])
+
+
 def get_camera_mesh(pose, depth=1):
-    vertices = torch.tensor([[-0.5, -0.5, 1],
-                             [ 0.5, -0.5, 1],
-                             [ 0.5,  0.5, 1],
-                             [-0.5,  0.5, 1],
-                             [   0,    0, 0]]) * depth
-    
-    faces = torch.tensor([[0, 1, 2],
-                          [0, 2, 3],
-                          [0, 1, 4],
-                          [1, 2, 4],
-                          [2, 3, 4],
-                          [3, 0, 4]])
+    vertices = _CAMERA_VERTICES * depth
+    faces = _CAMERA_FACES
     
+    # All cameras in `pose` ([N,3,4]) are transformed in a single matmul.
     # vertices = camera.cam2world(vertices[None], pose)
     vertices = to_hom(vertices[None]) @ pose.transpose(-1, -2)
 
@@ -25,12 +32,21 @@ def get_camera_mesh(pose, depth=1):
     return vertices, faces, wire_frame
 
 
+def _merge_lines(points):
+    """
+    [N,L,3] line vertices to per-coordinate lists, each line followed by a None
+    separator. The separators stay None (not NaN) so that the plot data
+    remains valid JSON for visdom.
+    """
+    N, L = points.shape[:2]
+    merged = np.full((3, N, L + 1), None, dtype=object)
+    merged[:, :, :L] = points.detach().cpu().double().numpy().transpose(2, 0, 1)
+    
+    return [merged[k].ravel().tolist() for k in range(3)]
+
+
 def merge_wire_frames(wire_frame):
-    wire_frame_merged = [[], [], []]
-    for w in wire_frame:
-        wire_frame_merged[0] += [float(n) for n in w[:, 0]] + [None]
-        wire_frame_merged[1] += [float(n) for n in w[:, 1]] + [None]
-        wire_frame_merged[2] += [float(n) for n in w[:, 2]] + [None]
+    wire_frame_merged = _merge_lines(wire_frame)
     
     return wire_frame_merged
 
@@ -44,12 +60,8 @@ def merge_meshes(vertices, faces):
 
 
 def merge_centers(centers):
-    center_merged = [[], [], []]
-    
-    for c1, c2 in zip(*centers):
-        center_merged[0] += [float(c1[0]), float(c2[0]), None]
-        center_merged[1] += [float(c1[1]), float(c2[1]), None]
-        center_merged[2] += [float(c1[2]), float(c2[2]), None]
+    num_centers = min(len(c) for c in centers)
+    center_merged = _merge_lines(torch.stack([c[:num_centers] for c in centers], dim=1))
     
     return center_merged
 
@@ -61,8 +73,14 @@ def visualize_cameras(vis, step, poses=[], cam_depth=0.5, colors=["blue", "magen
     
     # set up plots
     centers = []
+    poses = [pose.detach() for pose in poses]
+    if len(poses) > 1 and all(pose.shape == poses[0].shape for pose in poses):
+        # One device-to-host copy (and sync) for all pose sets.
+        poses = torch.stack(poses).cpu().unbind(0)
+    else:
+        poses = [pose.cpu() for pose in poses]
+
     for pose, color in zip(poses, colors):
-        pose = pose.detach().cpu()
         vertices, faces, wire_frame = get_camera_mesh(pose, depth=cam_depth)
         center = vertices[:, -1]
         centers.append(center)
@@ -70,9 +88,9 @@ def visualize_cameras(vis, step, poses=[], cam_depth=0.5, colors=["blue", "magen
         # camera centers
         data.append(dict(
             type="scatter3d",
-            x=[float(n) for n in center[:, 0]],
-            y=[float(n) for n in center[:, 1]],
-            z=[float(n) for n in center[:, 2]],
+            x=center[:, 0].tolist(),
+            y=center[:, 1].tolist(),
+            z=center[:, 2].tolist(),
             mode="markers",
             marker=dict(color=color, size=3),
         ))
@@ -82,12 +100,12 @@ def visualize_cameras(vis, step, poses=[], cam_depth=0.5, colors=["blue", "magen
         
         data.append(dict(
             type="mesh3d",
-            x=[float(n) for n in vertices_merged[:, 0]],
-            y=[float(n) for n in vertices_merged[:, 1]],
-            z=[float(n) for n in vertices_merged[:, 2]],
-            i=[int(n) for n in faces_merged[:, 0]],
-            j=[int(n) for n in faces_merged[:, 1]],
-            k=[int(n) for n in faces_merged[:, 2]],
+            x=vertices_merged[:, 0].tolist(),
+            y=vertices_merged[:, 1].tolist(),
+            z=vertices_merged[:, 2].tolist(),
+            i=faces_merged[:, 0].tolist(),
+            j=faces_merged[:, 1].tolist(),
+            k=faces_merged[:, 2].tolist(),
             flatshading=True,
             color=color,
             opacity=0.05,
@@ -1,7 +1,7 @@
 
 import sys
 import json
-import queue
+import heapq
 import networkx
 sys.path.append('../')
 
@@ -12,7 +12,7 @@ from dbarf.config import config_parser
 from dbarf.model.dbarf import DBARFModel
 from utils import *
 from dbarf.data_loaders import dataset_dict
-from dbarf.pose_util import Pose
+from dbarf.pose_util import Pose, eye4
 from dbarf.geometry.align_poses import align_ate_c2b_use_a2b
 from dbarf.pose_util import rotation_distance
 from eval_dbarf import compose_state_dicts
@@ -22,14 +22,15 @@ from eval_dbarf import compose_state_dicts
 
 @torch.no_grad()
 def get_predicted_training_poses(pred_poses):
-    target_pose = torch.eye(4, device=pred_poses.device, dtype=torch.float).repeat(1, 1, 1)
+    target_pose = eye4(pred_poses.device, torch.float)[None]
 
     # World->camera poses.
     pred_poses = Pose.from_vec(pred_poses) # [n_views, 4, 4]
-    pred_poses = torch.cat([target_pose, pred_poses], dim=0)
 
-    # Convert camera poses to camera->world.
-    pred_poses = pred_poses.inverse()
+    # Convert camera poses to camera->world. The rigid transforms are inverted
+    # in closed form, the identity target pose is its own inverse.
+    pred_poses = torch.cat([Pose().invert(pred_poses[:, :3]), pred_poses[:, 3:]], dim=1)
+    pred_poses = torch.cat([target_pose, pred_poses], dim=0)
 
     return pred_poses
 
@@ -59,6 +60,19 @@ def evaluate_camera_alignment(aligned_pred_poses, poses_gt):
     return R_error, t_error
 
 
+def write_vertices(file, image_ids, poses):
+    """
+    Write [N,4,4] (or [N,3,4]) poses as g2o SE3 vertices in a single call.
+    """
+    poses = np.asarray(poses)
+    quats = Rotation.from_matrix(poses[:, :3, :3]).as_quat() # [qx, qy, qz, qw]
+    tvecs = poses[:, :3, 3]
+    file.write(''.join(
+        f'VERTEX_SE3:QUAT {image_id} {tvec[0]} {tvec[1]} {tvec[2]} ' +
+        f'{qvec[0]} {qvec[1]} {qvec[2]} {qvec[3]}\n'
+        for image_id, tvec, qvec in zip(image_ids, tvecs, quats)))
+
+
 def normalize(v):
     norm = np.linalg.norm(v)
     if norm == 0: 
@@ -71,7 +85,7 @@ def compute_abs_poses_from_mst(model, dataset, mst, num_poses, view_graph_file):
     ref_image_id = 0
     visited = [False for i in range(num_poses)]
     visited[ref_image_id] = 0
-    qu = queue.PriorityQueue()
+    qu = []
 
     abs_poses = {ref_image_id: torch.eye(4)}
 
@@ -93,21 +107,30 @@ def compute_abs_poses_from_mst(model, dataset, mst, num_poses, view_graph_file):
         cur_pose = abs_poses[i] @ rel_pose.inverse()
         abs_poses[j] = cur_pose
 
+    # Adjacency of the tree in CSR form, so that neighbors and weights are
+    # array slices instead of NetworkX dict lookups.
+    nodes = list(mst.nodes())
+    node_to_row = {node: k for k, node in enumerate(nodes)}
+    adjacency = networkx.to_scipy_sparse_array(mst, nodelist=nodes, weight='weight', format='csr')
+
     def add_edges_to_heap(image_id):
-        neighbors = list(mst.neighbors(image_id))
-        for j in neighbors:
+        row = node_to_row[image_id]
+        start, end = adjacency.indptr[row], adjacency.indptr[row + 1]
+        neighbors = adjacency.indices[start:end].tolist()
+        weights = adjacency.data[start:end].tolist()
+        for k, weight in zip(neighbors, weights):
+            j = nodes[k]
             if visited[j]:
                 continue
 
-            priority_level = int(1e5 / mst[image_id][j]['weight'])
-            qu.put([priority_level, (image_id, j)])
+            priority_level = int(1e5 / weight)
+            heapq.heappush(qu, (priority_level, image_id, j))
 
     # Computing absolute camera poses along the maximum spanning tree.
     add_edges_to_heap(ref_image_id)
 
-    while not qu.empty():
-        edge = qu.get()
-        i, j = edge[1][0], edge[1][1]
+    while qu:
+        _, i, j = heapq.heappop(qu)
         if visited[j] == True: continue
 
         compute_pose(i, j)
@@ -116,15 +139,9 @@ def compute_abs_poses_from_mst(model, dataset, mst, num_poses, view_graph_file):
         add_edges_to_heap(j)
 
     # Output camera poses to view graph.
-    for image_id in abs_poses.keys():
-        pose = abs_poses[image_id].squeeze(0)
-        # print(f'pose shape: {pose.shape}')
-        rot_mat = pose[:3, :3]
-        tvec = pose[:3, 3]
-        # print(f'rot_mat shape: {rot_mat.shape}')
-        qvec = Rotation.from_matrix(rot_mat).as_quat() # [qx, qy, qz, qw]
-        view_graph_file.write(f'VERTEX_SE3:QUAT {image_id} {tvec[0]} {tvec[1]} {tvec[2]} ' +
-                              f'{qvec[0]} {qvec[1]} {qvec[2]} {qvec[3]}\n')
+    image_ids = list(abs_poses.keys())
+    poses = torch.stack([abs_poses[image_id].reshape(4, 4) for image_id in image_ids])
+    write_vertices(view_graph_file, image_ids, poses)
 
 
 def compute_rel_poses(args):
@@ -153,6 +170,7 @@ def compute_rel_poses(args):
     view_graph_file = open(view_graph_path, 'w')
     R_errors = []
     t_errors = []
+    gt_image_ids, gt_poses = [], []
 
     # assert len(test_dataset.train_view_graphs) <= 1, "invalid view graphs number for evaluation"
     # view_graph = test_dataset.train_view_graphs[0]["graph"]
@@ -161,24 +179,26 @@ def compute_rel_poses(args):
     # compute_abs_poses_from_mst(model, test_dataset, mst, num_poses, view_graph_file)
     view_graph_file.close()
 
-    for i in range(num_poses):
+    # Load samples in background workers into pinned memory, so that loading
+    # and host-to-device copies overlap with pose correction of the previous one.
+    data_loader = torch.utils.data.DataLoader(
+        range(num_poses), batch_size=None, num_workers=2, pin_memory=True,
+        collate_fn=test_dataset.get_data_one_batch)
+
+    for data in data_loader:
         with torch.no_grad():
             # model.switch_to_eval()
             
-            data = test_dataset.get_data_one_batch(i)
             src = data['idx']
 
             gt_camera_pose = data['camera'][..., -16:].reshape(4, 4)
-            gt_rot_mat = gt_camera_pose[:3, :3]
-            gt_tvec = gt_camera_pose[:3, 3].numpy()
-            gt_qvec = Rotation.from_matrix(gt_rot_mat).as_quat() # [qx, qy, qz, qw]
-            gt_view_graph_file.write(f'VERTEX_SE3:QUAT {src} {gt_tvec[0]} {gt_tvec[1]} {gt_tvec[2]} ' +
-                                     f'{gt_qvec[0]} {gt_qvec[1]} {gt_qvec[2]} {gt_qvec[3]}\n')
+            gt_image_ids.append(src)
+            gt_poses.append(gt_camera_pose)
 
             _, pred_rel_poses, __, ___ = model.correct_poses(
                 fmaps=None,
-                target_image=data['rgb'].unsqueeze(0).cuda(),
-                ref_imgs=data['src_rgbs'].unsqueeze(0).cuda(),
+                target_image=data['rgb'].unsqueeze(0).cuda(non_blocking=True),
+                ref_imgs=data['src_rgbs'].unsqueeze(0).cuda(non_blocking=True),
                 target_camera=data['camera'].unsqueeze(0),
                 ref_cameras=data['src_cameras'].unsqueeze(0),
                 min_depth=data['depth_range'][0],
@@ -192,6 +212,9 @@ def compute_rel_poses(args):
             R_errors.append(pose_error[0])
             t_errors.append(pose_error[1])
 
+    write_vertices(gt_view_graph_file, gt_image_ids, torch.stack(gt_poses))
+    gt_view_graph_file.close()
+
     R_errors = np.concatenate(R_errors, axis=0)
     t_errors = np.concatenate(t_errors, axis=0)
 
@@ -16,6 +16,7 @@
 import sys
 sys.path.append('../')
 
+import json
 import imageio
 import lpips
 
@@ -29,6 +30,7 @@ from dbarf.model.ibrnet import IBRNetModel
 from utils import *
 from dbarf.projection import Projector
 from dbarf.data_loaders import dataset_dict
+from dbarf.data_loaders.data_utils import CUDAPrefetcher
 from dbarf.loss.ssim_torch import ssim as ssim_torch
 
 # os.environ["CUDA_VISIBLE_DEVICES"]="0"
@@ -45,10 +47,12 @@ def img2mse(x, y, mask=None):
     :return: mse score
     '''
 
+    sq_diff = (x - y).square()
     if mask is None:
-        return torch.mean((x - y) * (x - y))
+        return torch.mean(sq_diff)
     else:
-        return torch.sum((x - y) * (x - y) * mask.unsqueeze(-1)) / (torch.sum(mask) * x.shape[-1] + TINY_NUMBER)
+        # Reduce over channels first so the mask is applied without broadcasting.
+        return torch.sum(sq_diff.sum(dim=-1) * mask) / (torch.sum(mask) * x.shape[-1] + TINY_NUMBER)
 
 
 def img2psnr(x, y, mask=None):
@@ -60,12 +64,23 @@ def img2ssim(gt_image, pred_image):
     Args:
         gt_image: [B, 3, H, W]
         pred_image: [B, 3, H, W]
+    Return:
+        ssim scores, [B]
     """
-    return ssim_torch(gt_image, pred_image).item()
+    return ssim_torch(gt_image, pred_image, size_average=False)
 
 
 def img2lpips(lpips_loss, gt_image, pred_image):
-    return lpips_loss(gt_image * 2 - 1, pred_image * 2 - 1).item()
+    """
+    Args:
+        gt_image: [B, 3, H, W]
+        pred_image: [B, 3, H, W]
+    Return:
+        lpips scores, [B]
+    """
+    # Inputs follow the precision of the LPIPS weights.
+    dtype = next(lpips_loss.parameters()).dtype
+    return lpips_loss(gt_image.to(dtype) * 2 - 1, pred_image.to(dtype) * 2 - 1).flatten()
 
 
 def compose_state_dicts(model) -> dict:
@@ -89,6 +104,16 @@ if __name__ == '__main__':
     state_dicts = compose_state_dicts(model=model)
     ckpt_manager = CheckPointManager()
     start_step = ckpt_manager.load(config=args, models=state_dicts)
+    if args.eval_fp16:
+        # Weights stay in FP32, autocast picks the FP16 kernels.
+        model.feature_net = model.feature_net.to(memory_format=torch.channels_last)
+    if args.eval_compile and hasattr(torch, 'compile'):
+        # Image size, chunk size and sample counts are fixed for a scene, so the
+        # graphs are captured once (plus once for a shorter last chunk).
+        model.feature_net = torch.compile(model.feature_net, mode='reduce-overhead')
+        model.net_coarse = torch.compile(model.net_coarse, mode='reduce-overhead')
+        if model.net_fine is not None:
+            model.net_fine = torch.compile(model.net_fine, mode='reduce-overhead')
 
     eval_dataset_name = args.eval_dataset
     extra_out_dir = '{}/{}'.format(args.rootdir, args.expname)
@@ -104,38 +129,39 @@ if __name__ == '__main__':
 
     test_dataset = dataset_dict[args.eval_dataset](args, 'test', scenes=args.eval_scenes)
     save_prefix = scene_name
-    test_loader = DataLoader(test_dataset, batch_size=1)
+    test_loader = DataLoader(test_dataset, batch_size=1, num_workers=args.workers,
+                             pin_memory=True, persistent_workers=args.workers > 0)
     total_num = len(test_loader)
-    results_dict = {scene_name: {}}
+    # Per-frame results are streamed as JSON lines, the scene means come last.
+    results_file = open("{}/psnr_{}_{}.jsonl".format(extra_out_dir, save_prefix, start_step), "w")
     sum_coarse_psnr = 0
     sum_fine_psnr = 0
-    running_mean_coarse_psnr = 0
-    running_mean_fine_psnr = 0
     sum_coarse_lpips = 0
     sum_fine_lpips = 0
-    running_mean_coarse_lpips = 0
-    running_mean_fine_lpips = 0
     sum_coarse_ssim = 0
     sum_fine_ssim = 0
-    running_mean_coarse_ssim = 0
-    running_mean_fine_ssim = 0
 
-    lpips_loss = lpips.LPIPS(net="alex").cuda()
+    lpips_loss = lpips.LPIPS(net="alex").cuda().eval().requires_grad_(False)
+    if args.eval_fp16:
+        lpips_loss = lpips_loss.half()
+    image_writer = AsyncImageWriter()
 
-    for i, data in enumerate(test_loader):
+    model.switch_to_eval()
+    # Source views of the next sample are uploaded while the current one renders.
+    for i, data in enumerate(CUDAPrefetcher(test_loader, device='cuda:0', keys=('src_rgbs',))):
         rgb_path = data['rgb_path'][0]
         file_id = os.path.basename(rgb_path).split('.')[0]
-        src_rgbs = data['src_rgbs'][0].cpu().numpy()
-
-        averaged_img = (np.mean(src_rgbs, axis=0) * 255.).astype(np.uint8)
-        imageio.imwrite(os.path.join(out_scene_dir, '{}_average.png'.format(file_id)),
-                        averaged_img)
+        # src_rgbs are already on the GPU, only the averaged uint8 image is copied back.
+        averaged_img = (data['src_rgbs'][0].mean(dim=0) * 255.).to(torch.uint8).cpu().numpy()
+        image_writer.write(os.path.join(out_scene_dir, '{}_average.png'.format(file_id)),
+                           averaged_img)
 
-        model.switch_to_eval()
-        with torch.no_grad():
+        with torch.inference_mode(), torch.autocast('cuda', dtype=torch.float16, enabled=args.eval_fp16):
             ray_sampler = RaySamplerSingleImage(data, device='cuda:0')
             ray_batch = ray_sampler.get_all()
-            feat_maps = model.feature_net(ray_batch['src_rgbs'].squeeze(0).permute(0, 3, 1, 2))
+            # [N, H, W, 3] -> [N, 3, H, W] already has channels_last strides, no copy here.
+            feat_maps = model.feature_net(ray_batch['src_rgbs'].squeeze(0).permute(0, 3, 1, 2)
+                                          .contiguous(memory_format=torch.channels_last))
 
             ret = render_single_image(ray_sampler=ray_sampler,
                                       ray_batch=ray_batch,
@@ -150,81 +176,89 @@ if __name__ == '__main__':
                                       feat_maps=feat_maps)
 
             gt_rgb = data['rgb'][0]
-            coarse_pred_rgb = ret['outputs_coarse']['rgb'].detach().cpu()
+            coarse_pred_rgb = ret['outputs_coarse']['rgb'].detach().cpu().float()
+            pred_rgbs = [coarse_pred_rgb]
+            if ret['outputs_fine'] is not None:
+                fine_pred_rgb = ret['outputs_fine']['rgb'].detach().cpu().float()
+                pred_rgbs.append(fine_pred_rgb)
+
+            # The metrics are computed in float32 whatever eval_fp16 is, SSIM's
+            # variances (E[x^2] - mu^2) do not survive half precision.
+            with torch.autocast('cuda', enabled=False):
+                # Images are uploaded once and stay on the GPU for all metrics, in
+                # [B, 3, H, W] channels-last layout (a free permute of [B, H, W, 3]).
+                # Coarse and fine predictions share one LPIPS and one SSIM forward.
+                # The predictions are stacked on the GPU, not staged in a host copy.
+                gt_rgb_gpu = gt_rgb.unsqueeze(0).to('cuda:0', non_blocking=True).permute(0, 3, 1, 2)
+                pred_rgbs_gpu = torch.stack([pred_rgb.to('cuda:0', non_blocking=True) for pred_rgb in pred_rgbs])
+                pred_rgbs_gpu = pred_rgbs_gpu.clamp_(0., 1.).permute(0, 3, 1, 2)
+                gt_rgbs_gpu = gt_rgb_gpu.expand_as(pred_rgbs_gpu)
+
+                lpips_scores = img2lpips(lpips_loss, gt_rgbs_gpu, pred_rgbs_gpu)
+                ssim_scores = img2ssim(gt_rgbs_gpu, pred_rgbs_gpu)
+                mse_scores = (pred_rgbs_gpu - gt_rgbs_gpu).square().mean(dim=(1, 2, 3))
+                # A single device-to-host sync for all metrics of this frame.
+                lpips_scores, ssim_scores, mse_scores = \
+                    torch.stack([lpips_scores.float(), ssim_scores.float(), mse_scores]).tolist()
+            psnr_scores = [mse2psnr(mse) for mse in mse_scores]
+
+            coarse_lpips, coarse_ssim, coarse_psnr = lpips_scores[0], ssim_scores[0], psnr_scores[0]
+
             coarse_err_map = torch.sum((coarse_pred_rgb - gt_rgb) ** 2, dim=-1).numpy()
             coarse_err_map_colored = (colorize_np(coarse_err_map, range=(0., 1.)) * 255).astype(np.uint8)
-            imageio.imwrite(os.path.join(out_scene_dir, '{}_err_map_coarse.png'.format(file_id)),
-                            coarse_err_map_colored)
-            coarse_pred_rgb_np = torch.from_numpy(np.clip(coarse_pred_rgb.numpy()[None, ...], a_min=0., a_max=1.)).cuda()
-            gt_rgb_np = torch.from_numpy(gt_rgb.numpy()[None, ...]).cuda()
-            # print(f'coarse_pred_rgb_np.shape: {coarse_pred_rgb_np.shape}')
-            # print(f'gt_rgb_np.shape: {gt_rgb_np.shape}')
-
-            coarse_lpips = img2lpips(lpips_loss, gt_rgb_np.permute(0, 3, 1, 2), coarse_pred_rgb_np.permute(0, 3, 1, 2))
-            coarse_ssim = img2ssim(gt_rgb_np.permute(0, 3, 1, 2), coarse_pred_rgb_np.permute(0, 3, 1, 2))
-            coarse_psnr = img2psnr(gt_rgb_np, coarse_pred_rgb_np)
+            image_writer.write(os.path.join(out_scene_dir, '{}_err_map_coarse.png'.format(file_id)),
+                               coarse_err_map_colored)
 
             # saving outputs ...
             coarse_pred_rgb = (255 * np.clip(coarse_pred_rgb.numpy(), a_min=0, a_max=1.)).astype(np.uint8)
-            imageio.imwrite(os.path.join(out_scene_dir, '{}_pred_coarse.png'.format(file_id)), coarse_pred_rgb)
+            image_writer.write(os.path.join(out_scene_dir, '{}_pred_coarse.png'.format(file_id)), coarse_pred_rgb)
 
             gt_rgb_np_uint8 = (255 * np.clip(gt_rgb.numpy(), a_min=0, a_max=1.)).astype(np.uint8)
-            imageio.imwrite(os.path.join(out_scene_dir, '{}_gt_rgb.png'.format(file_id)), gt_rgb_np_uint8)
+            image_writer.write(os.path.join(out_scene_dir, '{}_gt_rgb.png'.format(file_id)), gt_rgb_np_uint8)
 
-            coarse_pred_depth = ret['outputs_coarse']['depth'].detach().cpu()
-            imageio.imwrite(os.path.join(out_scene_dir, '{}_depth_coarse.png'.format(file_id)),
-                            (coarse_pred_depth.numpy().squeeze() * 1000.).astype(np.uint16))
+            coarse_pred_depth = ret['outputs_coarse']['depth'].detach().cpu().float()
+            image_writer.write(os.path.join(out_scene_dir, '{}_depth_coarse.png'.format(file_id)),
+                               (coarse_pred_depth.numpy().squeeze() * 1000.).astype(np.uint16))
             coarse_pred_depth_colored = colorize_np(coarse_pred_depth,
                                                     range=tuple(data['depth_range'].squeeze().cpu().numpy()))
-            imageio.imwrite(os.path.join(out_scene_dir, '{}_depth_vis_coarse.png'.format(file_id)),
-                            (255 * coarse_pred_depth_colored).astype(np.uint8))
-            coarse_acc_map = torch.sum(ret['outputs_coarse']['weights'], dim=-1).detach().cpu()
+            image_writer.write(os.path.join(out_scene_dir, '{}_depth_vis_coarse.png'.format(file_id)),
+                               (255 * coarse_pred_depth_colored).astype(np.uint8))
+            coarse_acc_map = torch.sum(ret['outputs_coarse']['weights'].float(), dim=-1).detach().cpu()
             coarse_acc_map_colored = (colorize_np(coarse_acc_map, range=(0., 1.)) * 255).astype(np.uint8)
-            imageio.imwrite(os.path.join(out_scene_dir, '{}_acc_map_coarse.png'.format(file_id)),
-                            coarse_acc_map_colored)
+            image_writer.write(os.path.join(out_scene_dir, '{}_acc_map_coarse.png'.format(file_id)),
+                               coarse_acc_map_colored)
 
             sum_coarse_psnr += coarse_psnr
-            running_mean_coarse_psnr = sum_coarse_psnr / (i + 1)
             sum_coarse_lpips += coarse_lpips
-            running_mean_coarse_lpips = sum_coarse_lpips / (i + 1)
             sum_coarse_ssim += coarse_ssim
-            running_mean_coarse_ssim = sum_coarse_ssim / (i + 1)
 
             if ret['outputs_fine'] is not None:
-                fine_pred_rgb = ret['outputs_fine']['rgb'].detach().cpu()
-                fine_pred_rgb_np = torch.from_numpy(np.clip(fine_pred_rgb.numpy()[None, ...], a_min=0., a_max=1.)).cuda()
-
-                fine_lpips = img2lpips(lpips_loss, gt_rgb_np.permute(0, 3, 1, 2), fine_pred_rgb_np.permute(0, 3, 1, 2))
-                fine_ssim = img2ssim(gt_rgb_np.permute(0, 3, 1, 2), fine_pred_rgb_np.permute(0, 3, 1, 2))
-                fine_psnr = img2psnr(gt_rgb_np, fine_pred_rgb_np)
+                fine_lpips, fine_ssim, fine_psnr = lpips_scores[1], ssim_scores[1], psnr_scores[1]
 
                 fine_err_map = torch.sum((fine_pred_rgb - gt_rgb) ** 2, dim=-1).numpy()
                 fine_err_map_colored = (colorize_np(fine_err_map, range=(0., 1.)) * 255).astype(np.uint8)
-                imageio.imwrite(os.path.join(out_scene_dir, '{}_err_map_fine.png'.format(file_id)),
-                                fine_err_map_colored)
+                image_writer.write(os.path.join(out_scene_dir, '{}_err_map_fine.png'.format(file_id)),
+                                   fine_err_map_colored)
 
                 fine_pred_rgb = (255 * np.clip(fine_pred_rgb.numpy(), a_min=0, a_max=1.)).astype(np.uint8)
-                imageio.imwrite(os.path.join(out_scene_dir, '{}_pred_fine.png'.format(file_id)), fine_pred_rgb)
-                fine_pred_depth = ret['outputs_fine']['depth'].detach().cpu()
-                imageio.imwrite(os.path.join(out_scene_dir, '{}_depth_fine.png'.format(file_id)),
-                                (fine_pred_depth.numpy().squeeze() * 1000.).astype(np.uint16))
+                image_writer.write(os.path.join(out_scene_dir, '{}_pred_fine.png'.format(file_id)), fine_pred_rgb)
+                fine_pred_depth = ret['outputs_fine']['depth'].detach().cpu().float()
+                image_writer.write(os.path.join(out_scene_dir, '{}_depth_fine.png'.format(file_id)),
+                                   (fine_pred_depth.numpy().squeeze() * 1000.).astype(np.uint16))
                 fine_pred_depth_colored = colorize_np(fine_pred_depth,
                                                       range=tuple(data['depth_range'].squeeze().cpu().numpy()))
-                imageio.imwrite(os.path.join(out_scene_dir, '{}_depth_vis_fine.png'.format(file_id)),
-                                (255 * fine_pred_depth_colored).astype(np.uint8))
-                fine_acc_map = torch.sum(ret['outputs_fine']['weights'], dim=-1).detach().cpu()
+                image_writer.write(os.path.join(out_scene_dir, '{}_depth_vis_fine.png'.format(file_id)),
+                                   (255 * fine_pred_depth_colored).astype(np.uint8))
+                fine_acc_map = torch.sum(ret['outputs_fine']['weights'].float(), dim=-1).detach().cpu()
                 fine_acc_map_colored = (colorize_np(fine_acc_map, range=(0., 1.)) * 255).astype(np.uint8)
-                imageio.imwrite(os.path.join(out_scene_dir, '{}_acc_map_fine.png'.format(file_id)),
-                                fine_acc_map_colored)
+                image_writer.write(os.path.join(out_scene_dir, '{}_acc_map_fine.png'.format(file_id)),
+                                   fine_acc_map_colored)
             else:
                 fine_ssim = fine_lpips = fine_psnr = 0.
 
             sum_fine_psnr += fine_psnr
-            running_mean_fine_psnr = sum_fine_psnr / (i + 1)
             sum_fine_lpips += fine_lpips
-            running_mean_fine_lpips = sum_fine_lpips / (i + 1)
             sum_fine_ssim += fine_ssim
-            running_mean_fine_ssim = sum_fine_ssim / (i + 1)
 
             print("==================\n"
                   "{}, curr_id: {} \n"
@@ -237,20 +271,22 @@ if __name__ == '__main__':
                   "===================\n"
                   .format(scene_name, file_id,
                           coarse_psnr, fine_psnr,
-                          running_mean_coarse_psnr, running_mean_fine_psnr,
+                          sum_coarse_psnr / (i + 1), sum_fine_psnr / (i + 1),
                           coarse_ssim, fine_ssim,
-                          running_mean_coarse_ssim, running_mean_fine_ssim,
+                          sum_coarse_ssim / (i + 1), sum_fine_ssim / (i + 1),
                           coarse_lpips, fine_lpips,
-                          running_mean_coarse_lpips, running_mean_fine_lpips
+                          sum_coarse_lpips / (i + 1), sum_fine_lpips / (i + 1)
                           ))
 
-            results_dict[scene_name][file_id] = {'coarse_psnr': coarse_psnr,
-                                                 'fine_psnr': fine_psnr,
-                                                 'coarse_ssim': coarse_ssim,
-                                                 'fine_ssim': fine_ssim,
-                                                 'coarse_lpips': coarse_lpips,
-                                                 'fine_lpips': fine_lpips,
-                                                 }
+            results_file.write(json.dumps({file_id: {'coarse_psnr': coarse_psnr,
+                                                     'fine_psnr': fine_psnr,
+                                                     'coarse_ssim': coarse_ssim,
+                                                     'fine_ssim': fine_ssim,
+                                                     'coarse_lpips': coarse_lpips,
+                                                     'fine_lpips': fine_lpips,
+                                                     }}) + '\n')
+
+    image_writer.close()
 
     mean_coarse_psnr = sum_coarse_psnr / total_num
     mean_fine_psnr = sum_fine_psnr / total_num
@@ -268,14 +304,12 @@ if __name__ == '__main__':
                   mean_coarse_lpips, mean_fine_lpips,
                   ))
 
-    results_dict[scene_name]['coarse_mean_psnr'] = mean_coarse_psnr
-    results_dict[scene_name]['fine_mean_psnr'] = mean_fine_psnr
-    results_dict[scene_name]['coarse_mean_ssim'] = mean_coarse_ssim
-    results_dict[scene_name]['fine_mean_ssim'] = mean_fine_ssim
-    results_dict[scene_name]['coarse_mean_lpips'] = mean_coarse_lpips
-    results_dict[scene_name]['fine_mean_lpips'] = mean_fine_lpips
-
-    f = open("{}/psnr_{}_{}.txt".format(extra_out_dir, save_prefix, start_step), "w")
-    f.write(str(results_dict))
-    f.close()
+    results_file.write(json.dumps({scene_name: {'coarse_mean_psnr': mean_coarse_psnr,
+                                                'fine_mean_psnr': mean_fine_psnr,
+                                                'coarse_mean_ssim': mean_coarse_ssim,
+                                                'fine_mean_ssim': mean_fine_ssim,
+                                                'coarse_mean_lpips': mean_coarse_lpips,
+                                                'fine_mean_lpips': mean_fine_lpips,
+                                                }}) + '\n')
+    results_file.close()
 
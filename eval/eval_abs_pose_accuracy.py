@@ -4,6 +4,7 @@ import configargparse
 sys.path.append('../')
 
 import json
+import re
 import torch
 import numpy as np
 
@@ -15,39 +16,40 @@ from scipy.spatial.transform import Rotation
 
 
 def read_g2o_file(filename: str):
-    poses_dict = {}
-
-    f = open(filename)
-    line = f.readline()
-
-    while line:
-        data = line.split(' ')
-        line = f.readline()
-
-        if data[0].find('VERTEX_SE3:QUAT') >= 0:
-            # Read vertices' data.
-            node_index = int(data[1]) # - 1 if src == 'COLMAP' else int(data[1]) # node id
-            # qw, qx, qy, qz, tx, ty, tz
-            pose = np.array([float(data[8]), float(data[5]), float(data[6]), float(data[7]),
-                                 float(data[2]), float(data[3]), float(data[4])])
-            
-            quat_norm = np.linalg.norm(pose[0:4], ord=2)
-            assert abs(quat_norm - 1) < 1e-5, f"Quaternion norm is not 1: {absolute_poses[node_index, 0:4]}"
-
-            poses_dict[node_index] = pose
-        else:
-            continue
-    f.close()
-    print(f'poses_dict len: {len(poses_dict)}')
-
-    num_nodes = len(poses_dict)
+    with open(filename) as f:
+        text = f.read()
+
+    # VERTEX_SE3:QUAT id tx ty tz qx qy qz qw, all vertices parsed at once.
+    vertices = re.findall(r'^VERTEX_SE3:QUAT' + r'[ \t]+(\S+)' * 8, text, re.M)
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 8)
+    print(f'poses_dict len: {len(vertices)}')
+
+    node_indices = vertices[:, 0].astype(np.int64)
+    # qw, qx, qy, qz, tx, ty, tz
+    poses = vertices[:, [7, 4, 5, 6, 1, 2, 3]]
+
+    quat_norm_err = np.abs(np.linalg.norm(poses[:, 0:4], ord=2, axis=1) - 1)
+    assert np.all(quat_norm_err < 1e-5), \
+        f"Quaternion norm is not 1: {poses[np.argmax(quat_norm_err), 0:4]}"
+
+    num_nodes = len(vertices)
     absolute_poses = np.zeros((num_nodes, 7), dtype=np.float64)
-    for key in poses_dict.keys():
-        absolute_poses[key] = poses_dict[key]
+    absolute_poses[node_indices] = poses
 
     return absolute_poses
 
 
+def quat_poses_to_matrices(poses_quat):
+    """
+    [N,7] poses as (qw, qx, qy, qz, tx, ty, tz) to [N,3,4] matrices.
+    """
+    # scipy expects scalar-last quaternions.
+    rotations = Rotation.from_quat(poses_quat[:, [1, 2, 3, 0]]).as_matrix()
+    translations = poses_quat[:, 4:7, None]
+    
+    return np.concatenate([rotations, translations], axis=-1)
+
+
 def write_camera_poses_to_COLMAP_format(output_dir, gt_poses, pred_poses,
                                         camera_model='PINHOLE', width=504, height=378,
                                         fx=200, fy=200, cx=252, cy=189):
@@ -74,23 +76,17 @@ def write_camera_poses_to_COLMAP_format(output_dir, gt_poses, pred_poses,
     image_file.write('#   POINTS2D[] as (X, Y, POINT3D_ID)\n')
     image_file.write(f'# Number of images: {num_poses}, mean observations per image: 0\n')
 
-    # Writing camera poses.
-    for i in range(gt_poses.shape[0]):
-        pose = gt_poses[i]
-        qvec = Rotation.from_matrix(pose[:3, :3]).as_quat()
-        tvec = pose[:3, -1]
-        image_file.write(f'{i} {gt_cluster_id} {qvec[3]} {qvec[0]} {qvec[1]} {qvec[2]} {tvec[0]} {tvec[1]} {tvec[2]} ' +
-                         f'{camera_id} {i}\n')
-        image_file.write('-1\n') # No 3D points, just set a placeholder.
-    for i in range(pred_poses.shape[0]):
-        pose = pred_poses[i]
-        qvec = Rotation.from_matrix(pose[:3, :3]).as_quat()
-        tvec = pose[:3, -1]
-        image_file.write(f'{i} {pred_cluster_id} {qvec[3]} {qvec[0]} {qvec[1]} {qvec[2]} {tvec[0]} {tvec[1]} {tvec[2]} ' +
-                         f'{camera_id} {i}\n')
-        # image_file.write(f'{i} {qvec[3]} {qvec[0]} {qvec[1]} {qvec[2]} {tvec[0]} {tvec[1]} {tvec[2]} ' +
-        #                  f'{camera_id} {i}\n')
-        image_file.write('-1\n') # No 3D points, just set a placeholder.
+    # Writing camera poses, all quaternions are converted in one call and each
+    # cluster is written with a single write().
+    for poses, cluster_id in [(gt_poses, gt_cluster_id), (pred_poses, pred_cluster_id)]:
+        poses = np.asarray(poses)
+        qvecs = Rotation.from_matrix(poses[:, :3, :3]).as_quat()
+        tvecs = poses[:, :3, -1]
+        # No 3D points, '-1' is just a placeholder.
+        image_file.write(''.join(
+            f'{i} {cluster_id} {qvec[3]} {qvec[0]} {qvec[1]} {qvec[2]} {tvec[0]} {tvec[1]} {tvec[2]} ' +
+            f'{camera_id} {i}\n-1\n' for i, (qvec, tvec) in enumerate(zip(qvecs.tolist(), tvecs.tolist()))
+        ))
     image_file.close()
 
     # Write points txt (pseudo file).
@@ -124,27 +120,10 @@ if __name__ == '__main__':
     pred_poses_quat = read_g2o_file(pred_view_graph_filename)
 
     num_poses = gt_poses_quat.shape[0]
-    gt_poses, pred_poses = [], []
-    for i in range(num_poses):
-        gt_qw, gt_qx, gt_qy, gt_qz, gt_tx, gt_ty, gt_tz = \
-            gt_poses_quat[i, 0], gt_poses_quat[i, 1], gt_poses_quat[i, 2], gt_poses_quat[i, 3],\
-            gt_poses_quat[i, 4], gt_poses_quat[i, 5], gt_poses_quat[i, 6]
-        gt_rot = Rotation.from_quat(np.array([gt_qx, gt_qy, gt_qz, gt_qw])).as_matrix()
-        gt_tvec = np.array([[gt_tx], [gt_ty], [gt_tz]])
-
-        gt_pose = np.concatenate([gt_rot, gt_tvec], axis=1)
-        gt_poses.append(gt_pose)
-
-        pred_qw, pred_qx, pred_qy, pred_qz, pred_tx, pred_ty, pred_tz = \
-            pred_poses_quat[i, 0], pred_poses_quat[i, 1], pred_poses_quat[i, 2], pred_poses_quat[i, 3],\
-            pred_poses_quat[i, 4], pred_poses_quat[i, 5], pred_poses_quat[i, 6]
-        pred_rot = Rotation.from_quat(np.array([pred_qx, pred_qy, pred_qz, pred_qw])).as_matrix()
-        pred_tvec = np.array([[pred_tx], [pred_ty], [pred_tz]])
-        pred_pose = np.concatenate([pred_rot, pred_tvec], axis=1)
-        pred_poses.append(pred_pose)
-    
-    gt_poses = torch.from_numpy(np.stack(gt_poses)).float()
-    pred_poses = np.stack(pred_poses)
+    gt_poses = quat_poses_to_matrices(gt_poses_quat)
+    pred_poses = quat_poses_to_matrices(pred_poses_quat[:num_poses])
+
+    gt_poses = torch.from_numpy(gt_poses).float()
     # The predicted absolute poses rotate points from world to camera!
     pred_poses[..., :3, :3] = np.transpose(pred_poses[..., :3, :3], axes=(0, 2, 1))
     pred_poses = torch.from_numpy(pred_poses).float()
@@ -30,10 +30,12 @@ def img2mse(x, y, mask=None):
     :return: mse score
     '''
 
+    sq_diff = (x - y).square()
     if mask is None:
-        return torch.mean((x - y) * (x - y))
+        return torch.mean(sq_diff)
     else:
-        return torch.sum((x - y) * (x - y) * mask.unsqueeze(-1)) / (torch.sum(mask) * x.shape[-1] + TINY_NUMBER)
+        # Reduce over channels first so the mask is applied without broadcasting.
+        return torch.sum(sq_diff.sum(dim=-1) * mask) / (torch.sum(mask) * x.shape[-1] + TINY_NUMBER)
 
 
 def img2psnr(x, y, mask=None):
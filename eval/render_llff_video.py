@@ -13,10 +13,20 @@
 # limitations under the License.
 
 import imageio
+import os
+from importlib.metadata import version
 import time
 import sys
 sys.path.append('../')
 
+# Must be set before CUDA is initialized. Frames reuse the same allocation
+# pattern, expandable segments keep fragmentation in check without having to
+# empty the cache every frame.
+# expandable_segments is only known to the allocator since PyTorch 2.1, older versions
+# fail on the first CUDA allocation with an unrecognized option, so it is not set there.
+if tuple(int(v) for v in version('torch').split('.')[:2]) >= (2, 1):
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader
 
@@ -28,6 +38,7 @@ from dbarf.model.ibrnet import IBRNetModel
 from utils import *
 from dbarf.projection import Projector
 from dbarf.data_loaders import get_nearest_pose_ids
+from dbarf.data_loaders.data_utils import CUDAPrefetcher
 from dbarf.data_loaders.llff_data_utils import load_llff_data, batch_parse_llff_poses
 
 
@@ -53,6 +64,7 @@ class LLFFRenderDataset(Dataset):
         self.train_intrinsics = []
         self.train_poses = []
         self.train_rgb_files = []
+        self.train_imgs = []
 
         for i, scene in enumerate(scenes):
             scene_path = os.path.join(self.folder_path, scene)
@@ -68,9 +80,14 @@ class LLFFRenderDataset(Dataset):
             i_train = np.array([i for i in np.arange(len(rgb_files)) if
                                 (i not in i_test and i not in i_val)])
 
-            self.train_intrinsics.append(intrinsics[i_train])
-            self.train_poses.append(c2w_mats[i_train])
+            # [num_train, 4, 4] float32 blocks, source cameras are gathered with one index.
+            self.train_intrinsics.append(np.ascontiguousarray(intrinsics[i_train], dtype=np.float32))
+            self.train_poses.append(np.ascontiguousarray(c2w_mats[i_train], dtype=np.float32))
             self.train_rgb_files.append(np.array(rgb_files)[i_train].tolist())
+            # Every render frame reuses the same few training images as source views,
+            # so they are decoded once (in uint8) and shared with the loader workers.
+            train_imgs = np.stack([imageio.imread(rgb_file)[..., :3] for rgb_file in self.train_rgb_files[-1]])
+            self.train_imgs.append(torch.from_numpy(train_imgs).share_memory_())
             num_render = len(render_intrinsics)
             self.render_intrinsics.extend([intrinsics_ for intrinsics_ in render_intrinsics])
             self.render_poses.extend([c2w_mat for c2w_mat in render_c2w_mats])
@@ -79,6 +96,18 @@ class LLFFRenderDataset(Dataset):
             self.h.extend([int(h)]*num_render)
             self.w.extend([int(w)]*num_render)
 
+        # The render trajectory and training views are fixed, so the source views of
+        # every frame are selected once here rather than in each __getitem__.
+        id_render = -1
+        self.render_nearest_pose_ids = [
+            get_nearest_pose_ids(render_pose,
+                                 self.train_poses[train_set_id],
+                                 self.num_source_views,
+                                 tar_id=id_render,
+                                 angular_dist_method='dist')
+            for render_pose, train_set_id in zip(self.render_poses, self.render_train_set_ids)
+        ]
+
     def __len__(self):
         return len(self.render_poses)
 
@@ -88,7 +117,7 @@ class LLFFRenderDataset(Dataset):
         depth_range = self.render_depth_range[idx]
 
         train_set_id = self.render_train_set_ids[idx]
-        train_rgb_files = self.train_rgb_files[train_set_id]
+        train_imgs = self.train_imgs[train_set_id]
         train_poses = self.train_poses[train_set_id]
         train_intrinsics = self.train_intrinsics[train_set_id]
 
@@ -96,32 +125,23 @@ class LLFFRenderDataset(Dataset):
         camera = np.concatenate(([h, w], intrinsics.flatten(),
                                  render_pose.flatten())).astype(np.float32)
 
-        id_render = -1
-        nearest_pose_ids = get_nearest_pose_ids(render_pose,
-                                                train_poses,
-                                                self.num_source_views,
-                                                tar_id=id_render,
-                                                angular_dist_method='dist')
-
-        src_rgbs = []
-        src_cameras = []
-        for id in nearest_pose_ids:
-            src_rgb = imageio.imread(train_rgb_files[id]).astype(np.float32) / 255.
-            train_pose = train_poses[id]
-            train_intrinsics_ = train_intrinsics[id]
-            src_rgbs.append(src_rgb)
-            img_size = src_rgb.shape[:2]
-            src_camera = np.concatenate((list(img_size), train_intrinsics_.flatten(),
-                                         train_pose.flatten())).astype(np.float32)
-            src_cameras.append(src_camera)
-
-        src_rgbs = np.stack(src_rgbs, axis=0)
-        src_cameras = np.stack(src_cameras, axis=0)
+        nearest_pose_ids = self.render_nearest_pose_ids[idx]
+
+        # Kept in uint8, the conversion to [0, 1] floats is done on the GPU.
+        src_rgbs = train_imgs[nearest_pose_ids]
+        img_size = src_rgbs.shape[1:3]
+
+        # [H, W, 4x4 intrinsics, 4x4 c2w] per source view, see parse_camera().
+        num_src = len(nearest_pose_ids)
+        src_cameras = np.empty((num_src, 34), dtype=np.float32)
+        src_cameras[:, :2] = img_size
+        src_cameras[:, 2:18] = train_intrinsics[nearest_pose_ids].reshape(num_src, 16)
+        src_cameras[:, 18:34] = train_poses[nearest_pose_ids].reshape(num_src, 16)
         depth_range = torch.tensor([depth_range[0] * 0.9, depth_range[1] * 1.5])
 
         return {'camera': torch.from_numpy(camera),
                 'rgb_path': '',
-                'src_rgbs': torch.from_numpy(src_rgbs[..., :3]),
+                'src_rgbs': src_rgbs,
                 'src_cameras': torch.from_numpy(src_cameras),
                 'depth_range': depth_range
                 }
@@ -148,6 +168,16 @@ if __name__ == '__main__':
     state_dicts = compose_state_dicts(model=model)
     ckpt_manager = CheckPointManager()
     start_step = ckpt_manager.load(config=args, models=state_dicts)
+    if args.eval_fp16:
+        # Weights stay in FP32, autocast picks the FP16 kernels.
+        model.feature_net = model.feature_net.to(memory_format=torch.channels_last)
+    if args.eval_compile and hasattr(torch, 'compile'):
+        # Image size, chunk size and sample counts are fixed for the whole
+        # trajectory, so the graphs are captured once (plus once for a shorter last chunk).
+        model.feature_net = torch.compile(model.feature_net, mode='reduce-overhead')
+        model.net_coarse = torch.compile(model.net_coarse, mode='reduce-overhead')
+        if model.net_fine is not None:
+            model.net_fine = torch.compile(model.net_fine, mode='reduce-overhead')
 
     eval_dataset_name = args.eval_dataset
     extra_out_dir = '{}/{}'.format(args.rootdir, args.expname)
@@ -165,22 +195,33 @@ if __name__ == '__main__':
 
     test_dataset = LLFFRenderDataset(args, scenes=args.eval_scenes)
     save_prefix = scene_name
-    test_loader = DataLoader(test_dataset, batch_size=1)
+    test_loader = DataLoader(test_dataset, batch_size=1, num_workers=args.workers,
+                             pin_memory=True, persistent_workers=args.workers > 0)
     total_num = len(test_loader)
-    out_frames = []
-    out_depth_frames = []
-    out_color_depth_frames = []
+    # Frames are streamed to ffmpeg as they are rendered instead of being kept
+    # in memory for the whole trajectory.
+    video_writer = imageio.get_writer(os.path.join(extra_out_dir, f'{scene_name}_{start_step}.mp4'),
+                                      fps=30, quality=8)
+    depth_video_writer = imageio.get_writer(os.path.join(extra_out_dir, f'{scene_name}_depth_{start_step}.mp4'),
+                                            fps=30, quality=8)
+    color_depth_video_writer = imageio.get_writer(os.path.join(extra_out_dir, f'{scene_name}_color_depth_{start_step}.mp4'),
+                                                  fps=30, quality=8)
     crop_ratio = 0.075
+    image_writer = AsyncImageWriter(num_workers=4)
 
-    for i, data in enumerate(test_loader):
+    # Source views of the next frame are uploaded while the current one renders. The
+    # camera stays on the host since rays are generated on the CPU from it.
+    for i, data in enumerate(CUDAPrefetcher(test_loader, device='cuda:0', keys=('src_rgbs', 'src_cameras'))):
         start = time.time()
-        src_rgbs = data['src_rgbs'][0].cpu().numpy()
+        data['src_rgbs'] = data['src_rgbs'].float().div_(255.)
 
         model.switch_to_eval()
-        with torch.no_grad():
+        with torch.no_grad(), torch.autocast('cuda', dtype=torch.float16, enabled=args.eval_fp16):
             ray_sampler = RaySamplerSingleImage(data, device='cuda:0')
             ray_batch = ray_sampler.get_all()
-            feat_maps = model.feature_net(ray_batch['src_rgbs'].squeeze(0).permute(0, 3, 1, 2))
+            # [N, H, W, 3] -> [N, 3, H, W] already has channels_last strides, no copy here.
+            feat_maps = model.feature_net(ray_batch['src_rgbs'].squeeze(0).permute(0, 3, 1, 2)
+                                          .contiguous(memory_format=torch.channels_last))
 
             ret = render_single_image(ray_sampler=ray_sampler,
                                       ray_batch=ray_batch,
@@ -193,31 +234,29 @@ if __name__ == '__main__':
                                       N_importance=args.N_importance,
                                       white_bkgd=args.white_bkgd,
                                       feat_maps=feat_maps)
-            torch.cuda.empty_cache()
 
-        coarse_pred_rgb = ret['outputs_coarse']['rgb'].detach().cpu()
-        coarse_pred_rgb = (255 * np.clip(coarse_pred_rgb.numpy(), a_min=0, a_max=1.)).astype(np.uint8)
-        imageio.imwrite(os.path.join(out_scene_dir, '{}_pred_coarse.png'.format(i)), coarse_pred_rgb)
+        # Outputs are already on the host, quantized in place without numpy temporaries.
+        coarse_pred_rgb = ret['outputs_coarse']['rgb'].detach().float().clamp_(0., 1.).mul_(255.).to(torch.uint8).numpy()
+        image_writer.write(os.path.join(out_scene_dir, '{}_pred_coarse.png'.format(i)), coarse_pred_rgb)
 
-        coarse_pred_depth = ret['outputs_coarse']['depth'].detach().cpu()
-        imageio.imwrite(os.path.join(out_scene_dir, '{}_depth_coarse.png'.format(i)),
-                        (coarse_pred_depth.numpy().squeeze() * 1000.).astype(np.uint16))
+        coarse_pred_depth = ret['outputs_coarse']['depth'].detach().cpu().float()
+        image_writer.write(os.path.join(out_scene_dir, '{}_depth_coarse.png'.format(i)),
+                           (coarse_pred_depth.numpy().squeeze() * 1000.).astype(np.uint16))
         coarse_pred_depth_colored = colorize_np(coarse_pred_depth,
                                                 range=tuple(data['depth_range'].squeeze().numpy()))
-        imageio.imwrite(os.path.join(out_scene_dir, '{}_depth_vis_coarse.png'.format(i)),
-                        (255 * coarse_pred_depth_colored).astype(np.uint8))
+        image_writer.write(os.path.join(out_scene_dir, '{}_depth_vis_coarse.png'.format(i)),
+                           (255 * coarse_pred_depth_colored).astype(np.uint8))
 
         if ret['outputs_fine'] is not None:
-            fine_pred_rgb = ret['outputs_fine']['rgb'].detach().cpu()
-            fine_pred_rgb = (255 * np.clip(fine_pred_rgb.numpy(), a_min=0, a_max=1.)).astype(np.uint8)
-            imageio.imwrite(os.path.join(out_scene_dir, '{}_pred_fine.png'.format(i)), fine_pred_rgb)
-            fine_pred_depth = ret['outputs_fine']['depth'].detach().cpu()
-            imageio.imwrite(os.path.join(out_scene_dir, '{}_depth_fine.png'.format(i)),
-                            (fine_pred_depth.numpy().squeeze() * 1000.).astype(np.uint16))
+            fine_pred_rgb = ret['outputs_fine']['rgb'].detach().float().clamp_(0., 1.).mul_(255.).to(torch.uint8).numpy()
+            image_writer.write(os.path.join(out_scene_dir, '{}_pred_fine.png'.format(i)), fine_pred_rgb)
+            fine_pred_depth = ret['outputs_fine']['depth'].detach().cpu().float()
+            image_writer.write(os.path.join(out_scene_dir, '{}_depth_fine.png'.format(i)),
+                               (fine_pred_depth.numpy().squeeze() * 1000.).astype(np.uint16))
             fine_pred_depth_colored = colorize_np(fine_pred_depth,
                                                   range=tuple(data['depth_range'].squeeze().cpu().numpy()))
-            imageio.imwrite(os.path.join(out_scene_dir, '{}_depth_vis_fine.png'.format(i)),
-                            (255 * fine_pred_depth_colored).astype(np.uint8))
+            image_writer.write(os.path.join(out_scene_dir, '{}_depth_vis_fine.png'.format(i)),
+                               (255 * fine_pred_depth_colored).astype(np.uint8))
         else:
             fine_pred_rgb = None
 
@@ -228,17 +267,22 @@ if __name__ == '__main__':
         
         # crop out image boundaries
         out_frame = out_frame[crop_h:h - crop_h, crop_w:w - crop_w, :]
-        out_frames.append(out_frame)
+        video_writer.append_data(out_frame)
         
-        out_depth_frame = coarse_pred_depth[crop_h:h - crop_h, crop_w:w - crop_w]
-        out_depth_frames.append(out_depth_frame)
+        # Quantized over the depth range (the same for all frames), so that ffmpeg
+        # gets uint8 frames without conversion.
+        depth_min, depth_max = data['depth_range'].squeeze().tolist()
+        out_depth_frame = coarse_pred_depth.numpy()[crop_h:h - crop_h, crop_w:w - crop_w]
+        out_depth_frame = (np.clip((out_depth_frame - depth_min) / (depth_max - depth_min), 0., 1.) * 255.).astype(np.uint8)
+        depth_video_writer.append_data(out_depth_frame)
 
         out_color_depth_frame = (255 * coarse_pred_depth_colored).astype(np.uint8)[crop_h:h - crop_h, crop_w:w - crop_w, :]
-        out_color_depth_frames.append(out_color_depth_frame)
+        color_depth_video_writer.append_data(out_color_depth_frame)
 
         print('frame {} completed, {}'.format(i, time.time() - start))
 
-    imageio.mimwrite(os.path.join(extra_out_dir, f'{scene_name}_{start_step}.mp4'), out_frames, fps=30, quality=8)
-    imageio.mimwrite(os.path.join(extra_out_dir, f'{scene_name}_depth_{start_step}.mp4'), out_depth_frames, fps=30, quality=8)
-    imageio.mimwrite(os.path.join(extra_out_dir, f'{scene_name}_color_depth_{start_step}.mp4'), out_color_depth_frames, fps=30, quality=8)
+    image_writer.close()
+    video_writer.close()
+    depth_video_writer.close()
+    color_depth_video_writer.close()
 
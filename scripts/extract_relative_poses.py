@@ -1,4 +1,6 @@
 import os
+import functools
+import multiprocessing
 from pathlib import Path
 from pprint import pformat
 import argparse
@@ -15,8 +17,8 @@ from disambiguation import calculate_geodesic_consistency_scores
 
 from scripts import extract_features, match_features, \
     pairs_from_retrieval, reconstruction, filter_matches
-from scripts.utils import read_all_keypoints, import_matches, \
-    decompose_essential_matrix, read_camera_intrinsics_by_image_id
+from scripts.utils import import_matches, \
+    decompose_essential_matrix, read_all_camera_intrinsics
 from dbarf.geometry.rotation import Rotation
 
 
@@ -92,52 +94,81 @@ def output_view_graph(num_images, view_graph_path, relative_poses, model=None):
     f.close()
 
 
+# Database connection of a decomposition worker. Keypoints are loaded lazily
+# per image (and cached), so memory does not grow with the number of images.
+_db = None
+
+
+def _init_decompose_worker(database_path):
+    global _db
+    _db = COLMAPDatabase.connect(database_path)
+
+
+@functools.lru_cache(maxsize=4096)
+def _read_keypoints(image_id):
+    (data,) = _db.execute(
+        "SELECT data FROM keypoints WHERE image_id=?", (image_id,)).fetchone()
+    # Zero-copy view of the blob, the keypoints are only indexed.
+    return np.frombuffer(data, np.float32).reshape(-1, 2)
+
+
+def _decompose_worker(task):
+    image_id1, image_id2, E, matches, intrinsics1, intrinsics2 = task
+    relative_motion, points3d = decompose_essential_matrix(
+        _read_keypoints(image_id1), _read_keypoints(image_id2), E, matches,
+        intrinsics1, intrinsics2)
+
+    return image_id1, image_id2, relative_motion, points3d
+
+
 def extract_relative_poses(
     database_path: Path, visualization=True
 ) -> (np.ndarray, np.ndarray):
     db = COLMAPDatabase.connect(database_path)
-    keypoints = read_all_keypoints(db)
+    intrinsics = read_all_camera_intrinsics(db)
     # rows = db.execute("SELECT * FROM two_view_geometries")
     cursor = db.cursor()
-    cursor.execute("SELECT * FROM two_view_geometries")
-    num_match_pairs = 0
-    for row in cursor:
-        num_match_pairs += 1
-
-    relative_motions = []
-    pbar = tqdm(total=num_match_pairs)
+    num_match_pairs = cursor.execute(
+        "SELECT COUNT(*) FROM two_view_geometries WHERE data IS NOT NULL").fetchone()[0]
 
     print(f'num two view geometries: {num_match_pairs}')
-    cursor.execute("SELECT * FROM two_view_geometries")
-    for rows in cursor:
-        pbar.set_description('Extracting relative poses ')
-        pbar.update(1)
-
-        # pair_id, shape1, shape2, matches, config, F, E, H, qvec, tvec = next(rows)
-        pair_id, shape1, shape2, matches, config, F, E, H, qvec, tvec = rows
+    # Only the columns used below are read, pairs without matches are skipped by sqlite.
+    cursor.execute("SELECT pair_id, rows, cols, data, E FROM two_view_geometries WHERE data IS NOT NULL")
+    cursor.arraysize = 512
+    rows = (row for batch in iter(cursor.fetchmany, []) for row in batch)
+
+    # Reading the database is serial, the decompositions are independent per pair.
+    tasks = []
+    for pair_id, shape1, shape2, matches, E in rows:
         image_id1, image_id2 = pair_id_to_image_ids(pair_id)
 
-        if matches == None:
-            continue
-
         matches = blob_to_array(matches, np.uint32).reshape(shape1, shape2)
 
         # FIXME(chenyu): in some cases, we need to decompose homography matrix rather than
         # the essential matrix. There should be some strategies to do this inside COLMAP.
         E = blob_to_array(E, np.float64).reshape(3, 3)
 
-        intrinsics1 = read_camera_intrinsics_by_image_id(image_id1, db)
-        intrinsics2 = read_camera_intrinsics_by_image_id(image_id2, db)
+        intrinsics1 = intrinsics[image_id1]
+        intrinsics2 = intrinsics[image_id2]
+
+        tasks.append((image_id1, image_id2, E, matches, intrinsics1, intrinsics2))
 
-        relative_motion, points3d = decompose_essential_matrix(
-            keypoints[image_id1], keypoints[image_id2], E, matches,
-            intrinsics1, intrinsics2)
+    relative_motions = []
+    pbar = tqdm(total=num_match_pairs)
+    pbar.set_description('Extracting relative poses ')
+
+    # Results come back in the database order, so the view graph stays deterministic.
+    with multiprocessing.Pool(os.cpu_count(), initializer=_init_decompose_worker,
+                              initargs=(str(database_path),)) as pool:
+        for image_id1, image_id2, relative_motion, points3d in \
+                pool.imap(_decompose_worker, tasks, chunksize=64):
+            pbar.update(1)
         
-        if not (relative_motion is None or points3d is None):
-            # image1, image2, [rotations, translations]
-            relative_motion = np.concatenate(
-                (np.array([[image_id1, image_id2]]), relative_motion), axis=1)
-            relative_motions.append(relative_motion)
+            if not (relative_motion is None or points3d is None):
+                # image1, image2, [rotations, translations]
+                relative_motion = np.concatenate(
+                    (np.array([[image_id1, image_id2]]), relative_motion), axis=1)
+                relative_motions.append(relative_motion)
 
     if visualization == True:
         fig = viz_3d.init_figure()
@@ -47,11 +47,11 @@ def filter_with_fixed_threshold(scores, thres, plot_path=None):
 
 
 def filter_with_knn(scores, k, plot_path):
-    valid = np.zeros_like(scores, dtype=np.bool)
-    valid_indices = scores.argsort()[:, -k:]
-    for i in range(scores.shape[0]):
-        for j in valid_indices[i]:
-            valid[i, j] = True
+    k = min(k, scores.shape[1])
+    valid = np.zeros_like(scores, dtype=bool)
+    # Only the top-k need to be found per row, not a full sort.
+    valid_indices = np.argpartition(scores, -k, axis=1)[:, -k:]
+    np.put_along_axis(valid, valid_indices, True, axis=1)
     invalid = np.logical_not(valid)
     scores[invalid] = 0.
     if plot_path is not None:
@@ -62,10 +62,11 @@ def filter_with_knn(scores, k, plot_path):
 def filter_with_mst_min(scores, plot_path=None):
     min_scores = np.minimum(scores, scores.T)
     assert np.allclose(min_scores, min_scores.T)
-    mst = minimum_spanning_tree(-min_scores)
-    valid = (-mst).toarray() > 0
-    invalid = np.logical_not(valid)
-    scores[invalid] = 0.
+    # Only the N-1 tree edges are scattered into the mask.
+    mst = minimum_spanning_tree(-min_scores).tocoo()
+    valid = np.zeros_like(scores, dtype=bool)
+    valid[mst.row[mst.data < 0], mst.col[mst.data < 0]] = True
+    scores *= valid
     if plot_path is not None:
         draw_graph(scores, plot_path, display=False)
     return valid
@@ -74,20 +75,20 @@ def filter_with_mst_min(scores, plot_path=None):
 def filter_with_mst_mean(scores, plot_path=None):
     mean_scores = (scores + scores.T) / 2
     assert np.allclose(mean_scores, mean_scores.T)
-    mst = minimum_spanning_tree(-mean_scores)
-    valid = (-mst).toarray() > 0
-    invalid = np.logical_not(valid)
-    scores[invalid] = 0.
+    # Only the N-1 tree edges are scattered into the mask.
+    mst = minimum_spanning_tree(-mean_scores).tocoo()
+    valid = np.zeros_like(scores, dtype=bool)
+    valid[mst.row[mst.data < 0], mst.col[mst.data < 0]] = True
+    scores *= valid
     if plot_path is not None:
         draw_graph(scores, plot_path, display=False)
     return valid
 
 
 def filter_with_percentile(scores, percentile, plot_path=None):
-    num_images = scores.shape[0]
-    thres = np.zeros((num_images, 1))
-    for i in range(num_images):
-        thres[i] = np.percentile(scores[i, scores[i].nonzero()], percentile)
+    # Per-row percentile over the non-zero scores only.
+    thres = np.nanpercentile(np.where(scores != 0, scores, np.nan), percentile,
+                             axis=1, keepdims=True)
     valid = scores >= thres
     invalid = np.logical_not(valid)
     scores[invalid] = 0.
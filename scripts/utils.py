@@ -1,9 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
 import cv2
 from tqdm import tqdm
 
-from hloc.utils.database import COLMAPDatabase, blob_to_array
+from hloc.utils.database import COLMAPDatabase, blob_to_array, array_to_blob, \
+    image_ids_to_pair_id
 from hloc import logger
 from hloc.utils.io import get_matches
 
@@ -18,30 +21,50 @@ def import_matches(image_ids, database_path, pairs_path, matches_path,
 
     db = COLMAPDatabase.connect(database_path)
 
+    # An unordered pair is keyed by a single int, (min_id << 32) | max_id.
     matched = set()
-    for name0, name1 in tqdm(pairs):
+    unique_pairs = []
+    for name0, name1 in pairs:
         id0, id1 = image_ids[name0], image_ids[name1]
-        if len({(id0, id1), (id1, id0)} & matched) > 0:
+        key = (min(id0, id1) << 32) | max(id0, id1)
+        if key in matched:
             continue
-        matches, scores = get_matches(matches_path, name0, name1)
-        if min_match_score:
-            matches = matches[scores > min_match_score]
-        db.add_matches(id0, id1, matches)
-        matched |= {(id0, id1), (id1, id0)}
-
-        if skip_geometric_verification:
-            db.add_two_view_geometry(id0, id1, matches)
-
+        matched.add(key)
+        unique_pairs.append((name0, name1))
+
+    def read_matches(pair):
+        return get_matches(matches_path, *pair)
+
+    # Matches are read by a thread pool, sqlite is only written from this thread.
+    # Rows of the matches table are inserted in batches with executemany.
+    match_rows = []
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        pair_matches_iter = executor.map(read_matches, unique_pairs)
+        for (name0, name1), (matches, scores) in tqdm(
+                zip(unique_pairs, pair_matches_iter), total=len(unique_pairs)):
+            id0, id1 = image_ids[name0], image_ids[name1]
+            if min_match_score:
+                matches = matches[scores > min_match_score]
+            # Same layout as COLMAPDatabase.add_matches().
+            pair_matches = matches[:, ::-1] if id0 > id1 else matches
+            pair_matches = np.asarray(pair_matches, np.uint32)
+            match_rows.append((image_ids_to_pair_id(id0, id1),) + pair_matches.shape +
+                              (array_to_blob(pair_matches),))
+            if len(match_rows) >= 1024:
+                db.executemany("INSERT INTO matches VALUES (?, ?, ?, ?)", match_rows)
+                match_rows.clear()
+
+            if skip_geometric_verification:
+                db.add_two_view_geometry(id0, id1, matches)
+
+    db.executemany("INSERT INTO matches VALUES (?, ?, ?, ?)", match_rows)
     db.commit()
     db.close()
     return len(pairs)
 
 
-def read_camera_intrinsics_by_image_id(image_id: int, db: COLMAPDatabase):
-    rows = db.execute(f'SELECT camera_id FROM images WHERE image_id={image_id}')
-    camera_id = next(rows)[0]
-    rows = db.execute(f'SELECT params FROM cameras WHERE camera_id={camera_id}')
-    params = blob_to_array(next(rows)[0], dtype=np.float64)
+def params_to_intrinsics(params):
+    params = blob_to_array(params, dtype=np.float64)
 
     # FIXME(chenyu): when camera model is not a simple pinhole.
     intrinsics = np.zeros((3, 3), dtype=np.float64)
@@ -51,24 +74,38 @@ def read_camera_intrinsics_by_image_id(image_id: int, db: COLMAPDatabase):
     return intrinsics
 
 
+def read_camera_intrinsics_by_image_id(image_id: int, db: COLMAPDatabase):
+    rows = db.execute(
+        "SELECT cameras.params FROM images JOIN cameras ON images.camera_id = cameras.camera_id "
+        "WHERE images.image_id=?", (image_id,))
+    return params_to_intrinsics(next(rows)[0])
+
+
+def read_all_camera_intrinsics(db: COLMAPDatabase):
+    # Intrinsics of all images with one query, many images share a camera.
+    intrinsics_by_camera = dict()
+    intrinsics_dict = dict()
+    for image_id, camera_id, params in db.execute(
+            "SELECT images.image_id, cameras.camera_id, cameras.params FROM images "
+            "JOIN cameras ON images.camera_id = cameras.camera_id"):
+        if camera_id not in intrinsics_by_camera:
+            intrinsics_by_camera[camera_id] = params_to_intrinsics(params)
+        intrinsics_dict[image_id] = intrinsics_by_camera[camera_id]
+    return intrinsics_dict
+
+
 def read_all_keypoints(db: COLMAPDatabase):
+    # np.frombuffer wraps the blobs without copying, the arrays are read-only.
     keypoints_dict = dict(
-        (image_id, blob_to_array(data, np.float32, (-1, 2)))
+        (image_id, np.frombuffer(data, np.float32).reshape(-1, 2))
         for image_id, data in db.execute(
             "SELECT image_id, data FROM keypoints"))
     return keypoints_dict
 
 
 def extract_inlier_keypoints_pair(inlier_matches, keypoints1, keypoints2):
-    inlier_keypoints1, inlier_keypoints2 = [], []
-    num_inliers = inlier_matches.shape[0]
-    for i in range(num_inliers):
-        idx = inlier_matches[i]
-        inlier_keypoints1.append(keypoints1[idx[0]])
-        inlier_keypoints2.append(keypoints2[idx[1]])
-    
-    inlier_keypoints1 = np.stack(inlier_keypoints1, axis=0)
-    inlier_keypoints2 = np.stack(inlier_keypoints2, axis=0)
+    inlier_keypoints1 = keypoints1[inlier_matches[:, 0]]
+    inlier_keypoints2 = keypoints2[inlier_matches[:, 1]]
     return inlier_keypoints1, inlier_keypoints2
 
 
@@ -86,32 +123,41 @@ def triangulate(inlier_keypoints1, inlier_keypoints2,
     return points3d
 
 
-def compute_depth(proj_matrix, point3d):
-    homo_point3d = np.ones(4)
-    homo_point3d[0:3] = point3d
-    proj_z = np.dot(proj_matrix[2, :].T, homo_point3d)
+def compute_depth(proj_matrix, points3d):
+    # Works on a single point of shape [3] as well as on [N, 3] points.
+    proj_z = np.dot(points3d, proj_matrix[2, :3]) + proj_matrix[2, 3]
     return proj_z * np.linalg.norm(proj_matrix[:, 2], ord=2)
 
 
-def check_cheirality(inlier_keypoints1, inlier_keypoints2,
-                     extrinsic1: np.ndarray, extrinsic2: np.ndarray,
-                     intrinsics1: np.ndarray, intrinsics2: np.ndarray):
+def check_cheirality(points3d, extrinsic1: np.ndarray, extrinsics2: np.ndarray):
+    """
+    Cheirality test of all candidates of the second camera at once.
+
+    Args:
+        points3d: [K, N, 3] points triangulated with each candidate
+        extrinsic1: 3 x 4 numpy array of the first camera
+        extrinsics2: [K, 3, 4] candidates of the second camera
+
+    Returns:
+        number of points in front of both cameras [K] and the masks [K, N]
+    """
     min_depth = 1e-16
+    # [K, 1, 1]
     max_depth = 1000 * np.linalg.norm(
-        np.dot(extrinsic2[:3, :3].T, extrinsic2[:, 3]), ord=2)
-    points3d = []
-
-    tmp_points3d = triangulate(inlier_keypoints1, inlier_keypoints2,
-                               extrinsic1, extrinsic2, intrinsics1, intrinsics2)
-    for point3d in tmp_points3d:
-        # Checking for positive depth in front of both cameras.
-        depth1 = compute_depth(extrinsic1, point3d)
-        if depth1 < max_depth and depth1 > min_depth:
-          depth2 = compute_depth(extrinsic2, point3d)
-          if depth2 < max_depth and depth2 > min_depth:
-            points3d.append(point3d)
-      
-    return points3d
+        np.einsum('kji,kj->ki', extrinsics2[:, :3, :3], extrinsics2[:, :, 3]),
+        ord=2, axis=-1)[:, None, None]
+
+    # [K, 2, 3, 4], both cameras of each candidate.
+    cameras = np.stack(
+        [np.broadcast_to(extrinsic1, extrinsics2.shape), extrinsics2], axis=1)
+    # Same as compute_depth(), for both cameras of all candidates with one einsum: [K, 2, N]
+    depths = np.einsum('knd,kcd->kcn', points3d, cameras[:, :, 2, :3]) + cameras[:, :, 2, 3:]
+    depths *= np.linalg.norm(cameras[:, :, :, 2], ord=2, axis=-1)[..., None]
+
+    # Checking for positive depth in front of both cameras.
+    masks = np.all((depths > min_depth) & (depths < max_depth), axis=1)
+
+    return masks.sum(axis=1), masks
 
 
 def decompose_essential_matrix(
@@ -140,14 +186,23 @@ def decompose_essential_matrix(
     # print(f'{inlier_keypoints1.shape}')
     # print(f'{inlier_keypoints2.shape}')
 
-    extrinsic1 = np.zeros(shape=[3, 4], dtype=np.float64)
-    extrinsic1[:3, :3] = np.eye(3)
-    # relative motion from camera1 to camera2.
-    extrinsics2 = np.zeros(shape=[3, 4], dtype=np.float64)
+    # extrinsics[0] is the first camera at [I|0], extrinsics[1:] are the four candidates
+    # of the second camera, all stored contiguously for batched products.
+    extrinsics = np.zeros(shape=[5, 3, 4], dtype=np.float64)
+    extrinsics[0, :3, :3] = np.eye(3)
+    extrinsic1, P2 = extrinsics[0], extrinsics[1:]
 
     W = np.zeros((3, 3))
     W[0, 1], W[1, 0], W[2, 2] = -1, 1, 1
-    U, _, Vh = np.linalg.svd(essential_matrix)
+    # SVD of E from the symmetric eigendecomposition of E E^T: U holds its eigenvectors,
+    # the singular values are the square roots of the eigenvalues (in descending order).
+    eigvals, U = np.linalg.eigh(np.dot(essential_matrix, essential_matrix.T))
+    U = U[:, ::-1]
+    singular_values = np.sqrt(np.maximum(eigvals[::-1][:2], 0.))
+    Vh = np.empty(shape=[3, 3], dtype=np.float64)
+    Vh[:2] = np.dot(U[:, :2].T, essential_matrix) / singular_values[:, None]
+    # E has rank 2, the last right singular vector spans its null space.
+    Vh[2] = np.cross(Vh[0], Vh[1])
 
     if np.linalg.det(U) < 0:
         U *= -1
@@ -158,34 +213,33 @@ def decompose_essential_matrix(
     t = U[:, 2]
     t /= np.linalg.norm(t, ord=2)
 
-    def compose_projection_matrix(R, t):
-        P = np.zeros(shape=[3, 4], dtype=float)
-        P[:3, :3], P[:, 3] = R, t
-        return P
+    # Generate candidate projection matrices: (R1, t), (R2, t), (R1, -t), (R2, -t).
+    P2[:, :3, :3] = np.stack([R1, R2, R1, R2], axis=0)
+    P2[:, :, 3] = np.stack([t, t, -t, -t], axis=0)
     
-    # Generate candidate projection matrices.
-    P2_list = []
-    P2_list.append(compose_projection_matrix(R1,  t))
-    P2_list.append(compose_projection_matrix(R2,  t))
-    P2_list.append(compose_projection_matrix(R1, -t))
-    P2_list.append(compose_projection_matrix(R2, -t))
-    
-    candidate_points3d, points3d = [], []
-    # Then, we need to iterate over each projection matrix and 
-    # make the cheirality validation.
-    for extrinsic2 in P2_list:
-        candidate_points3d = check_cheirality(
-            inlier_keypoints1, inlier_keypoints2,
-            extrinsic1, extrinsic2, intrinsics1, intrinsics2)
-        # print(f'len points3d: {len(points3d)}')
-        if len(points3d) < len(candidate_points3d):
-            points3d[:] = candidate_points3d
-            extrinsics2[:] = extrinsic2
-
-    # print(f'final len points3d: {len(points3d)}')
-    if len(points3d) == 0:
+    # Only the second projection matrix changes between the candidates.
+    proj_mtx1 = np.matmul(intrinsics1, extrinsic1)
+    proj_mtxs2 = np.matmul(intrinsics2, P2)
+    inlier_keypoints1_t = inlier_keypoints1.transpose(1, 0)
+    inlier_keypoints2_t = inlier_keypoints2.transpose(1, 0)
+
+    # OpenCV triangulates one pair of projection matrices per call, [4, 4, N].
+    candidate_points3d = np.stack([
+        cv2.triangulatePoints(proj_mtx1, proj_mtx2, inlier_keypoints1_t, inlier_keypoints2_t)
+        for proj_mtx2 in proj_mtxs2], axis=0)
+    # [4, N, 3]
+    candidate_points3d = candidate_points3d[:, :3].transpose(0, 2, 1) / candidate_points3d[:, 3, :, None]
+
+    # Then, the cheirality validation of all candidates at once. argmax keeps the
+    # first candidate on ties.
+    counts, masks = check_cheirality(candidate_points3d, extrinsic1, P2)
+    best = int(np.argmax(counts))
+    # print(f'final num points3d: {counts[best]}')
+    if counts[best] == 0:
         return None, None
     
-    points3d = np.stack(points3d, axis=0)
+    # Only the points of the winning candidate are materialized, with the
+    # relative motion from camera1 to camera2.
+    points3d = candidate_points3d[best][masks[best]]
 
-    return extrinsics2.reshape(1, -1), points3d
+    return P2[best].reshape(1, -1), points3d
@@ -1,6 +1,16 @@
+import os
+from importlib.metadata import version
 import random
 import numpy as np
 
+# Must be set before CUDA is initialized. The allocator keeps its cached blocks for
+# the whole run (the cache is never emptied), expandable segments keep the pool
+# from fragmenting between training and validation steps.
+# expandable_segments is only known to the allocator since PyTorch 2.1, older versions
+# fail on the first CUDA allocation with an unrecognized option, so it is not set there.
+if tuple(int(v) for v in version('torch').split('.')[:2]) >= (2, 1):
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+
 import torch
 import torch.utils.data.distributed
 
@@ -8,14 +18,14 @@ from dbarf.geometry.depth import inv2depth
 from dbarf.geometry.align_poses import align_ate_c2b_use_a2b
 from dbarf.model.dbarf import DBARFModel
 from dbarf.projection import Projector
-from dbarf.pose_util import Pose, rotation_distance
+from dbarf.pose_util import Pose, eye4, rotation_distance
 from dbarf.render_ray import render_rays
 from dbarf.render_image import render_single_image
 from dbarf.sample_ray import RaySamplerSingleImage
 from dbarf.visualization.pose_visualizer import visualize_cameras
 from dbarf.visualization.feature_visualizer import *
-from utils import img2mse, mse2psnr, img_HWC2CHW, colorize, img2psnr
-from train_ibrnet import IBRNetTrainer, synchronize
+from utils import mse2psnr, img_HWC2CHW, colorize, img2psnr
+from train_ibrnet import IBRNetTrainer, reduce_mean, write_view_images
 import dbarf.config as config
 
 # torch.autograd.set_detect_anomaly(True)
@@ -26,12 +36,17 @@ class DBARFTrainer(IBRNetTrainer):
         super().__init__(config)
         
         self.state = 'pose_only'
+        # Side stream for uploading the sampled rays while the default stream
+        # runs the feature network and the pose correction.
+        self.copy_stream = torch.cuda.Stream(device=self.device)
 
     def build_networks(self):
         self.model = DBARFModel(self.config,
                                 load_opt=not self.config.no_load_opt,
                                 load_scheduler=not self.config.no_load_scheduler,
                                 pretrained=self.config.pretrained)
+        if self.config.train_compile:
+            self.model.compile_networks()
 
         # create projector
         self.projector = Projector(device=self.device)
@@ -71,109 +86,148 @@ class DBARFTrainer(IBRNetTrainer):
         if self.iteration != 0 and self.iteration % 30000 == 0:
             self.state = self.model.switch_state_machine(state='joint')
 
-        images = torch.cat([data_batch['rgb'], data_batch['src_rgbs'].squeeze(0)], dim=0).cuda().permute(0, 3, 1, 2)
-        all_feat_maps = self.model.feature_net(images)
+        # load training rays, the rays do not depend on the networks so they are sampled
+        # first and their copies overlap with the kernels launched below.
+        ray_sampler = RaySamplerSingleImage(data_batch, self.device)
+        N_rand = int(1.0 * args.N_rand * args.num_source_views / data_batch['src_rgbs'][0].shape[0])
 
-        feat_maps = (all_feat_maps[0][1:, :32, ...], None) if args.coarse_only else \
-                    (all_feat_maps[0][1:, :32, ...], all_feat_maps[1][1:, ...])
+        # The batch is pinned by the data loader, so the copies are asynchronous and
+        # the images are concatenated on the device. The uploads are reused below,
+        # the source images also by the ray batch.
+        target_image = data_batch['rgb'].to(self.device, non_blocking=True)
+        ref_imgs = data_batch['src_rgbs'].to(self.device, non_blocking=True)
+
+        self.copy_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.copy_stream):
+            ray_batch = ray_sampler.random_sample(N_rand,
+                                                  sample_mode=args.sample_mode,
+                                                  center_ratio=args.center_ratio,
+                                                  tile_size=args.tile_size,
+                                                  src_rgbs=ref_imgs,
+                                                  )
+
+        # Only the last view of an accumulation window all-reduces the gradients.
+        with self.model.no_sync(enabled=not self.is_accumulation_end()):
+            images = torch.cat([target_image, ref_imgs.squeeze(0)], dim=0).permute(0, 3, 1, 2)
+            # NHWC lets cuDNN pick channels-last convolution kernels.
+            images = images.contiguous(memory_format=torch.channels_last)
+
+            min_depth, max_depth = data_batch['depth_range'][0][0], data_batch['depth_range'][0][1]
+
+            # bfloat16 has the range of float32, so no loss scaling is needed.
+            with torch.autocast('cuda', dtype=torch.bfloat16, enabled=args.train_bf16):
+                all_feat_maps = self.model.feature_net(images)
+                pose_feats = all_feat_maps[0]
+
+                # Start of core optimization loop
+                pred_inv_depths, pred_rel_poses, sfm_loss, fmap = self.model.correct_poses(
+                    fmaps=pose_feats,
+                    target_image=target_image,
+                    ref_imgs=ref_imgs,
+                    target_camera=data_batch['camera'],
+                    ref_cameras=data_batch['src_cameras'],
+                    min_depth=min_depth,
+                    max_depth=max_depth,
+                    scaled_shape=data_batch['scaled_shape'])
+
+            if args.train_bf16:
+                # The rendering and the pose math stay in float32.
+                all_feat_maps = [feat_map.float() for feat_map in all_feat_maps]
+                pred_inv_depths = [pred_inv_depth.float() for pred_inv_depth in pred_inv_depths]
+                pred_rel_poses = pred_rel_poses.float()
+
+            feat_maps = (all_feat_maps[0][1:, :32, ...], None) if args.coarse_only else \
+                        (all_feat_maps[0][1:, :32, ...], all_feat_maps[1][1:, ...])
+
+            # The rays were uploaded on the copy stream, the tensors are now used on the default stream.
+            torch.cuda.current_stream().wait_stream(self.copy_stream)
+            for value in ray_batch.values():
+                if torch.is_tensor(value) and value.is_cuda:
+                    value.record_stream(torch.cuda.current_stream())
+
+            # The predicted inverse depth is used as a weak supervision to NeRF.
+            self.pred_inv_depth = pred_inv_depths[-1]
+            inv_depth_prior = pred_inv_depths[-1].detach().clone()
+            inv_depth_prior = inv_depth_prior.reshape(-1, 1)[ray_batch['selected_inds']]
+
+            ret = render_rays(ray_batch=ray_batch,
+                              model=self.model,
+                              projector=self.projector,
+                              feat_maps=feat_maps,
+                              N_samples=args.N_samples,
+                              inv_uniform=args.inv_uniform,
+                              N_importance=args.N_importance,
+                              det=args.det,
+                              white_bkgd=args.white_bkgd,
+                              inv_depth_prior=None, #inv_depth_prior, # TODO(chenyu): enabling the adaptive sampling when well tuned
+                              rel_poses=pred_rel_poses[:, -1, :],
+                              fine_inv_depth_prior=inv_depth_prior if args.depth_guided_sampling else None)
 
-        pose_feats = all_feat_maps[0]
+            loss_all = 0
+            loss_dict = {}
 
-        min_depth, max_depth = data_batch['depth_range'][0][0], data_batch['depth_range'][0][1]
+            # rendered_depth = ret['outputs_coarse']['depth']
+            # loss_depth = self_sup_depth_loss(inv_depth_prior, rendered_depth, min_depth, max_depth)
+            # scalars_to_log['loss/self-sup-depth'] = loss_depth
 
-        # Start of core optimization loop
-        pred_inv_depths, pred_rel_poses, sfm_loss, fmap = self.model.correct_poses(
-            fmaps=pose_feats,
-            target_image=data_batch['rgb'].cuda(),
-            ref_imgs=data_batch['src_rgbs'].cuda(),
-            target_camera=data_batch['camera'],
-            ref_cameras=data_batch['src_cameras'],
-            min_depth=min_depth,
-            max_depth=max_depth,
-            scaled_shape=data_batch['scaled_shape'])
+            # compute loss
+            if self.is_accumulation_start():
+                self.optimizer.zero_grad(set_to_none=True)
+                self.pose_optimizer.zero_grad(set_to_none=True)
 
-        # load training rays
-        ray_sampler = RaySamplerSingleImage(data_batch, self.device)
-        N_rand = int(1.0 * args.N_rand * args.num_source_views / data_batch['src_rgbs'][0].shape[0])
+            if self.state == 'pose_only' or self.state == 'joint':
+                loss_dict['sfm_loss'] = sfm_loss['loss']
+                self.scalars_to_log['loss/photometric_loss'] = sfm_loss['metrics']['photometric_loss']
+                if 'smoothness_loss' in sfm_loss['metrics']:
+                    self.scalars_to_log['loss/smoothness_loss'] = sfm_loss['metrics']['smoothness_loss']
+
+            # The unmasked mses for logging come with the losses, coarse first.
+            if ret['outputs_fine'] is not None:
+                (coarse_loss, fine_loss), mse_errors = self.rgb_loss.forward_pair(
+                    ret['outputs_coarse'], ret['outputs_fine'], ray_batch)
+            else:
+                coarse_loss, mse_errors = self.rgb_loss(ret['outputs_coarse'], ray_batch)
+                mse_errors = mse_errors[None]
 
-        ray_batch = ray_sampler.random_sample(N_rand,
-                                              sample_mode=args.sample_mode,
-                                              center_ratio=args.center_ratio,
-                                              )
-
-        # The predicted inverse depth is used as a weak supervision to NeRF.
-        self.pred_inv_depth = pred_inv_depths[-1]
-        inv_depth_prior = pred_inv_depths[-1].detach().clone()
-        inv_depth_prior = inv_depth_prior.reshape(-1, 1)[ray_batch['selected_inds']]
-
-        ret = render_rays(ray_batch=ray_batch,
-                          model=self.model,
-                          projector=self.projector,
-                          feat_maps=feat_maps,
-                          N_samples=args.N_samples,
-                          inv_uniform=args.inv_uniform,
-                          N_importance=args.N_importance,
-                          det=args.det,
-                          white_bkgd=args.white_bkgd,
-                          inv_depth_prior=None, #inv_depth_prior, # TODO(chenyu): enabling the adaptive sampling when well tuned
-                          rel_poses=pred_rel_poses[:, -1, :])
-
-        loss_all = 0
-        loss_dict = {}
-
-        # rendered_depth = ret['outputs_coarse']['depth']
-        # loss_depth = self_sup_depth_loss(inv_depth_prior, rendered_depth, min_depth, max_depth)
-        # scalars_to_log['loss/self-sup-depth'] = loss_depth
-
-        # compute loss
-        self.optimizer.zero_grad()
-        self.pose_optimizer.zero_grad()
-
-        if self.state == 'pose_only' or self.state == 'joint':
-            loss_dict['sfm_loss'] = sfm_loss['loss']
-            self.scalars_to_log['loss/photometric_loss'] = sfm_loss['metrics']['photometric_loss']
-            if 'smoothness_loss' in sfm_loss['metrics']:
-                self.scalars_to_log['loss/smoothness_loss'] = sfm_loss['metrics']['smoothness_loss']
-
-        coarse_loss = self.rgb_loss(ret['outputs_coarse'], ray_batch)
-        if ret['outputs_fine'] is not None:
-            fine_loss = self.rgb_loss(ret['outputs_fine'], ray_batch)
-
-        loss_dict['nerf_loss'] = coarse_loss
-        if ret['outputs_fine'] is not None:
-            loss_dict['nerf_loss'] += fine_loss
+            loss_dict['nerf_loss'] = coarse_loss
+            if ret['outputs_fine'] is not None:
+                loss_dict['nerf_loss'] = loss_dict['nerf_loss'] + fine_loss
             
-        if self.state == 'joint':
-            # loss_all += loss_depth.item()
-            loss_all += self.model.compose_joint_loss(
-                loss_dict['sfm_loss'], loss_dict['nerf_loss'], self.iteration)
-        elif self.state == 'pose_only':
-            loss_all += loss_dict['sfm_loss']
-        else: # nerf_only
-            # loss_all += loss_depth.item()
-            loss_all += loss_dict['nerf_loss']
-
-        # with torch.autograd.detect_anomaly():
-        loss_all.backward()
-
-        if self.state == 'pose_only' or self.state == 'joint':
-            self.pose_optimizer.step()
-            self.pose_scheduler.step()
-
-        if self.state == 'nerf_only' or self.state == 'joint':
-            self.optimizer.step()
-            self.scheduler.step()
+            if self.state == 'joint':
+                # loss_all += loss_depth.item()
+                loss_all += self.model.compose_joint_loss(
+                    loss_dict['sfm_loss'], loss_dict['nerf_loss'], self.iteration)
+            elif self.state == 'pose_only':
+                loss_all += loss_dict['sfm_loss']
+            else: # nerf_only
+                # loss_all += loss_depth.item()
+                loss_all += loss_dict['nerf_loss']
+
+            # with torch.autograd.detect_anomaly():
+            (loss_all / self.config.accum_views).backward()
+
+        if self.is_accumulation_end():
+            if self.state == 'pose_only' or self.state == 'joint':
+                self.pose_optimizer.step()
+                self.pose_scheduler.step()
+
+            if self.state == 'nerf_only' or self.state == 'joint':
+                self.optimizer.step()
+                self.scheduler.step()
+
+        # The loss is only synchronized to the host on logging steps.
+        if self.iteration % self.config.n_tensorboard == 0:
+            loss_all = reduce_mean(loss_all)
 
         if self.config.local_rank == 0 and self.iteration % self.config.n_tensorboard == 0:
-            mse_error = img2mse(ret['outputs_coarse']['rgb'], ray_batch['rgb']).item()
-            self.scalars_to_log['train/coarse-loss'] = mse_error
-            self.scalars_to_log['train/coarse-psnr-training-batch'] = mse2psnr(mse_error)
+            mse_errors = mse_errors.tolist()
+            self.scalars_to_log['train/coarse-loss'] = mse_errors[0]
+            self.scalars_to_log['train/coarse-psnr-training-batch'] = mse2psnr(mse_errors[0])
             self.scalars_to_log['loss/final'] = loss_all.item()
             self.scalars_to_log['loss/rgb_coarse'] = coarse_loss
             if ret['outputs_fine'] is not None:
-                mse_error = img2mse(ret['outputs_fine']['rgb'], ray_batch['rgb']).item()
-                self.scalars_to_log['train/fine-loss'] = mse_error
-                self.scalars_to_log['train/fine-psnr-training-batch'] = mse2psnr(mse_error)
+                self.scalars_to_log['train/fine-loss'] = mse_errors[1]
+                self.scalars_to_log['train/fine-psnr-training-batch'] = mse2psnr(mse_errors[1])
                 self.scalars_to_log['loss/rgb_fine'] = fine_loss
             
             self.scalars_to_log['lr/IBRNet'] = self.scheduler.get_last_lr()[0]
@@ -196,7 +250,7 @@ class DBARFTrainer(IBRNetTrainer):
         pred_inv_depth_gray = self.pred_inv_depth.squeeze(0).detach().cpu()
         pred_inv_depth = self.pred_inv_depth.squeeze(0).squeeze(0)
         pred_depth= inv2depth(pred_inv_depth)
-        pred_depth_color = colorize(pred_depth.detach().cpu(), cmap_name='jet', append_cbar=True).permute(2, 0, 1)
+        pred_depth_color = colorize(pred_depth.detach(), cmap_name='jet', append_cbar=True).permute(2, 0, 1)
 
         self.writer.add_image('train/target_image', target_image, self.iteration)
         self.writer.add_image('train/pred_inv_depth', pred_inv_depth_gray, self.iteration)
@@ -212,16 +266,16 @@ class DBARFTrainer(IBRNetTrainer):
         score = log_view_to_tb(
             self.writer, self.iteration, self.config, self.model, tmp_ray_sampler, self.projector,
             gt_img, render_stride=self.config.render_stride, prefix='val/',
-            data=val_data, dataset=self.val_dataset)
+            data=val_data, dataset=self.val_dataset, image_logger=self.image_logger)
 
         # Logging current training view.
         tmp_ray_train_sampler = RaySamplerSingleImage(self.train_data, self.device, render_stride=1)
         H, W = tmp_ray_train_sampler.H, tmp_ray_train_sampler.W
         gt_img = tmp_ray_train_sampler.rgb.reshape(H, W, 3)
         log_view_to_tb(self.writer, self.iteration, self.config, self.model, tmp_ray_train_sampler, self.projector,
-                       gt_img, render_stride=1, prefix='train/', data=self.train_data, dataset=self.train_dataset)
+                       gt_img, render_stride=1, prefix='train/', data=self.train_data, dataset=self.train_dataset,
+                       image_logger=self.image_logger)
 
-        torch.cuda.empty_cache()
         self.model.switch_to_train()
 
         return score
@@ -229,23 +283,25 @@ class DBARFTrainer(IBRNetTrainer):
 
 @torch.no_grad()
 def get_predicted_training_poses(pred_poses):
-    target_pose = torch.eye(4, device=pred_poses.device, dtype=torch.float).repeat(1, 1, 1)
+    target_pose = eye4(pred_poses.device, torch.float)[None]
 
     # World->camera poses.
     pred_poses = Pose.from_vec(pred_poses) # [n_views, 4, 4]
-    pred_poses = torch.cat([target_pose, pred_poses], dim=0)
 
-    # Convert camera poses to camera->world.
-    pred_poses = pred_poses.inverse()
+    # Convert camera poses to camera->world. The rigid transforms are inverted
+    # in closed form, the identity target pose is its own inverse.
+    pred_poses = torch.cat([Pose().invert(pred_poses[:, :3]), pred_poses[:, 3:]], dim=1)
+    pred_poses = torch.cat([target_pose, pred_poses], dim=0)
 
     return pred_poses
 
 
 @torch.no_grad()
 def align_predicted_training_poses(pred_poses, data, dataset, device):
-    target_pose_gt = data['camera'][..., -16:].reshape(1, 4, 4)
-    src_poses_gt = data['src_cameras'][..., -16:].reshape(-1, 4, 4)
-    poses_gt = torch.cat([target_pose_gt, src_poses_gt], dim=0).to(device).float()
+    # Target and source camera rows are joined on the (pinned) host side and the
+    # poses are uploaded with one asynchronous copy, already as float32.
+    cameras = torch.cat([data['camera'], data['src_cameras'][0]], dim=0)
+    poses_gt = cameras[:, -16:].reshape(-1, 4, 4).to(device, torch.float32, non_blocking=True)
     
     pred_poses = get_predicted_training_poses(pred_poses)
 
@@ -263,10 +319,11 @@ def evaluate_camera_alignment(aligned_pred_poses, poses_gt):
     R_error = rotation_distance(R_aligned[..., :3, :3], R_gt[..., :3, :3])
     t_error = (t_aligned - t_gt)[..., 0].norm(dim=-1)
     
-    mean_rotation_error = np.rad2deg(R_error.mean().cpu())
-    mean_position_error = t_error.mean()
-    med_rotation_error = np.rad2deg(R_error.median().cpu())
-    med_position_error = t_error.median()
+    # All statistics are fetched from the device with a single copy.
+    mean_rotation_error, med_rotation_error, mean_position_error, med_position_error = torch.stack(
+        [R_error.mean(), R_error.median(), t_error.mean(), t_error.median()]).cpu().numpy()
+    mean_rotation_error = np.rad2deg(mean_rotation_error)
+    med_rotation_error = np.rad2deg(med_rotation_error)
     
     return {'R_error_mean': mean_rotation_error, "t_error_mean": mean_position_error,
             'R_error_med': med_rotation_error, 't_error_med': med_position_error}
@@ -274,7 +331,7 @@ def evaluate_camera_alignment(aligned_pred_poses, poses_gt):
 
 @torch.no_grad()
 def log_view_to_tb(writer, global_step, args, model, ray_sampler, projector, gt_img,
-                   render_stride=1, prefix='', data=None, dataset=None) -> float:
+                   render_stride=1, prefix='', data=None, dataset=None, image_logger=None) -> float:
     # with torch.no_grad():
     ray_batch = ray_sampler.get_all()
     if model.feature_net is not None:
@@ -297,10 +354,14 @@ def log_view_to_tb(writer, global_step, args, model, ray_sampler, projector, gt_
                             max_depth=data['depth_range'][0][1],
                             scaled_shape=data['scaled_shape'])
     inv_depth_prior = pred_inv_depth.reshape(-1, 1).detach().clone()
+    fine_inv_depth_prior = None
+    if args.depth_guided_sampling:
+        fine_inv_depth_prior = pred_inv_depth.detach().reshape(ray_sampler.H, ray_sampler.W)
+        fine_inv_depth_prior = fine_inv_depth_prior[::render_stride, ::render_stride].reshape(-1, 1)
 
     if prefix == 'val/':
         pred_inv_depth = pred_inv_depth.squeeze(0).squeeze(0)
-        pred_inv_depth = colorize(pred_inv_depth.detach().cpu(), cmap_name='jet', append_cbar=True).permute(2, 0, 1)
+        pred_inv_depth = colorize(pred_inv_depth.detach(), cmap_name='jet', append_cbar=True).permute(2, 0, 1)
         writer.add_image(prefix + 'pred_inv_depth', pred_inv_depth, global_step)
         aligned_pred_poses, poses_gt = align_predicted_training_poses(pred_rel_poses, data, dataset, args.local_rank)
         pose_error = evaluate_camera_alignment(aligned_pred_poses, poses_gt)
@@ -321,46 +382,34 @@ def log_view_to_tb(writer, global_step, args, model, ray_sampler, projector, gt_
                               white_bkgd=args.white_bkgd,
                               render_stride=render_stride,
                               inv_depth_prior=None, #inv_depth_prior, # TODO(chenyu): enabling the adaptive sampling when well tuned
-                              feat_maps=feat_maps)
+                              feat_maps=feat_maps,
+                              fine_inv_depth_prior=fine_inv_depth_prior)
 
-    average_im = ray_sampler.src_rgbs.cpu().mean(dim=(0, 1))
+    # The source images are already on the device, only the strided mean is copied back.
+    average_im = ray_batch['src_rgbs'].mean(dim=(0, 1))
 
     if args.render_stride != 1:
         gt_img = gt_img[::render_stride, ::render_stride]
         average_im = average_im[::render_stride, ::render_stride]
 
     rgb_gt = img_HWC2CHW(gt_img)
-    average_im = img_HWC2CHW(average_im)
+    average_im = img_HWC2CHW(average_im.cpu())
 
     rgb_pred = img_HWC2CHW(ret['outputs_coarse']['rgb'].detach().cpu())
 
-    h_max = max(rgb_gt.shape[-2], rgb_pred.shape[-2], average_im.shape[-2])
-    w_max = max(rgb_gt.shape[-1], rgb_pred.shape[-1], average_im.shape[-1])
-    rgb_im = torch.zeros(3, h_max, 3*w_max)
-    rgb_im[:, :average_im.shape[-2], :average_im.shape[-1]] = average_im
-    rgb_im[:, :rgb_gt.shape[-2], w_max:w_max+rgb_gt.shape[-1]] = rgb_gt
-    rgb_im[:, :rgb_pred.shape[-2], 2*w_max:2*w_max+rgb_pred.shape[-1]] = rgb_pred
-
-    depth_im = ret['outputs_coarse']['depth'].detach().cpu()
-    acc_map = torch.sum(ret['outputs_coarse']['weights'], dim=-1).detach().cpu()
-
-    if ret['outputs_fine'] is None:
-        depth_im = img_HWC2CHW(colorize(depth_im, cmap_name='jet', append_cbar=True))
-        acc_map = img_HWC2CHW(colorize(acc_map, range=(0., 1.), cmap_name='jet', append_cbar=False))
+    # average | gt | coarse (| fine)
+    panels = [average_im, rgb_gt, rgb_pred]
+    depth_maps = [ret['outputs_coarse']['depth'].detach().cpu()]
+    acc_maps = [torch.sum(ret['outputs_coarse']['weights'], dim=-1).detach().cpu()]
+    if ret['outputs_fine'] is not None:
+        panels.append(img_HWC2CHW(ret['outputs_fine']['rgb'].detach().cpu()))
+        depth_maps.append(ret['outputs_fine']['depth'].detach().cpu())
+        acc_maps.append(torch.sum(ret['outputs_fine']['weights'], dim=-1).detach().cpu())
+
+    if image_logger is not None:
+        image_logger.log(writer, global_step, prefix, panels, depth_maps, acc_maps)
     else:
-        rgb_fine = img_HWC2CHW(ret['outputs_fine']['rgb'].detach().cpu())
-        rgb_fine_ = torch.zeros(3, h_max, w_max)
-        rgb_fine_[:, :rgb_fine.shape[-2], :rgb_fine.shape[-1]] = rgb_fine
-        rgb_im = torch.cat((rgb_im, rgb_fine_), dim=-1)
-        depth_im = torch.cat((depth_im, ret['outputs_fine']['depth'].detach().cpu()), dim=-1)
-        depth_im = img_HWC2CHW(colorize(depth_im, cmap_name='jet', append_cbar=True))
-        acc_map = torch.cat((acc_map, torch.sum(ret['outputs_fine']['weights'], dim=-1).detach().cpu()), dim=-1)
-        acc_map = img_HWC2CHW(colorize(acc_map, range=(0., 1.), cmap_name='jet', append_cbar=False))
-
-    # write the pred/gt rgb images and depths
-    writer.add_image(prefix + 'rgb_gt-coarse-fine', rgb_im, global_step)
-    writer.add_image(prefix + 'depth_gt-coarse-fine', depth_im, global_step)
-    writer.add_image(prefix + 'acc-coarse-fine', acc_map, global_step)
+        write_view_images(writer, global_step, prefix, panels, depth_maps, acc_maps)
 
     # plot_feature_map(writer, global_step, ray_sampler, feat_maps, prefix)
 
@@ -389,11 +438,17 @@ if __name__ == '__main__':
     torch.cuda.manual_seed(args.seed)
     torch.cuda.manual_seed_all(args.seed)
 
+    # Image sizes are fixed per dataset, so cuDNN benchmarks each conv shape only once.
+    torch.backends.cudnn.benchmark = not args.deterministic
+    torch.backends.cudnn.deterministic = args.deterministic
+    torch.backends.cuda.matmul.allow_tf32 = not args.deterministic
+    torch.backends.cudnn.allow_tf32 = not args.deterministic
+
     # Configuration for distributed training.
     if args.distributed:
         torch.cuda.set_device(args.local_rank)
+        # init_process_group already waits for all ranks, no extra barrier is needed.
         torch.distributed.init_process_group(backend="nccl", init_method="env://")
-        synchronize()
         print(f'[INFO] Train in distributed mode')
 
     train(args)
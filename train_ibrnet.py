@@ -1,7 +1,15 @@
 import os
-import time
-import numpy as np
-import shutil
+from importlib.metadata import version
+
+# Must be set before CUDA is initialized. The allocator keeps its cached blocks for
+# the whole run (the cache is never emptied), expandable segments keep the pool
+# from fragmenting between training and validation steps.
+# expandable_segments is only known to the allocator since PyTorch 2.1, older versions
+# fail on the first CUDA allocation with an unrecognized option, so it is not set there.
+if tuple(int(v) for v in version('torch').split('.')[:2]) >= (2, 1):
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import torch.utils.data.distributed
@@ -14,27 +22,26 @@ from dbarf.model.ibrnet import IBRNetModel
 from dbarf.sample_ray import RaySamplerSingleImage
 from dbarf.loss.criterion import MaskedL2ImageLoss
 from dbarf.projection import Projector
-from utils import img2mse, mse2psnr, img_HWC2CHW, colorize, img2psnr
+from utils import mse2psnr, img_HWC2CHW, colorize, img2psnr
 import dbarf.config as config
 
 
-def synchronize():
+def reduce_mean(tensor):
     """
-    Helper function to synchronize (barrier) among all processes when
-    using distributed training
+    Mean of a (detached) tensor over all processes. It is a collective operation,
+    so every rank has to call it.
     """
-    if not dist.is_available():
-        return
-    if not dist.is_initialized():
-        return
-    world_size = dist.get_world_size()
-    if world_size == 1:
-        return
-    dist.barrier()
+    tensor = tensor.detach().clone()
+    if not dist.is_available() or not dist.is_initialized():
+        return tensor
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor / dist.get_world_size()
 
 
 class IBRNetTrainer(BaseTrainer):
     def __init__(self, config) -> None:
+        # Created first, finish_logging() is called even if the setup fails.
+        self.image_logger = ViewImageLogger()
         super().__init__(config)
 
     def build_networks(self):
@@ -43,33 +50,27 @@ class IBRNetTrainer(BaseTrainer):
                                  load_opt=not self.config.no_load_opt,
                                  load_scheduler=not self.config.no_load_scheduler
                                 )
+        if self.config.train_compile:
+            self.model.compile_networks()
 
         # create projector
         self.projector = Projector(device=self.device)
 
     def setup_optimizer(self):
         # optimizer and learning rate scheduler
-        learnable_params = list(self.model.net_coarse.parameters())
-        learnable_params += list(self.model.feature_net.parameters())
-        if self.model.net_fine is not None:
-            learnable_params += list(self.model.net_fine.parameters())
-
+        param_groups = [{'params': self.model.net_coarse.parameters()}]
         if self.model.net_fine is not None:
-            self.optimizer = torch.optim.Adam([
-                {'params': self.model.net_coarse.parameters()},
-                {'params': self.model.net_fine.parameters()},
-                {'params': self.model.feature_net.parameters(), 'lr': self.config.lrate_feature}],
-                lr=self.config.lrate_mlp)
-        else:
-            self.optimizer = torch.optim.Adam([
-                {'params': self.model.net_coarse.parameters()},
-                {'params': self.model.feature_net.parameters(), 'lr': self.config.lrate_feature}],
-                lr=self.config.lrate_mlp)
+            param_groups.append({'params': self.model.net_fine.parameters()})
+        param_groups.append({'params': self.model.feature_net.parameters(), 'lr': self.config.lrate_feature})
+        self.optimizer = torch.optim.Adam(param_groups, lr=self.config.lrate_mlp)
 
         self.scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer,
                                                          step_size=self.config.lrate_decay_steps,
                                                          gamma=self.config.lrate_decay_factor)
 
+        # A no-op unless training in float16, whose gradients need loss scaling.
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.config.train_fp16)
+
     def setup_loss_functions(self):
         self.rgb_loss = MaskedL2ImageLoss()
 
@@ -84,6 +85,14 @@ class IBRNetTrainer(BaseTrainer):
         self.state_dicts['optimizers']['optimizer'] = self.optimizer
         self.state_dicts['schedulers']['scheduler'] = self.scheduler
 
+    def is_accumulation_start(self) -> bool:
+        # Gradients of accum_views consecutive iterations (one target view each)
+        # are accumulated, the optimizers only step at the last one.
+        return self.iteration % self.config.accum_views == 0
+
+    def is_accumulation_end(self) -> bool:
+        return (self.iteration + 1) % self.config.accum_views == 0
+
     def train_iteration(self, data_batch) -> None:
         # load training rays
         ray_sampler = RaySamplerSingleImage(data_batch, self.device)
@@ -92,44 +101,57 @@ class IBRNetTrainer(BaseTrainer):
         ray_batch = ray_sampler.random_sample(N_rand,
                                               sample_mode=self.config.sample_mode,
                                               center_ratio=self.config.center_ratio,
+                                              tile_size=self.config.tile_size,
                                               )
 
-        feat_maps = self.model.feature_net(ray_batch['src_rgbs'].squeeze(0).permute(0, 3, 1, 2))
-
-        ret = render_rays(ray_batch=ray_batch,
-                          model=self.model,
-                          projector=self.projector,
-                          feat_maps=feat_maps,
-                          N_samples=self.config.N_samples,
-                          inv_uniform=self.config.inv_uniform,
-                          N_importance=self.config.N_importance,
-                          det=self.config.det,
-                          white_bkgd=self.config.white_bkgd)
-
-        # compute loss
-        self.optimizer.zero_grad()
-        loss = self.rgb_loss(ret['outputs_coarse'], ray_batch)
-
-        if ret['outputs_fine'] is not None:
-            fine_loss = self.rgb_loss(ret['outputs_fine'], ray_batch)
-            loss += fine_loss
-
-        loss.backward()
-        self.scalars_to_log['loss'] = loss.item()
-
-        self.optimizer.step()
-        self.scheduler.step()
+        # Only the last view of an accumulation window all-reduces the gradients.
+        with self.model.no_sync(enabled=not self.is_accumulation_end()):
+            # The projection geometry inside render_rays stays in float32, see Projector.
+            with torch.autocast('cuda', dtype=torch.float16, enabled=self.config.train_fp16):
+                feat_maps = self.model.feature_net(ray_batch['src_rgbs'].squeeze(0).permute(0, 3, 1, 2))
+
+                ret = render_rays(ray_batch=ray_batch,
+                                  model=self.model,
+                                  projector=self.projector,
+                                  feat_maps=feat_maps,
+                                  N_samples=self.config.N_samples,
+                                  inv_uniform=self.config.inv_uniform,
+                                  N_importance=self.config.N_importance,
+                                  det=self.config.det,
+                                  white_bkgd=self.config.white_bkgd)
+
+                # compute loss
+                if self.is_accumulation_start():
+                    self.optimizer.zero_grad(set_to_none=True)
+                # The unmasked mses for logging come with the losses, coarse first.
+                if ret['outputs_fine'] is not None:
+                    losses, mse_errors = self.rgb_loss.forward_pair(ret['outputs_coarse'], ret['outputs_fine'], ray_batch)
+                    loss = losses.sum()
+                else:
+                    loss, mse_errors = self.rgb_loss(ret['outputs_coarse'], ray_batch)
+                    mse_errors = mse_errors[None]
+
+            self.scaler.scale(loss / self.config.accum_views).backward()
+
+        if self.is_accumulation_end():
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            self.scheduler.step()
 
         self.scalars_to_log['lr'] = self.scheduler.get_last_lr()[0]
 
+        # The loss is only synchronized to the host on logging steps.
+        if self.iteration % self.config.n_tensorboard == 0:
+            loss = reduce_mean(loss)
+
         if self.config.local_rank == 0 and self.iteration % self.config.n_tensorboard == 0:
-            mse_error = img2mse(ret['outputs_coarse']['rgb'], ray_batch['rgb']).item()
-            self.scalars_to_log['train/coarse-loss'] = mse_error
-            self.scalars_to_log['train/coarse-psnr-training-batch'] = mse2psnr(mse_error)
+            self.scalars_to_log['loss'] = loss.item()
+            mse_errors = mse_errors.tolist()
+            self.scalars_to_log['train/coarse-loss'] = mse_errors[0]
+            self.scalars_to_log['train/coarse-psnr-training-batch'] = mse2psnr(mse_errors[0])
             if ret['outputs_fine'] is not None:
-                mse_error = img2mse(ret['outputs_fine']['rgb'], ray_batch['rgb']).item()
-                self.scalars_to_log['train/fine-loss'] = mse_error
-                self.scalars_to_log['train/fine-psnr-training-batch'] = mse2psnr(mse_error)
+                self.scalars_to_log['train/fine-loss'] = mse_errors[1]
+                self.scalars_to_log['train/fine-psnr-training-batch'] = mse2psnr(mse_errors[1])
 
     def validate(self) -> float:
         # print('[INFO] Logging a random validation view...')
@@ -140,8 +162,8 @@ class IBRNetTrainer(BaseTrainer):
         H, W = tmp_ray_sampler.H, tmp_ray_sampler.W
         gt_img = tmp_ray_sampler.rgb.reshape(H, W, 3)
         score = log_view_to_tb(self.writer, self.iteration, args, self.model, tmp_ray_sampler, self.projector,
-                               gt_img, render_stride=args.render_stride, prefix='val/')
-        torch.cuda.empty_cache()
+                               gt_img, render_stride=args.render_stride, prefix='val/',
+                               image_logger=self.image_logger)
 
         # print('[INFO] Logging current training view...')
         tmp_ray_train_sampler = RaySamplerSingleImage(self.train_data, self.device, render_stride=1)
@@ -149,15 +171,85 @@ class IBRNetTrainer(BaseTrainer):
         gt_img = tmp_ray_train_sampler.rgb.reshape(H, W, 3)
         log_view_to_tb(self.writer, self.iteration, args, self.model,
                        tmp_ray_train_sampler, self.projector,
-                       gt_img, render_stride=1, prefix='train/')
+                       gt_img, render_stride=1, prefix='train/', image_logger=self.image_logger)
 
         self.model.switch_to_train()
         return score
 
+    def finish_logging(self) -> None:
+        self.image_logger.close()
+
+
+# Mosaic buffers of log_view_to_tb, reused across logging steps for each size.
+_mosaic_buffers = dict()
+
+
+def compose_mosaic(panels):
+    """
+    Place [3, h, w] panels side by side into a [3, h_max, n * w_max] image. The
+    buffer is reused, it is overwritten by the next call of the same size.
+    """
+    h_max = max(panel.shape[-2] for panel in panels)
+    w_max = max(panel.shape[-1] for panel in panels)
+    shape = (3, h_max, len(panels) * w_max)
+    if shape not in _mosaic_buffers:
+        _mosaic_buffers[shape] = torch.empty(shape)
+    mosaic = _mosaic_buffers[shape]
+
+    # No padding has to be cleared when all panels have the same size.
+    if any(panel.shape[-2:] != (h_max, w_max) for panel in panels):
+        mosaic.zero_()
+    for i, panel in enumerate(panels):
+        mosaic[:, :panel.shape[-2], i*w_max:i*w_max+panel.shape[-1]] = panel
+
+    return mosaic
+
+
+def write_view_images(writer, global_step, prefix, panels, depth_maps, acc_maps):
+    """
+    Write the RGB mosaic and the colorized depth/accumulation maps of a rendered
+    view to tensorboard. All tensors must be on the CPU.
+    """
+    rgb_im = compose_mosaic(panels)
+    depth_im = img_HWC2CHW(colorize(torch.cat(depth_maps, dim=-1), cmap_name='jet', append_cbar=True))
+    acc_map = img_HWC2CHW(colorize(torch.cat(acc_maps, dim=-1), range=(0., 1.), cmap_name='jet', append_cbar=False))
+
+    # write the pred/gt rgb images and depths
+    writer.add_image(prefix + 'rgb_gt-coarse-fine', rgb_im, global_step)
+    writer.add_image(prefix + 'depth_gt-coarse-fine', depth_im, global_step)
+    writer.add_image(prefix + 'acc-coarse-fine', acc_map, global_step)
+
+
+class ViewImageLogger(object):
+    """
+    Run write_view_images() on a background thread, so training resumes once a view
+    is rendered. One job runs at a time (the mosaic buffers are shared), an error of
+    a job is raised by the next log() or by close().
+    """
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+
+    def wait(self):
+        future, self.future = self.future, None
+        if future is not None:
+            future.result()
+
+    def log(self, writer, global_step, prefix, panels, depth_maps, acc_maps):
+        self.wait()
+        self.future = self.executor.submit(write_view_images, writer, global_step, prefix,
+                                           panels, depth_maps, acc_maps)
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown(wait=True)
+
 
 @torch.no_grad()
 def log_view_to_tb(writer, global_step, args, model, ray_sampler, projector, gt_img,
-                   render_stride=1, prefix='') -> float:
+                   render_stride=1, prefix='', image_logger=None) -> float:
 
     # with torch.no_grad():
     ray_batch = ray_sampler.get_all()
@@ -189,33 +281,19 @@ def log_view_to_tb(writer, global_step, args, model, ray_sampler, projector, gt_
 
     rgb_pred = img_HWC2CHW(ret['outputs_coarse']['rgb'].detach().cpu())
 
-    h_max = max(rgb_gt.shape[-2], rgb_pred.shape[-2], average_im.shape[-2])
-    w_max = max(rgb_gt.shape[-1], rgb_pred.shape[-1], average_im.shape[-1])
-    rgb_im = torch.zeros(3, h_max, 3*w_max)
-    rgb_im[:, :average_im.shape[-2], :average_im.shape[-1]] = average_im
-    rgb_im[:, :rgb_gt.shape[-2], w_max:w_max+rgb_gt.shape[-1]] = rgb_gt
-    rgb_im[:, :rgb_pred.shape[-2], 2*w_max:2*w_max+rgb_pred.shape[-1]] = rgb_pred
-
-    depth_im = ret['outputs_coarse']['depth'].detach().cpu()
-    acc_map = torch.sum(ret['outputs_coarse']['weights'], dim=-1).detach().cpu()
-
-    if ret['outputs_fine'] is None:
-        depth_im = img_HWC2CHW(colorize(depth_im, cmap_name='jet', append_cbar=True))
-        acc_map = img_HWC2CHW(colorize(acc_map, range=(0., 1.), cmap_name='jet', append_cbar=False))
+    # average | gt | coarse (| fine)
+    panels = [average_im, rgb_gt, rgb_pred]
+    depth_maps = [ret['outputs_coarse']['depth'].detach().cpu()]
+    acc_maps = [torch.sum(ret['outputs_coarse']['weights'], dim=-1).detach().cpu()]
+    if ret['outputs_fine'] is not None:
+        panels.append(img_HWC2CHW(ret['outputs_fine']['rgb'].detach().cpu()))
+        depth_maps.append(ret['outputs_fine']['depth'].detach().cpu())
+        acc_maps.append(torch.sum(ret['outputs_fine']['weights'], dim=-1).detach().cpu())
+
+    if image_logger is not None:
+        image_logger.log(writer, global_step, prefix, panels, depth_maps, acc_maps)
     else:
-        rgb_fine = img_HWC2CHW(ret['outputs_fine']['rgb'].detach().cpu())
-        rgb_fine_ = torch.zeros(3, h_max, w_max)
-        rgb_fine_[:, :rgb_fine.shape[-2], :rgb_fine.shape[-1]] = rgb_fine
-        rgb_im = torch.cat((rgb_im, rgb_fine_), dim=-1)
-        depth_im = torch.cat((depth_im, ret['outputs_fine']['depth'].detach().cpu()), dim=-1)
-        depth_im = img_HWC2CHW(colorize(depth_im, cmap_name='jet', append_cbar=True))
-        acc_map = torch.cat((acc_map, torch.sum(ret['outputs_fine']['weights'], dim=-1).detach().cpu()), dim=-1)
-        acc_map = img_HWC2CHW(colorize(acc_map, range=(0., 1.), cmap_name='jet', append_cbar=False))
-
-    # write the pred/gt rgb images and depths
-    writer.add_image(prefix + 'rgb_gt-coarse-fine', rgb_im, global_step)
-    writer.add_image(prefix + 'depth_gt-coarse-fine', depth_im, global_step)
-    writer.add_image(prefix + 'acc-coarse-fine', acc_map, global_step)
+        write_view_images(writer, global_step, prefix, panels, depth_maps, acc_maps)
 
     # write scalar
     pred_rgb = ret['outputs_fine']['rgb'] if ret['outputs_fine'] is not None else ret['outputs_coarse']['rgb']
@@ -250,8 +328,8 @@ if __name__ == '__main__':
     # Configuration for distributed training.
     if args.distributed:
         torch.cuda.set_device(args.local_rank)
+        # init_process_group already waits for all ranks, no extra barrier is needed.
         torch.distributed.init_process_group(backend="nccl", init_method="env://")
-        synchronize()
         print(f'[INFO] Train in distributed mode')
 
     train(args)
@@ -14,7 +14,11 @@
 
 import cv2
 import os
+import queue
 import shutil
+import threading
+import functools
+import imageio
 import torch
 import numpy as np
 import matplotlib as mpl
@@ -54,16 +58,58 @@ def img2mse(x, y, mask=None):
     :return: mse score
     '''
 
+    sq_diff = (x - y).square()
     if mask is None:
-        return torch.mean((x - y) * (x - y))
+        return torch.mean(sq_diff)
     else:
-        return torch.sum((x - y) * (x - y) * mask.unsqueeze(-1)) / (torch.sum(mask) * x.shape[-1] + TINY_NUMBER)
+        # Reduce over channels first so the mask is applied without broadcasting.
+        return torch.sum(sq_diff.sum(dim=-1) * mask) / (torch.sum(mask) * x.shape[-1] + TINY_NUMBER)
 
 
 def img2psnr(x, y, mask=None):
     return mse2psnr(img2mse(x, y, mask).item())
 
 
+class AsyncImageWriter(object):
+    """
+    Encode and write images on background threads, so that PNG encoding and
+    disk I/O stay off the rendering loop. Call close() to flush.
+    """
+    def __init__(self, num_workers=2, maxsize=32):
+        self.queue = queue.Queue(maxsize=maxsize)
+        # First exception raised by a worker, re-raised by close().
+        self.error = None
+        self.workers = [threading.Thread(target=self._run, daemon=True) for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def _run(self):
+        # A failed write must not end the worker, the queue would not be drained
+        # anymore and write()/close() would block forever.
+        for path, image in iter(self.queue.get, None):
+            try:
+                imageio.imwrite(path, image)
+            except Exception as error:
+                if self.error is None:
+                    self.error = error
+            finally:
+                self.queue.task_done()
+        self.queue.task_done()
+
+    def write(self, path, image):
+        # Own the buffer, the caller may reuse it while the image is encoded.
+        self.queue.put((path, np.array(image, copy=True)))
+
+    def close(self):
+        for _ in self.workers:
+            self.queue.put(None)
+        self.queue.join()
+        for worker in self.workers:
+            worker.join()
+        if self.error is not None:
+            raise self.error
+
+
 def cycle(iterable):
     while True:
         for x in iterable:
@@ -122,6 +168,15 @@ def get_vertical_colorbar(h, vmin, vmax, cmap_name='jet', label=None, cbar_preci
     return im
 
 
+@functools.lru_cache(maxsize=None)
+def get_colormap_lut(cmap_name='jet'):
+    """
+    The [N, 3] RGB table of a matplotlib colormap, built once per name.
+    """
+    cmap = cm.get_cmap(cmap_name)
+    return cmap(np.arange(cmap.N))[:, :3]
+
+
 def colorize_np(x, cmap_name='jet', mask=None, range=None, append_cbar=False, cbar_in_image=False, cbar_precision=2):
     '''
     turn a grayscale image into a color image
@@ -133,6 +188,7 @@ def colorize_np(x, cmap_name='jet', mask=None, range=None, append_cbar=False, cb
     :param cbar_in_image: put the color bar inside the image to keep the output image the same size as the input image
     :return: colorized image, [H, W]
     '''
+    x = np.asarray(x)
     if range is not None:
         vmin, vmax = range
     elif mask is not None:
@@ -150,16 +206,17 @@ def colorize_np(x, cmap_name='jet', mask=None, range=None, append_cbar=False, cb
     x = (x - vmin) / (vmax - vmin)
     # x = np.clip(x, 0., 1.)
 
-    cmap = cm.get_cmap(cmap_name)
-    x_new = cmap(x)[:, :, :3]
+    # Same binning as matplotlib's Colormap.__call__, as a single gather.
+    lut = get_colormap_lut(cmap_name)
+    lut_size = lut.shape[0]
+    x_new = lut[np.minimum((np.nan_to_num(x) * lut_size).astype(np.int64), lut_size - 1)]
 
     if mask is not None:
         mask = np.float32(mask[:, :, np.newaxis])
         x_new = x_new * mask + np.ones_like(x_new) * (1. - mask)
 
-    cbar = get_vertical_colorbar(h=x.shape[0], vmin=vmin, vmax=vmax, cmap_name=cmap_name, cbar_precision=cbar_precision)
-
     if append_cbar:
+        cbar = get_vertical_colorbar(h=x.shape[0], vmin=vmin, vmax=vmax, cmap_name=cmap_name, cbar_precision=cbar_precision)
         if cbar_in_image:
             x_new[:, -cbar.shape[1]:, :] = cbar
         else:
@@ -169,8 +226,38 @@ def colorize_np(x, cmap_name='jet', mask=None, range=None, append_cbar=False, cb
         return x_new
 
 
+def colorize_cuda(x, cmap_name='jet', range=None, append_cbar=False, cbar_in_image=False, cbar_precision=2):
+    """
+    colorize_np() for CUDA tensors without a mask, the lookup is gathered on the GPU.
+    """
+    x = x.float()
+    if range is not None:
+        vmin, vmax = range
+    else:
+        vmin, vmax = torch.quantile(x.flatten(), torch.tensor([0.01, 1.], device=x.device)).tolist()
+        vmax += TINY_NUMBER
+
+    x = (x.clamp(vmin, vmax) - vmin) / (vmax - vmin)
+
+    lut = torch.from_numpy(get_colormap_lut(cmap_name)).to(x.device, torch.float32)
+    lut_size = lut.shape[0]
+    x_new = lut[(torch.nan_to_num(x) * lut_size).long().clamp_(max=lut_size - 1)]
+
+    if append_cbar:
+        cbar = get_vertical_colorbar(h=x.shape[0], vmin=vmin, vmax=vmax, cmap_name=cmap_name, cbar_precision=cbar_precision)
+        cbar = torch.from_numpy(cbar).to(x.device)
+        if cbar_in_image:
+            x_new[:, -cbar.shape[1]:, :] = cbar
+        else:
+            x_new = torch.cat((x_new, torch.zeros_like(x_new[:, :5, :]), cbar), dim=1)
+    return x_new
+
+
 # tensor
 def colorize(x, cmap_name='jet', mask=None, range=None, append_cbar=False, cbar_in_image=False):
+    if x.is_cuda and mask is None:
+        return colorize_cuda(x, cmap_name, range, append_cbar, cbar_in_image)
+
     device = x.device
     x = x.cpu().numpy()
     if mask is not None: